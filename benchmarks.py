@@ -0,0 +1,373 @@
+"""
+Offline benchmarks for the codec, the reader, the packet parser and the
+RCon log classifier.
+
+    python benchmarks.py [--json results.json] [group ...]
+
+Every result is the best time of a single call in seconds.  The JSON file
+also records the commit and the Python version, so results of two
+commits can be compared side by side.
+"""
+import sys
+import json
+import time
+import random
+import struct
+import argparse
+import platform
+import subprocess
+import os
+import asyncio
+import tempfile
+import contextlib
+import huffman
+from playersessions import PlayerSessions
+from serverstate import ServerSnapshot, PlayerSnapshot
+from leaderboard import Leaderboard, week_of
+from capture import PacketCapture, CaptureDirection
+from replay import ReplayServer
+from zandronumserver import RConServerHeaders
+from metrics import METRICS, RCON_PACKETS, huffman_encode
+from commandindex import CommandTrie
+from rconlog import LogClassifier
+from bytereader import ByteReader, CheckedByteReader
+from zandronumserver import ZandronumServer
+from fakeserver import string
+from fixtures import INFO_FLAGS, launcher_response, rcon_log, legacy_classify, legacy_parse_info
+
+SERVERS = 100
+
+def measure(func, number: int = 1, repeat: int = 5) -> float:
+    """Best time of a single call to func out of several runs, in seconds."""
+    best = float('inf')
+
+    for i in range(repeat):
+        start = time.perf_counter()
+
+        for j in range(number):
+            func()
+
+        best = min(best, (time.perf_counter() - start) / number)
+
+    return best
+
+def measure_import(module: str, repeat: int = 5) -> float:
+    """Time to import module in a fresh interpreter, in seconds."""
+    code = (
+        'import time\n'
+        'start = time.perf_counter()\n'
+        f'import {module}\n'
+        'print(time.perf_counter() - start)\n'
+    )
+
+    # Run next to the modules, wherever the benchmarks were started from
+    directory = os.path.dirname(os.path.abspath(__file__))
+
+    return min(
+        float(subprocess.check_output([sys.executable, '-c', code], text=True, cwd=directory))
+        for i in range(repeat)
+    )
+
+def bench_startup() -> dict:
+    return {
+        'import huffman': measure_import('huffman'),
+        'import zandronumserver': measure_import('zandronumserver'),
+        # What every ZandronumServer used to pay before sharing the codec
+        'HuffmanObject(SKULLTAG_FREQS)': measure(lambda: huffman.HuffmanObject(huffman.SKULLTAG_FREQS), 10),
+        f'{SERVERS} x ZandronumServer()': measure(lambda: [ZandronumServer('127.0.0.1', 10666) for i in range(SERVERS)]),
+    }
+
+def bench_huffman() -> dict:
+    codec = huffman.SKULLTAG_HUFFMAN
+    payloads = {
+        'launcher query': struct.pack('<lLl', 199, 0xFFFFFFFF, int(time.time())),
+        'chat line': b'\x25' + string('\x1c[J1]Somebody\x1c-: gg, that was a close one! rematch on map07?'),
+        'empty server': launcher_response(),
+        '32 players': launcher_response(players=32),
+        '32 players, 50 pwads': launcher_response(players=32, pwads=50),
+    }
+
+    results = {}
+
+    for name, payload in payloads.items():
+        encoded = codec.encode(payload)
+        results[f'encode {name} ({len(payload)} B)'] = measure(lambda: codec.encode(payload), 100)
+        results[f'decode {name} ({len(encoded)} B)'] = measure(lambda: codec.decode(encoded), 100)
+
+    return results
+
+def bench_bytereader() -> dict:
+    count = 1000
+    numbers = bytes(range(256)) * (count * 4 // 256 + 1)
+    strings = string('\x1c[J1]Somebody\x1c-') * count
+
+    def read_all(reader, data, method):
+        res = reader(data)
+
+        for i in range(count):
+            method(res)
+
+    results = {}
+
+    for reader in (ByteReader, CheckedByteReader):
+        for method in ('read_byte', 'read_short', 'read_long', 'read_float', 'remaining'):
+            results[f'{reader.__name__} {count} x {method}'] = measure(
+                lambda: read_all(reader, numbers, getattr(reader, method)), 10)
+
+        results[f'{reader.__name__} {count} x read_string'] = measure(
+            lambda: read_all(reader, strings, reader.read_string), 10)
+
+    return results
+
+def bench_parser() -> dict:
+    server = ZandronumServer('127.0.0.1', 10666)
+    payloads = {
+        'empty server': launcher_response(),
+        '32 players': launcher_response(players=32),
+        '50 pwads': launcher_response(pwads=50),
+        '32 players, 50 pwads': launcher_response(players=32, pwads=50),
+        '32 players, 4 teams': launcher_response(players=32, teams=4),
+    }
+
+    def parse(payload):
+        res = ByteReader(payload)
+        res.read_long()
+        server.parse_info(res)
+
+    # The eager parser parse_info() replaced
+    def legacy_parse(payload):
+        res = ByteReader(payload)
+        res.read_long()
+        legacy_parse_info(server, res)
+
+    def parse_all(payload):
+        parse(payload)
+        list(server.players)
+        list(server.teams)
+
+    results = {}
+
+    for name, payload in payloads.items():
+        results[f'legacy eager {name}'] = measure(lambda: legacy_parse(payload), 100)
+        results[f'parse_info {name}'] = measure(lambda: parse(payload), 100)
+        results[f'parse_info {name}, every record'] = measure(lambda: parse_all(payload), 100)
+
+    return results
+
+def bench_rconlog() -> dict:
+    lines = rcon_log()
+    classifier = LogClassifier()
+
+    # Leaderboard rules on top of the built in ones
+    plugged = LogClassifier()
+    plugged.add_rule('frag', r'(.+?) was (?:fragged|splattered|railed) by (.+?)\.$', lambda victim, killer: None)
+    plugged.add_rule('suicide', r'(.+?) (?:suicides|mutated)\.$', lambda player: None)
+    plugged.add_rule('flag_taken', r'(.+?) has taken the (\w+) flag', lambda player, team: None)
+    plugged.add_rule('flag_captured', r'(.+?) scored for the (\w+) team', lambda player, team: None)
+
+    def classify_all(classify):
+        for line in lines:
+            classify(line)
+
+    return {
+        f'legacy chain {len(lines)} lines': measure(lambda: classify_all(legacy_classify)),
+        f'LogClassifier {len(lines)} lines': measure(lambda: classify_all(classifier.classify)),
+        f'LogClassifier + 4 rules {len(lines)} lines': measure(lambda: classify_all(plugged.classify)),
+    }
+
+def bench_commandindex() -> dict:
+    rng = random.Random(666)
+    prefixes = ['sv_', 'cl_', 'r_', 'snd_', 'gl_', 'con_', 'am_', 'vid_', '']
+    words = {rng.choice(prefixes) + ''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for i in range(rng.randint(3, 12)))
+             for i in range(3000)}
+
+    def build():
+        trie = CommandTrie()
+
+        for word in words:
+            trie.add(word)
+
+        return trie
+
+    trie = build()
+
+    # Every node sorts its words the first time it's asked for them
+    trie.complete('')
+    trie.complete('sv_')
+
+    return {
+        f'CommandTrie add {len(words)} words': measure(build),
+        'CommandTrie complete ""': measure(lambda: trie.complete(''), 1000),
+        'CommandTrie complete "sv_"': measure(lambda: trie.complete('sv_'), 1000),
+        'CommandTrie complete "sv_ab"': measure(lambda: trie.complete('sv_ab'), 1000),
+    }
+
+def bench_leaderboard() -> dict:
+    rng = random.Random(666)
+    players = [f'Player{i}' for i in range(200)]
+    maps = [f'MAP{i:02}' for i in range(1, 33)]
+    start = time.time() - 52 * 7 * 86400
+    frags = [(rng.choice(players), rng.choice(players), rng.choice(maps), start + i * 30) for i in range(100000)]
+    week = week_of(frags[-1][3])
+    results = {}
+
+    async def run(path: str):
+        leaderboard = Leaderboard(path)
+
+        def record():
+            for killer, victim, mapname, when in frags:
+                leaderboard.record_frag(killer, victim, mapname, when)
+
+        # A year of frags, recorded and written ten times over
+        results[f'Leaderboard record {len(frags)} frags'] = measure(record, repeat=1)
+        begin = time.perf_counter()
+        await leaderboard.flush()
+        results[f'Leaderboard flush {len(frags)} frags'] = time.perf_counter() - begin
+
+        for i in range(9):
+            record()
+            await leaderboard.flush()
+
+        for name, query in (('all time', {}), ('week', {'week': week}), ('map', {'mapname': 'MAP07'}), ('deaths', {'by': 'deaths'})):
+            begin = time.perf_counter()
+
+            for i in range(100):
+                await leaderboard.top(**query)
+
+            results[f'Leaderboard top {name}'] = (time.perf_counter() - begin) / 100
+
+        await leaderboard.close()
+
+    with tempfile.TemporaryDirectory() as directory:
+        asyncio.run(run(os.path.join(directory, 'leaderboard.db')))
+
+    return results
+
+def bench_playersessions() -> dict:
+    rng = random.Random(666)
+    names = [f'\x1c[J{i % 10}]Player{i}\x1c-' for i in range(1000)]
+    snapshots = [
+        ServerSnapshot(players=tuple(PlayerSnapshot(name, rng.randint(0, 50), rng.randint(0, 300), False, False, rng.randint(0, 3))
+                                     for name in rng.sample(names, 64)))
+        for i in range(100)
+    ]
+    sessions = PlayerSessions()
+    player = snapshots[0].players[0].name
+
+    for snapshot in snapshots:
+        sessions.update(snapshot)
+
+    return {
+        'PlayerSessions update 64 players': measure(lambda: sessions.update(snapshots[0]), 100),
+        'PlayerSessions get': measure(lambda: sessions.get(player), 1000),
+        'PlayerSessions search "player5"': measure(lambda: sessions.search('player5'), 1000),
+        'PlayerSessions samples': measure(lambda: sessions.get(player).samples(), 100),
+    }
+
+def bench_metrics() -> dict:
+    codec = huffman.SKULLTAG_HUFFMAN
+    payload = b'\x25' + string('\x1c[J1]Somebody\x1c-: gg, that was a close one! rematch on map07?')
+    results = {'encode chat line': measure(lambda: codec.encode(payload), 1000)}
+
+    try:
+        for enabled in (False, True):
+            METRICS.enabled = enabled
+            state = 'enabled' if enabled else 'disabled'
+            results[f'encode chat line, metrics {state}'] = measure(lambda: huffman_encode(codec, payload), 1000)
+            results[f'count RCon packet, metrics {state}'] = measure(lambda: RCON_PACKETS.inc('message'), 1000)
+    finally:
+        METRICS.enabled = False
+
+    results['render'] = measure(METRICS.render, 100)
+
+    return results
+
+def bench_replay() -> dict:
+    codec = huffman.SKULLTAG_HUFFMAN
+    messages = [codec.encode(bytes([RConServerHeaders.MESSAGE]) + string(line)) for line in rcon_log(10000)]
+    responses = [codec.encode(launcher_response(players=16, pwads=10, seed=seed)) for seed in range(100)]
+    results = {}
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'replay.zcap')
+        capture = PacketCapture(path, flush=False)
+
+        # A launcher query and its response after every 100 messages
+        for i, message in enumerate(messages):
+            if i % 100 == 0:
+                capture.write(CaptureDirection.SENT, codec.encode(struct.pack('<lLl', 199, INFO_FLAGS, 0)))
+                capture.write(CaptureDirection.RECEIVED, responses[i // 100])
+
+            capture.write(CaptureDirection.RECEIVED, message)
+
+        capture.close()
+
+        async def replay():
+            server = ReplayServer()
+
+            try:
+                return await server.replay(path)
+            finally:
+                server.close()
+
+        # RCon packets are logged with print
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            stats = asyncio.run(replay())
+
+        results[f'replay {stats.packets} packets'] = stats.seconds
+        results['replay per packet'] = stats.seconds / stats.packets
+
+    return results
+
+BENCHMARKS = {
+    'startup': bench_startup,
+    'huffman': bench_huffman,
+    'metrics': bench_metrics,
+    'bytereader': bench_bytereader,
+    'parser': bench_parser,
+    'rconlog': bench_rconlog,
+    'commandindex': bench_commandindex,
+    'leaderboard': bench_leaderboard,
+    'playersessions': bench_playersessions,
+    'replay': bench_replay,
+}
+
+def print_results(group: str, results: dict):
+    print(f'{group}:')
+
+    for name, seconds in results.items():
+        print(f'  {name:<50} {seconds * 1e6:12.2f} us')
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], text=True, stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+def main():
+    parser = argparse.ArgumentParser(description='Run offline benchmarks.')
+    parser.add_argument('groups', nargs='*', help=f'benchmark groups to run, all by default: {", ".join(BENCHMARKS)}')
+    parser.add_argument('--json', metavar='FILE', help='write results as JSON to FILE')
+    args = parser.parse_args()
+
+    for group in args.groups:
+        if group not in BENCHMARKS:
+            parser.error(f'unknown benchmark group: {group}')
+
+    results = {}
+
+    for group in args.groups or BENCHMARKS:
+        results[group] = BENCHMARKS[group]()
+        print_results(group, results[group])
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({
+                'commit': git_commit(),
+                'python': platform.python_version(),
+                'time': int(time.time()),
+                'results': results,
+            }, f, indent=4)
+
+if __name__ == '__main__':
+    main()
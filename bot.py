@@ -1,61 +1,163 @@
-import os, json, discord, datetime, re, aiohttp
+import os, discord, datetime
 from discord import *
 from discord.ext import tasks
 from dotenv import load_dotenv
 from zandronumserver import ZandronumServer, RConServerUpdate
-import asyncio
+from poller import InfoPoller, POLL_TICK
+from webhook import WebhookSink, bridge_event
+from embedupdater import EmbedUpdater
+from rconqueue import RConCommandQueue, escape_say
+from commandindex import CommandIndex
+from playersessions import PlayerSessions
+from leaderboard import Leaderboard, Frag, FRAG_RULES, LEADERBOARD_COLUMNS, week_of
+from rconlog import LogClassifier, clean_nick
+from metrics import METRICS, MetricsServer
+from configstore import ConfigStore
+from serverstate import PlayerJoined, PlayerLeft, MapChanged, PwadsChanged, InfoChanged
 load_dotenv()
 
 # Bot settings
 TOKEN = os.getenv('DISCORD_TOKEN')
 SERVER_IP = str(os.getenv('DOOM_SERVER_IP'))
 SERVER_PORT = int(os.getenv('DOOM_SERVER_PORT'))
-MY_GUILD_ID = int(os.getenv('DEBUG_MY_GUILD_ID'))
+MY_GUILD_ID = int(os.getenv('DEBUG_MY_GUILD_ID', 0)) # the server owner's guild, the only one with /rcon
+METRICS_PORT = int(os.getenv('METRICS_PORT', 0)) # 0 to not serve metrics
+CAPTURE_FILE = os.getenv('CAPTURE_FILE') # every packet is appended here if set
+SERVER_ADDRESS = f'{SERVER_IP}:{SERVER_PORT}' # key of the server's settings in the config
+SHUTDOWN_TIMEOUT = 5 # seconds to send the chat lines still queued when the bot stops
 
 # Bot initialization
 intents = discord.Intents.default()
 intents.message_content = True
 
-bot_guild = discord.Object(id=MY_GUILD_ID)
-bot_client = discord.Client(intents=intents)
+class DoomerClient(discord.Client):
+    async def close(self):
+        # Runs on the loop before it's gone, so what's buffered still gets out
+        if not self.is_closed():
+            await shutdown()
+
+        await super().close()
+
+bot_guild = discord.Object(id=MY_GUILD_ID) if MY_GUILD_ID else None
+bot_client = DoomerClient(intents=intents)
 tree = app_commands.CommandTree(bot_client)
-chat_webhook = discord.SyncWebhook.from_url(url=os.getenv('CHAT_WEBHOOK_URL'))
 
 DOOMSERVER = ZandronumServer(SERVER_IP, SERVER_PORT)
 
-CONFIG = {
-    'info-channel-id': 0,
-    'info-message-id': 0
-}
-CONFIG_FILE = 'config.json'
-
-def load_config():
-    if os.path.exists(CONFIG_FILE):
-        with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
-            CONFIG.update(json.load(f))
-            print('Config loaded!')
-    else:
-        save_config()
+if CAPTURE_FILE:
+    DOOMSERVER.start_capture(CAPTURE_FILE)
+POLLER = InfoPoller(DOOMSERVER)
+RCON_COMMANDS = RConCommandQueue(DOOMSERVER)
+COMMAND_INDEX = CommandIndex(DOOMSERVER)
+LEADERBOARD = Leaderboard()
+PLAYERS = PlayerSessions()
+METRICS_SERVER = MetricsServer(port=METRICS_PORT)
+
+CONFIG = ConfigStore()
+
+# Chat webhooks by url, shared by the guilds which use the same one
+CHAT_WEBHOOKS = {}
+
+async def load_config():
+    await CONFIG.load(MY_GUILD_ID, SERVER_ADDRESS)
+    CONFIG.start()
+    print('Config loaded!')
+
+    # Settings from the environment of the days of a single guild
+    if not MY_GUILD_ID:
+        return
+
+    settings = CONFIG.get(MY_GUILD_ID, SERVER_ADDRESS)
+
+    if not settings.chat_channel_id and os.getenv('CHAT_CHANNEL_ID'):
+        CONFIG.update(MY_GUILD_ID, SERVER_ADDRESS, chat_channel_id=int(os.getenv('CHAT_CHANNEL_ID')))
+
+    if not settings.chat_webhook_url and os.getenv('CHAT_WEBHOOK_URL'):
+        CONFIG.update(MY_GUILD_ID, SERVER_ADDRESS, chat_webhook_url=os.getenv('CHAT_WEBHOOK_URL'))
+
+def chat_webhooks() -> list:
+    """Webhooks of every guild which bridges the chat of the server."""
+    sinks = []
+
+    for guild_id, settings in CONFIG.guilds(SERVER_ADDRESS):
+        url = settings.chat_webhook_url
+
+        if not url:
+            continue
 
-def save_config():
-    with open(CONFIG_FILE, "w", encoding="utf-8") as f:
-        json.dump(CONFIG, f, ensure_ascii=False, indent=4)
+        if url not in CHAT_WEBHOOKS:
+            CHAT_WEBHOOKS[url] = WebhookSink(url)
+            CHAT_WEBHOOKS[url].start()
+
+        sinks.append(CHAT_WEBHOOKS[url])
+
+    return sinks
+
+async def shutdown():
+    """Write and send whatever is still buffered, then close everything."""
+    closing = [
+        ('leaderboard', LEADERBOARD.close),
+        ('config', CONFIG.close),
+        ('metrics server', METRICS_SERVER.close),
+    ] + [('chat webhook', lambda sink=sink: sink.close(SHUTDOWN_TIMEOUT)) for sink in CHAT_WEBHOOKS.values()]
+
+    for name, close in closing:
+        try:
+            await close()
+        except Exception as e:
+            print(f'Failed to close the {name}: {e}')
 
 @bot_client.event
 async def on_ready():
-    load_config()
+    await load_config()
+
+    RCON_COMMANDS.start()
+    COMMAND_INDEX.start()
+    LEADERBOARD.start()
 
-    await tree.sync(guild=bot_guild)
-    print('Guild commands synced')
+    if METRICS_PORT:
+        METRICS.enabled = True
+
+        try:
+            await METRICS_SERVER.start()
+            print(f'Serving metrics on port {METRICS_SERVER.port}')
+        except OSError as e:
+            print(f'Failed to serve metrics: {e}')
+
+    # Every guild gets the commands, only /rcon stays in the owner's guild
+    await tree.sync()
+    print('Commands synced')
+
+    if bot_guild:
+        await tree.sync(guild=bot_guild)
+        print('Guild commands synced')
 
     try:
         DOOMSERVER.start_rcon(os.getenv('RCON_PASSWORD'))
     except Exception as e:
+        print(f'Failed to start RCon: {e}')
+
+    # The poller keeps trying when the server is down
+    try:
+        await DOOMSERVER.get_info()
+    except (TimeoutError, OSError, ValueError) as e:
         print(f'Failed to update doom server info: {e}')
-    finally:
-        DOOMSERVER.update_info()
+
+    if not poll_info.is_running():
+        poll_info.start()
     
     print('Bot started')
+
+@tasks.loop(seconds=POLL_TICK)
+async def poll_info():
+    try:
+        await POLLER.poll()
+    except Exception as e:
+        print(f'Failed to poll doom server info: {e}')
+
+    if DOOMSERVER.snapshot:
+        LEADERBOARD.record_snapshot(DOOMSERVER.snapshot)
+        PLAYERS.update(DOOMSERVER.snapshot)
     
 def generate_info_embed():
     embed = discord.Embed(title=f'{DOOMSERVER.name} ({SERVER_IP}:{SERVER_PORT})', colour=discord.Colour.brand_red(), timestamp=datetime.datetime.now())
@@ -69,87 +171,176 @@ def generate_info_embed():
 
     return embed
 
-async def update_info():
-    await bot_client.change_presence(activity=discord.Game(name=f'{DOOMSERVER.name} with {DOOMSERVER.numplayers} online'))
+# Info embeds by guild
+INFO_EMBEDS = {}
 
-    channel_id = CONFIG['info-channel-id']
+def info_embed(guild_id: int) -> EmbedUpdater:
+    if guild_id not in INFO_EMBEDS:
+        def info_message_created(message: discord.Message):
+            CONFIG.update(guild_id, SERVER_ADDRESS, info_message_id=message.id)
 
-    if not channel_id:
-        return
-    
-    channel = bot_client.get_channel(channel_id)
+        INFO_EMBEDS[guild_id] = EmbedUpdater(generate_info_embed, on_created=info_message_created)
 
-    message_id = CONFIG['info-message-id']
+    return INFO_EMBEDS[guild_id]
 
-    embed = generate_info_embed()
+presence = None
 
-    if message_id:
-        try:
-            message = await channel.fetch_message(message_id)
-            await message.edit(embed=embed)
+async def update_info():
+    global presence
 
-            return
-        except discord.NotFound:
-            pass
+    activity = f'{DOOMSERVER.name} with {DOOMSERVER.numplayers} online'
 
-    msg = await channel.send(embed=embed)    
+    if activity != presence:
+        presence = activity
+        await bot_client.change_presence(activity=discord.Game(name=activity))
 
-    CONFIG['info-message-id'] = msg.id
-    save_config()
+    for guild_id, settings in CONFIG.guilds(SERVER_ADDRESS):
+        if not settings.info_channel_id:
+            continue
 
-@tree.command(name = 'ping', description = 'Just for test', guild=bot_guild)
+        updater = info_embed(guild_id)
+        updater.set_channel(bot_client.get_channel(settings.info_channel_id), settings.info_message_id)
+        updater.request()
+
+@tree.command(name = 'ping', description = 'Just for test')
 async def ping(ctx):
     await ctx.response.send_message("Pong!")
 
-player_msg_re = re.compile(r'^(.*?)\:\s(.+)$')
-system_msg_re = re.compile(r'^(->|.+\(RCON by .+\))')
-ip_re = re.compile(r'\b\d{1,3}(?:\.\d{1,3}){3}(?::\d+)?\b')
-connect_re = re.compile(r"^(?P<name>.+?) \([^)]*\) has connected\.$")
-disconnect_re = re.compile(r"^client (?P<name>.+?) \([^)]*\) disconnected\.$")
+@app_commands.command(name = 'rcon', description = 'Run a console command on the server')
+@app_commands.default_permissions(administrator=True)
+async def rcon(ctx, command: str):
+    if RCON_COMMANDS.command(command):
+        await ctx.response.send_message(f'Sent `{command}`', ephemeral=True)
+    else:
+        await ctx.response.send_message('Too many commands waiting, try again later', ephemeral=True)
+
+@tree.command(name = 'infochannel', description = 'Post the server info in this channel')
+@app_commands.guild_only()
+@app_commands.default_permissions(administrator=True)
+async def infochannel(ctx):
+    CONFIG.update(ctx.guild_id, SERVER_ADDRESS, info_channel_id=ctx.channel_id, info_message_id=0)
+    await ctx.response.send_message('Server info will be posted here', ephemeral=True)
+    await update_info()
+
+@tree.command(name = 'chatchannel', description = 'Bridge the server chat with this channel')
+@app_commands.guild_only()
+@app_commands.default_permissions(administrator=True)
+async def chatchannel(ctx, webhook_url: str):
+    CONFIG.update(ctx.guild_id, SERVER_ADDRESS, chat_channel_id=ctx.channel_id, chat_webhook_url=webhook_url)
+    await ctx.response.send_message('Server chat will be bridged here', ephemeral=True)
+
+@tree.command(name = 'leaderboard', description = 'Best players on the server')
+@app_commands.choices(
+    by=[app_commands.Choice(name=column, value=column) for column in LEADERBOARD_COLUMNS],
+    period=[app_commands.Choice(name='All time', value='all'), app_commands.Choice(name='This week', value='week')],
+)
+async def leaderboard(ctx, by: str = 'frags', period: str = 'all', map: str = ''):
+    week = week_of(datetime.datetime.now().timestamp()) if period == 'week' else None
+    rows = await LEADERBOARD.top(by, week, map)
+
+    title = f'Top {by}' + (' this week' if week else '') + (f' on {map.upper()}' if map else '')
+    embed = discord.Embed(title=title, colour=discord.Colour.brand_red())
+    embed.description = '\n'.join(
+        f'**{i}.** {row.player} - {getattr(row, by)}' for i, row in enumerate(rows, 1)
+    ) or 'Nobody yet'
+
+    await ctx.response.send_message(embed=embed)
+
+@tree.command(name = 'player', description = 'Information about a player')
+async def player(ctx, name: str):
+    entry = PLAYERS.get(name)
+
+    if entry is None:
+        await ctx.response.send_message(f'Haven\'t seen {clean_nick(name)}', ephemeral=True)
+        return
 
-def clean_nick(nick: str) -> str:
-    return re.sub(r'\x1c\[[^\]]*\]|\x1c-', '', nick)
+    embed = discord.Embed(title=clean_nick(entry.name), colour=discord.Colour.brand_red())
+    minutes = int(entry.duration() // 60)
+
+    if entry.online:
+        embed.add_field(name='Online', value=f'for {minutes} min')
+    else:
+        embed.add_field(name='Last seen', value=f'<t:{int(entry.ended)}:R>, played {minutes} min')
+
+    last = entry.history.last()
+
+    if last:
+        pings = entry.history.pings[:len(entry.history)]
+        embed.add_field(name='Frags', value=str(last.frags))
+        embed.add_field(name='Ping', value=f'{last.ping} (avg {sum(pings) // len(pings)})')
+
+        if last.team >= 0 and last.team < len(DOOMSERVER.teams):
+            embed.add_field(name='Team', value=DOOMSERVER.teams[last.team].name)
+
+    await ctx.response.send_message(embed=embed)
+
+@player.autocomplete('name')
+async def player_autocomplete(ctx, current: str):
+    return [app_commands.Choice(name=clean_nick(entry.name), value=clean_nick(entry.name)) for entry in PLAYERS.search(current)]
+
+@rcon.autocomplete('command')
+async def rcon_autocomplete(ctx, current: str):
+    # Only the command itself is completed, not its arguments
+    if ' ' in current:
+        return []
+
+    return [app_commands.Choice(name=name, value=name) for name in COMMAND_INDEX.complete(current)]
+
+# Nobody else gets to run commands on the server
+if bot_guild:
+    tree.add_command(rcon, guild=bot_guild)
+
+def collect_metrics():
+    METRICS.collect('doomer_rcon_queue_depth', 'RCon commands waiting to be sent.', RCON_COMMANDS.depth)
+    METRICS.collect('doomer_rcon_commands_total', 'RCon commands by what happened to them.', lambda: {
+        ('queued',): RCON_COMMANDS.stats.queued,
+        ('sent',): RCON_COMMANDS.stats.sent,
+        ('dropped',): RCON_COMMANDS.stats.dropped,
+    }, ('state',), 'counter')
+    METRICS.collect('doomer_rcon_reconnects_total', 'RCon sessions lost and started again.', lambda: DOOMSERVER.rcon_reconnects, type='counter')
+    METRICS.collect('doomer_rcon_state', 'RCon session state, 2 when logged in.', lambda: int(DOOMSERVER.rcon_state))
+    METRICS.collect('doomer_embed_edits_total', 'Info embed updates by whether the message was edited.', lambda: {
+        ('edited',): sum(updater.edits for updater in INFO_EMBEDS.values()),
+        ('skipped',): sum(updater.skipped for updater in INFO_EMBEDS.values()),
+    }, ('result',), 'counter')
+    METRICS.collect('doomer_leaderboard_pending', 'Leaderboard records waiting to be written.', LEADERBOARD.pending)
+    METRICS.collect('doomer_players_tracked', 'Players with a session history.', lambda: len(PLAYERS))
+    METRICS.collect('doomer_players_online', 'Players on the server.', lambda: DOOMSERVER.numplayers)
+
+    METRICS.collect('doomer_config_pending', 'Whether config changes are waiting to be written.', lambda: int(CONFIG.pending()))
+    METRICS.collect('doomer_webhook_queue_depth', 'Chat lines waiting to be sent to Discord.',
+                    lambda: sum(sink.depth() for sink in CHAT_WEBHOOKS.values()))
+    METRICS.collect('doomer_webhook_lines_total', 'Chat lines by what happened to them.', lambda: {
+        (state,): sum(getattr(sink.stats, state) for sink in CHAT_WEBHOOKS.values())
+        for state in ('queued', 'sent', 'dropped', 'failed')
+    }, ('state',), 'counter')
+
+collect_metrics()
+
+RCON_LOG = LogClassifier()
+
+for rule in FRAG_RULES:
+    RCON_LOG.add_rule(rule.name, rule.pattern, rule.factory)
 
 @DOOMSERVER.message
 async def on_message(msg: str):
-    if chat_webhook is None:
-        return
-
     print(f'Processing RCon message: {msg}')
 
-    m = connect_re.match(msg)
-    if m:
-        chat_webhook.send(content=f'**{clean_nick(m.group('name'))}** has connected', username='Server')
+    event = RCON_LOG.classify(msg)
 
-    m = disconnect_re.match(msg)
-    if m:
-        chat_webhook.send(content=f'**{clean_nick(m.group('name'))}** has disconnected', username='Server')
-    
-    RCON_KEYS = (
-        "Name:", "Team:", "Skin:", "Gender:", "PlayerClass:", "Account:",
-        "ColorSet:", "SwitchOnPickup:", "MoveBob:", "StillBob:",
-        "Wi_NoAutostartMap:", "RailColor:", "Handicap:", "CL_TicsPerUpdate:",
-        "CL_ConnectionType:", "CL_ClientFlags:", "Voice_Enable:",
-        "Voice_ListenFilter:", "Voice_TransmitFilter:", "Autoaim:", "Color:",
-        "Connect"
-    )
-
-    if ip_re.search(msg) or msg.strip().startswith(RCON_KEYS):
-        return
-    
-    playermsg = player_msg_re.match(msg)
-    systemmsg = system_msg_re.match(msg)
+    if isinstance(event, Frag):
+        LEADERBOARD.record_frag(event.killer, event.victim, DOOMSERVER.mapname)
 
-    if playermsg and not systemmsg:
-        nick, message = playermsg.groups()
-
-        if nick != '<Server>':
-            chat_webhook.send(content=message, username=clean_nick(nick), avatar_url="https://sffempire.ru/bot/playeravatar.png")
+    for sink in chat_webhooks():
+        bridge_event(sink, event)
 
 @bot_client.event
 async def on_message(message: discord.Message):
-    if message.channel.id == int(os.getenv('CHAT_CHANNEL_ID')) and not message.author.bot:    
-        DOOMSERVER.send_command_rcon(f'SAY "\\c[J1]{message.author.name}: \\c[C2]{message.content}"')
+    if message.author.bot or message.guild is None:
+        return
+
+    if message.channel.id == CONFIG.get(message.guild.id, SERVER_ADDRESS).chat_channel_id:
+        RCON_COMMANDS.say(f'\\c[J1]{escape_say(message.author.name)}: \\c[C2]{escape_say(message.content)}', escape=False)
 
 @DOOMSERVER.update
 async def update(update: RConServerUpdate, value):
@@ -163,9 +354,16 @@ async def update(update: RConServerUpdate, value):
 
         case RConServerUpdate.MAP:
             print(f'Map changed to {value}')
-            chat_webhook.send(content=f'Map changed to **{value}**', username='Server')
+            for sink in chat_webhooks():
+                sink.send(content=f'Map changed to **{value}**', username='Server')
 
-    await update_info()
+# Changes which show up in the info embed or the presence
+EMBED_EVENTS = (PlayerJoined, PlayerLeft, MapChanged, PwadsChanged, InfoChanged)
+
+@DOOMSERVER.change
+async def change(event):
+    if isinstance(event, EMBED_EVENTS):
+        await update_info()
 
 
 if __name__ == '__main__':
@@ -173,3 +371,7 @@ if __name__ == '__main__':
         bot_client.run(token=TOKEN)
     finally: 
         DOOMSERVER.disconnect_rcon()
+
+        # In case the client never got to close, the loop is gone by now
+        if CONFIG.pending():
+            CONFIG.save()
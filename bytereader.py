@@ -1,46 +1,151 @@
-import io
 import struct
 
+BYTE = struct.Struct('<B')
+SHORT = struct.Struct('<h')
+USHORT = struct.Struct('<H')
+ULONG = struct.Struct('<I')
+LONG = struct.Struct('<i')
+FLOAT = struct.Struct('<f')
+
+class TruncatedPacketError(ValueError):
+    """Packet ended before the value that was being read."""
+
 class ByteReader:
-    def __init__(self, data: bytes):
-        self.buffer = io.BytesIO(data)
+    """
+    Reads little endian values from a packet without copying it.  data
+    can be anything with the buffer protocol and a find() method, like
+    bytes, bytearray or mmap.
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self.view = memoryview(data)
+        self.pos = 0
+        self.size = len(self.view)
 
     def read_bytes(self, size) -> bytes:
-        return self.buffer.read(size)
+        pos = self.pos
+        self.pos = min(pos + size, self.size)
+        return bytes(self.view[pos:self.pos])
 
     def read_byte(self) -> int:
-        return struct.unpack("<B", self.buffer.read(1))[0]
+        value = self.view[self.pos]
+        self.pos += 1
+        return value
 
     def read_short(self) -> int:
-        return struct.unpack("<h", self.buffer.read(2))[0]
-    
+        value = SHORT.unpack_from(self.view, self.pos)[0]
+        self.pos += 2
+        return value
+
+    def read_ushort(self) -> int:
+        value = USHORT.unpack_from(self.view, self.pos)[0]
+        self.pos += 2
+        return value
+
     def read_ulong(self) -> int:
-        return struct.unpack("<I", self.buffer.read(4))[0]
+        value = ULONG.unpack_from(self.view, self.pos)[0]
+        self.pos += 4
+        return value
 
     def read_long(self) -> int:
-        return struct.unpack("<i", self.buffer.read(4))[0]
+        value = LONG.unpack_from(self.view, self.pos)[0]
+        self.pos += 4
+        return value
 
     def read_float(self) -> float:
-        return struct.unpack("<f", self.buffer.read(4))[0]
+        value = FLOAT.unpack_from(self.view, self.pos)[0]
+        self.pos += 4
+        return value
 
     def read_string(self, encoding="utf-8") -> str:
-        chars = []
-        while True:
-            b = self.buffer.read(1)
-            if not b or b == b'\x00':
-                break
-            chars.append(b)
-        return b''.join(chars).decode(encoding, errors='ignore')
+        pos = self.pos
+        end = self.data.find(b'\x00', pos)
+
+        if end < 0:
+            end = self.size
+            self.pos = end
+        else:
+            self.pos = end + 1
+
+        return self.data[pos:end].decode(encoding, 'ignore')
+
+    def skip(self, size: int):
+        self.pos = min(self.pos + size, self.size)
+
+    def skip_string(self):
+        end = self.data.find(b'\x00', self.pos)
+        self.pos = self.size if end < 0 else end + 1
 
     def tell(self) -> int:
-        return self.buffer.tell()
+        return self.pos
 
     def seek(self, pos: int):
-        self.buffer.seek(pos)
+        self.pos = pos
 
     def remaining(self) -> int:
-        current = self.buffer.tell()
-        self.buffer.seek(0, io.SEEK_END)
-        end = self.buffer.tell()
-        self.buffer.seek(current)
-        return end - current
\ No newline at end of file
+        return self.size - self.pos
+
+class CheckedByteReader(ByteReader):
+    """
+    ByteReader that checks every read against the end of the packet and
+    raises TruncatedPacketError instead of returning short data or
+    letting struct.error through.
+    """
+
+    def _check(self, size: int, what: str):
+        if self.pos + size > self.size:
+            raise TruncatedPacketError(
+                f'Packet truncated: {what} needs {size} bytes at offset {self.pos}, '
+                f'but only {max(self.size - self.pos, 0)} are left'
+            )
+
+    def read_bytes(self, size) -> bytes:
+        self._check(size, 'bytes')
+        return super().read_bytes(size)
+
+    def read_byte(self) -> int:
+        self._check(1, 'byte')
+        return super().read_byte()
+
+    def read_short(self) -> int:
+        self._check(2, 'short')
+        return super().read_short()
+
+    def read_ushort(self) -> int:
+        self._check(2, 'ushort')
+        return super().read_ushort()
+
+    def read_ulong(self) -> int:
+        self._check(4, 'ulong')
+        return super().read_ulong()
+
+    def read_long(self) -> int:
+        self._check(4, 'long')
+        return super().read_long()
+
+    def read_float(self) -> float:
+        self._check(4, 'float')
+        return super().read_float()
+
+    def read_string(self, encoding="utf-8") -> str:
+        pos = self.pos
+        end = self.data.find(b'\x00', pos)
+
+        if end < 0:
+            raise TruncatedPacketError(f'Packet truncated: string at offset {pos} has no terminator')
+
+        self.pos = end + 1
+        return self.data[pos:end].decode(encoding, 'ignore')
+
+    def skip(self, size: int):
+        self._check(size, 'bytes')
+        self.pos += size
+
+    def skip_string(self):
+        end = self.data.find(b'\x00', self.pos)
+
+        if end < 0:
+            raise TruncatedPacketError(f'Packet truncated: string at offset {self.pos} has no terminator')
+
+        self.pos = end + 1
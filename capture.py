@@ -0,0 +1,134 @@
+"""
+Append-only capture files of the raw datagrams exchanged with a server,
+still Huffman coded, so they can be replayed offline with replay.py.
+
+A file starts with CAPTURE_MAGIC and a version byte, then every packet
+is a RECORD header, its time, direction and size, and its data.
+
+    server.start_capture('incident.zcap')
+    ...
+    server.stop_capture()
+
+    with CaptureReader('incident.zcap') as capture:
+        for packet in capture:
+            print(packet.time, packet.direction, len(packet.data))
+"""
+import os
+import mmap
+import time
+import struct
+from enum import IntEnum
+from dataclasses import dataclass
+from typing import Iterator
+
+CAPTURE_MAGIC = b'ZCAP'
+CAPTURE_VERSION = 1
+
+# Bytes buffered before they are written to the file, unless every
+# packet is flushed
+CAPTURE_BUFFER = 64 * 1024
+
+HEADER = struct.Struct('<4sB')
+RECORD = struct.Struct('<dBH') # time.time(), direction, size
+
+class CaptureDirection(IntEnum):
+    SENT = 0
+    RECEIVED = 1
+
+@dataclass(frozen=True)
+class CapturedPacket:
+    time: float
+    direction: CaptureDirection
+    data: bytes # as it was on the wire
+
+class PacketCapture:
+    """
+    Capture file written to.  Every packet is flushed to the file right
+    away, so a crash loses none of them, unless flush is False, like when
+    writing a capture in bulk.
+    """
+
+    def __init__(self, path: str, buffering: int = CAPTURE_BUFFER, flush: bool = True):
+        self.path = path
+        self.packets = 0
+        self.flush_packets = flush
+
+        # Only ever appended to, after checking it's a capture already
+        if os.path.exists(path) and os.path.getsize(path):
+            with open(path, 'rb') as f:
+                _check_header(f.read(HEADER.size))
+
+        self._file = open(path, 'ab', buffering=buffering)
+
+        if self._file.tell() == 0:
+            self._file.write(HEADER.pack(CAPTURE_MAGIC, CAPTURE_VERSION))
+
+    @property
+    def closed(self) -> bool:
+        return self._file.closed
+
+    def write(self, direction: CaptureDirection, data: bytes, when: float = None):
+        self._file.write(RECORD.pack(time.time() if when is None else when, direction, len(data)) + data)
+        self.packets += 1
+
+        if self.flush_packets:
+            self._file.flush()
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+def _check_header(header: bytes):
+    if len(header) < HEADER.size:
+        raise ValueError('Not a capture file')
+
+    magic, version = HEADER.unpack(header)
+
+    if magic != CAPTURE_MAGIC:
+        raise ValueError('Not a capture file')
+
+    if version != CAPTURE_VERSION:
+        raise ValueError(f'Unsupported capture version {version}')
+
+class CaptureReader:
+    """
+    Packets of a capture file, read from a memory map.  A record cut off
+    at the end, like when the bot died while writing it, is left out.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size < HEADER.size:
+                raise ValueError('Not a capture file')
+
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        _check_header(self._map[:HEADER.size])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __iter__(self) -> Iterator[CapturedPacket]:
+        data = self._map
+        end = len(data)
+        pos = HEADER.size
+
+        while pos + RECORD.size <= end:
+            when, direction, size = RECORD.unpack_from(data, pos)
+            pos += RECORD.size
+
+            if pos + size > end:
+                break
+
+            yield CapturedPacket(when, CaptureDirection(direction), data[pos:pos + size])
+            pos += size
+
+    def close(self):
+        self._map.close()
@@ -0,0 +1,166 @@
+import string
+import asyncio
+from zandronumserver import ZandronumServer, RConState, TooManyCompletions
+
+# Seconds between two walks over the server's commands, and before
+# trying again after one failed
+INDEX_REFRESH = 3600
+INDEX_RETRY = 60
+
+# Seconds between two tab completions during a walk, so it doesn't flood
+# the server.
+INDEX_REQUEST_INTERVAL = 0.05
+
+# Characters console commands and cvars are made of, and those only some
+# start with, like +attack, -attack and ?
+COMMAND_CHARS = string.ascii_lowercase + string.digits + '_'
+COMMAND_LEADING_CHARS = '+-?'
+
+class _Node:
+    __slots__ = ('children', 'words', 'sorted')
+
+    def __init__(self):
+        self.children = {}
+        self.words = [] # every word below, sorted when first asked for
+        self.sorted = True
+
+class CommandTrie:
+    """
+    Case insensitive prefix tree of words.  Every node keeps the words
+    below it, so completing a prefix is a walk down to its node and a
+    slice.
+    """
+
+    def __init__(self):
+        self._root = _Node()
+        self._words = set()
+
+    def __len__(self):
+        return len(self._words)
+
+    def add(self, word: str):
+        key = word.lower()
+
+        if key in self._words:
+            return
+
+        self._words.add(key)
+        node = self._root
+
+        for char in key:
+            node.words.append(word)
+            node.sorted = False
+            child = node.children.get(char)
+
+            if child is None:
+                child = node.children[char] = _Node()
+
+            node = child
+
+        node.words.append(word)
+        node.sorted = False
+
+    def complete(self, prefix: str, limit: int = 25) -> list:
+        """Up to limit words starting with prefix, in alphabetical order."""
+        node = self._root
+
+        for char in prefix.lower():
+            node = node.children.get(char)
+
+            if node is None:
+                return []
+
+        if not node.sorted:
+            node.words.sort(key=str.lower)
+            node.sorted = True
+
+        return node.words[:limit]
+
+class CommandIndex:
+    """
+    Console commands and cvars of a server, learnt from its tab
+    completions.  Answers from memory, so it's fast enough for Discord
+    autocomplete on every keystroke.
+
+        index = CommandIndex(server)
+        index.start()
+        index.complete('sv_')
+    """
+
+    def __init__(self, server: ZandronumServer, refresh: float = INDEX_REFRESH):
+        self.server = server
+        self.refresh_interval = refresh
+        self.trie = CommandTrie()
+        self._task = None
+
+    def complete(self, prefix: str, limit: int = 25) -> list:
+        return self.trie.complete(prefix, limit)
+
+    async def refresh(self):
+        """
+        Walk the server's commands, asking for longer prefixes wherever it
+        has too many completions for a short one.
+        """
+        trie = CommandTrie()
+
+        for char in COMMAND_CHARS + COMMAND_LEADING_CHARS:
+            await self._walk(char, trie)
+
+        self.trie = trie
+
+    async def _walk(self, prefix: str, trie: CommandTrie) -> int:
+        """Add the words starting with prefix to trie.  Returns how many there are."""
+        try:
+            words = await self.server.tab_complete(prefix)
+        except TooManyCompletions as e:
+            await asyncio.sleep(INDEX_REQUEST_INTERVAL)
+            found = 0
+
+            for char in COMMAND_CHARS:
+                found += await self._walk(prefix + char, trie)
+
+            # Longer prefixes never complete to the prefix itself, it's one
+            # of the words when the server counted more than they did.
+            if found < e.count:
+                trie.add(prefix)
+                found += 1
+
+            return found
+
+        for word in words:
+            trie.add(word)
+
+        await asyncio.sleep(INDEX_REQUEST_INTERVAL)
+        return len(words)
+
+    def start(self):
+        """Refresh in the background on the running event loop."""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+            self._task = None
+
+    async def _run(self):
+        while True:
+            if self.server.rcon_state != RConState.LOGGED_IN:
+                await asyncio.sleep(1)
+                continue
+
+            try:
+                await self.refresh()
+                print(f'Indexed {len(self.trie)} console commands')
+            except Exception as e:
+                print(f'Failed to index console commands: {e}')
+                await asyncio.sleep(INDEX_RETRY)
+                continue
+
+            await asyncio.sleep(self.refresh_interval)
@@ -0,0 +1,201 @@
+"""
+Settings of every guild for every server it follows, kept in memory and
+written to a JSON file in the background.  Reading and changing settings
+never touches the disk, changes are written together every CONFIG_FLUSH
+seconds on a thread of their own, to a temporary file which then
+replaces the old one, so the file is never half written.
+
+    store = ConfigStore('config.json')
+    await store.load()
+    store.start()
+    store.update(guild_id, '127.0.0.1:10666', info_channel_id=channel.id)
+    store.get(guild_id, '127.0.0.1:10666').info_channel_id
+"""
+import os
+import json
+import asyncio
+import tempfile
+from dataclasses import dataclass, asdict, fields, replace
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, Tuple
+
+CONFIG_FILE = 'config.json'
+CONFIG_VERSION = 2
+
+# Seconds between two writes of the file
+CONFIG_FLUSH = 2
+
+# Keys of the config of a single server and guild, before there were more
+LEGACY_KEYS = {
+    'info-channel-id': 'info_channel_id',
+    'info-message-id': 'info_message_id',
+}
+
+@dataclass(frozen=True)
+class ServerSettings:
+    info_channel_id: int = 0
+    info_message_id: int = 0 # 0 until the info embed was sent
+    chat_channel_id: int = 0
+    chat_webhook_url: str = ''
+
+SETTINGS_FIELDS = frozenset(field.name for field in fields(ServerSettings))
+
+class ConfigStore:
+    def __init__(self, path: str = CONFIG_FILE, flush_interval: float = CONFIG_FLUSH):
+        self.path = path
+        self.flush_interval = flush_interval
+
+        # Settings by guild id and server address, like '127.0.0.1:10666'
+        self._guilds: Dict[int, Dict[str, ServerSettings]] = {}
+        self._dirty = False
+
+        # Writes run one after the other on this thread
+        self._executor = ThreadPoolExecutor(1, thread_name_prefix='config')
+        self._task = None
+
+    def get(self, guild_id: int, server: str) -> ServerSettings:
+        """Settings of a guild for a server, the defaults if it has none."""
+        return self._guilds.get(guild_id, {}).get(server, ServerSettings())
+
+    def servers(self, guild_id: int) -> Dict[str, ServerSettings]:
+        return dict(self._guilds.get(guild_id, {}))
+
+    def guilds(self, server: str) -> Iterator[Tuple[int, ServerSettings]]:
+        """Every guild which has settings for server, with them."""
+        for guild_id, servers in self._guilds.items():
+            if server in servers:
+                yield guild_id, servers[server]
+
+    def update(self, guild_id: int, server: str, **changes) -> ServerSettings:
+        """Change settings of a guild for a server.  They're written with the next flush."""
+        unknown = changes.keys() - SETTINGS_FIELDS
+
+        if unknown:
+            raise ValueError(f'Unknown settings: {", ".join(sorted(unknown))}')
+
+        settings = replace(self.get(guild_id, server), **changes)
+        self._guilds.setdefault(guild_id, {})[server] = settings
+        self._dirty = True
+
+        return settings
+
+    def remove(self, guild_id: int, server: str):
+        servers = self._guilds.get(guild_id, {})
+
+        if servers.pop(server, None) is not None:
+            self._dirty = True
+
+        if not servers:
+            self._guilds.pop(guild_id, None)
+
+    def pending(self) -> bool:
+        return self._dirty
+
+    def _to_json(self) -> dict:
+        return {
+            'version': CONFIG_VERSION,
+            'guilds': {
+                str(guild_id): {server: asdict(settings) for server, settings in servers.items()}
+                for guild_id, servers in self._guilds.items()
+            },
+        }
+
+    def _from_json(self, data: dict, legacy_guild: int, legacy_server: str):
+        self._guilds = {}
+
+        # A config of the single guild and server there used to be
+        if 'version' not in data:
+            changes = {LEGACY_KEYS[key]: value for key, value in data.items() if key in LEGACY_KEYS}
+
+            if legacy_guild and legacy_server and any(changes.values()):
+                self.update(legacy_guild, legacy_server, **changes)
+
+            return
+
+        for guild_id, servers in data.get('guilds', {}).items():
+            for server, settings in servers.items():
+                known = {key: value for key, value in settings.items() if key in SETTINGS_FIELDS}
+                self._guilds.setdefault(int(guild_id), {})[server] = ServerSettings(**known)
+
+    def _read(self) -> dict:
+        if not os.path.exists(self.path):
+            return {}
+
+        with open(self.path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def save(self):
+        """Write the settings right away, on the calling thread."""
+        self._write(self._to_json())
+        self._dirty = False
+
+    def _write(self, data: dict):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, temp = tempfile.mkstemp(prefix='.config-', suffix='.json', dir=directory)
+
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False, indent=4)
+                f.flush()
+                os.fsync(f.fileno())
+
+            os.replace(temp, self.path)
+        except BaseException:
+            os.unlink(temp)
+            raise
+
+    async def _run_io(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    async def load(self, legacy_guild: int = 0, legacy_server: str = ''):
+        """
+        Read the file.  An old single server config is taken as the
+        settings of legacy_guild for legacy_server.
+        """
+        data = await self._run_io(self._read)
+        self._from_json(data, legacy_guild, legacy_server)
+        self._dirty = 'version' not in data
+
+    async def flush(self):
+        """Write the settings if they changed since the last write."""
+        if not self._dirty:
+            return
+
+        # Taken on the loop, so the thread never sees settings mid-change
+        data = self._to_json()
+        self._dirty = False
+
+        try:
+            await self._run_io(self._write, data)
+        except BaseException:
+            self._dirty = True
+            raise
+
+    def start(self):
+        """Flush in the background on the running event loop."""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f'Failed to save config: {e}')
+
+    async def close(self):
+        """Stop flushing in the background and write what's left."""
+        if self._task:
+            self._task.cancel()
+
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+            self._task = None
+
+        await self.flush()
+        self._executor.shutdown()
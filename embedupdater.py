@@ -0,0 +1,126 @@
+import asyncio
+import discord
+from typing import Callable, Dict
+
+# Seconds to wait for more updates before editing the message
+EMBED_DEBOUNCE = 2
+
+# Seconds between two edits in one channel, by any updater
+EMBED_MIN_INTERVAL = 5
+
+class EmbedUpdater:
+    """
+    Keeps a message with an embed up to date without flooding Discord.
+    request() can be called on every update, they are merged within
+    window, and the message is only edited when the embed rendered by
+    render() differs from the one sent last.  The message is fetched once
+    and kept, it's only sent anew when it was deleted.
+
+        updater = EmbedUpdater(generate_info_embed)
+        updater.set_channel(channel, message_id)
+        updater.request()
+    """
+
+    # Loop time of the last edit by channel id, shared by the messages of
+    # every updater in it, Discord limits edits per channel
+    _edited: Dict[int, float] = {}
+
+    def __init__(self, render: Callable[[], discord.Embed], window: float = EMBED_DEBOUNCE,
+                 min_interval: float = EMBED_MIN_INTERVAL, on_created: Callable = None):
+        self.render = render
+        self.window = window
+        self.min_interval = min_interval
+
+        # Called with the message when a new one had to be sent
+        self.on_created = on_created
+
+        self.channel = None
+        self.message_id = 0
+        self.message = None
+
+        self.edits = 0
+        self.skipped = 0
+
+        self._sent = None
+        self._dirty = False
+        self._task = None
+
+    def set_channel(self, channel, message_id: int = 0):
+        if channel is not self.channel or message_id != self.message_id:
+            self.channel = channel
+            self.message_id = message_id
+            self.message = None
+            self._sent = None
+
+    def request(self):
+        """Update the message soon, together with whatever else comes in meanwhile."""
+        self._dirty = True
+
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+
+        while self._dirty:
+            await asyncio.sleep(self.window)
+
+            if self.channel is None:
+                self._dirty = False
+                return
+
+            wait = self._edited.get(self.channel.id, -float('inf')) + self.min_interval - loop.time()
+
+            if wait > 0:
+                await asyncio.sleep(wait)
+
+            # Updates from now on need another round
+            self._dirty = False
+
+            try:
+                await self.update()
+            except Exception as e:
+                print(f'Failed to update embed: {e}')
+
+    async def update(self) -> bool:
+        """Edit the message right away if the embed changed.  Returns whether it did."""
+        embed = self.render()
+        rendered = embed.to_dict()
+
+        # The timestamp changes on every render
+        rendered.pop('timestamp', None)
+
+        if rendered == self._sent:
+            self.skipped += 1
+            return False
+
+        message = await self._fetch_message()
+
+        if message is not None:
+            try:
+                await message.edit(embed=embed)
+            except discord.NotFound:
+                message = None
+
+        if message is None:
+            message = await self.channel.send(embed=embed)
+            self.message_id = message.id
+
+            if self.on_created:
+                self.on_created(message)
+
+        self.message = message
+        self._sent = rendered
+        self._edited[self.channel.id] = asyncio.get_running_loop().time()
+        self.edits += 1
+
+        return True
+
+    async def _fetch_message(self):
+        if self.message is None and self.message_id:
+            try:
+                self.message = await self.channel.fetch_message(self.message_id)
+            except discord.NotFound:
+                pass
+
+        return self.message
@@ -0,0 +1,332 @@
+"""
+A stand-in for zandronum-server on a local UDP port, for tests and load
+tests which can't run the real one.  It answers launcher queries, in
+segments when the response is large, and speaks the RCon protocol:
+salted login, MESSAGE, UPDATE, PONG and tab completion.  What happens on
+the server is scripted:
+
+    server = FakeZandronumServer(password='secret')
+    await server.start()
+    server.join('Player')
+    await server.play(['Player: hello', partial(server.leave, 'Player')], rate=1000)
+
+or from a shell, with a busy server forever:
+
+    python fakeserver.py --port 10666 --password secret --rate 2000
+"""
+import random
+import struct
+import asyncio
+import hashlib
+import argparse
+from functools import partial
+from typing import Callable, Iterable, Iterator
+import huffman
+from bytereader import ByteReader
+from zandronumserver import (
+    ServerQueryFlags, ServerLauncherResponse, ZandronumGamemode, ZandronumPlayer,
+    RConClientHeaders, RConServerHeaders, RConServerUpdate,
+    LAUNCHER_CHALLENGE, RCON_PROTOCOL_VERSION, TEAM_GAMEMODES,
+)
+
+# Largest launcher response sent in one datagram, more is segmented
+FAKE_SEGMENT_SIZE = 1024
+
+# Sections the fake server can answer with
+FAKE_INFO_FLAGS = (
+    ServerQueryFlags.NAME | ServerQueryFlags.MAPNAME | ServerQueryFlags.MAXCLIENTS |
+    ServerQueryFlags.MAXPLAYERS | ServerQueryFlags.PWADS | ServerQueryFlags.GAMETYPE |
+    ServerQueryFlags.IWAD | ServerQueryFlags.NUMPLAYERS | ServerQueryFlags.PLAYERDATA
+)
+
+# Tab completions answered at once, more get TOOMANYTABCOMPLETES
+FAKE_TAB_COMPLETIONS = 10
+
+FAKE_COMMANDS = ('changemap', 'fraglimit', 'kick', 'kickfromgame', 'map', 'say', 'sv_hostname', 'timelimit')
+
+def string(value: str) -> bytes:
+    return value.encode() + b'\x00'
+
+def segment_response(response: bytes, size: int = FAKE_SEGMENT_SIZE) -> list:
+    """Datagrams of a launcher response split into segments of up to size bytes."""
+    body = response[4:]
+    count = (len(body) + size - 1) // size
+
+    return [
+        struct.pack('<lBBHHH', ServerLauncherResponse.CHALLENGE_SEGMENTED,
+                    i, count, i * size, len(body[i * size:(i + 1) * size]), len(body)) + body[i * size:(i + 1) * size]
+        for i in range(count)
+    ]
+
+class FakeZandronumServer(asyncio.DatagramProtocol):
+    def __init__(self, password: str = 'secret', name: str = 'Fake Server', mapname: str = 'MAP01',
+                 segment_size: int = FAKE_SEGMENT_SIZE, commands: Iterable[str] = FAKE_COMMANDS):
+        self.password = password
+        self.name = name
+        self.mapname = mapname
+        self.pwads = []
+        self.gametype = ZandronumGamemode.COOPERATIVE
+        self.maxclients = 64
+        self.maxplayers = 32
+        self.segment_size = segment_size
+        self.commands = list(commands)
+
+        self.players = {} # by name
+
+        # RCon clients by address: their salt, and whether they logged in
+        self.clients = {}
+        self.received = [] # commands sent over RCon
+
+        self.queries = 0
+        self.connections = 0 # RCon logins begun
+        self.logins = 0 # of them which got the password right
+        self.pongs = 0
+        self.messages = 0 # log lines sent, to every client
+
+        self._codec = huffman.SKULLTAG_HUFFMAN
+        self._transport = None
+
+    @property
+    def address(self) -> tuple:
+        return self._transport.get_extra_info('sockname')[:2]
+
+    @property
+    def port(self) -> int:
+        return self.address[1]
+
+    async def start(self, host: str = '127.0.0.1', port: int = 0):
+        loop = asyncio.get_running_loop()
+        await loop.create_datagram_endpoint(lambda: self, local_addr=(host, port))
+
+    def close(self):
+        if self._transport:
+            self._transport.close()
+            self._transport = None
+
+    def connection_made(self, transport):
+        self._transport = transport
+
+    def send(self, data: bytes, addr):
+        if self._transport:
+            self._transport.sendto(self._codec.encode(data), addr)
+
+    def broadcast(self, data: bytes):
+        """Send data to every client logged in to RCon."""
+        encoded = self._codec.encode(data)
+
+        for addr, (salt, logged_in) in self.clients.items():
+            if logged_in and self._transport:
+                self._transport.sendto(encoded, addr)
+
+    # What happens on the server
+
+    def message(self, line: str):
+        """A line of the server log."""
+        self.messages += 1
+        self.broadcast(bytes([RConServerHeaders.MESSAGE]) + string(line))
+
+    def join(self, name: str, address: str = '127.0.0.1:10667', team: int = None):
+        """A player joins, in team modes on team or the next one in turn."""
+        if team is None:
+            team = len(self.players) % 2 if self.gametype in TEAM_GAMEMODES else -1
+
+        self.players[name] = ZandronumPlayer(name, ping=random.randint(10, 200), team=team)
+        self.message(f'{name} ({address}) has connected.')
+        self.broadcast(self._player_data())
+
+    def leave(self, name: str, address: str = '127.0.0.1:10667'):
+        if self.players.pop(name, None):
+            self.message(f'client {name} ({address}) disconnected.')
+            self.broadcast(self._player_data())
+
+    def change_map(self, mapname: str):
+        self.mapname = mapname
+        self.message(f'-> map {mapname}')
+        self.broadcast(bytes([RConServerHeaders.UPDATE, RConServerUpdate.MAP]) + string(mapname))
+
+    async def play(self, script: Iterable[str | Callable], rate: float) -> int:
+        """
+        Go through script at rate items per second: lines are sent as log
+        messages, callables are called.  Items are timed from the start, so
+        high rates don't depend on how precisely the event loop sleeps, and
+        it yields to the loop after every one even when it's behind, so a
+        client on the same loop gets to read them before its socket buffer
+        overflows.  Returns the number of items played.
+        """
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        played = 0
+
+        for item in script:
+            await asyncio.sleep(max(start + played / rate - loop.time(), 0))
+
+            if callable(item):
+                item()
+            else:
+                self.message(item)
+
+            played += 1
+
+        return played
+
+    # Protocol
+
+    def datagram_received(self, data, addr):
+        try:
+            data = self._codec.decode(data)
+        except (ValueError, IndexError):
+            return
+
+        if len(data) >= 4 and struct.unpack_from('<l', data)[0] == LAUNCHER_CHALLENGE:
+            self.queries += 1
+            self._answer_query(ByteReader(data), addr)
+        elif data:
+            self._handle_rcon(ByteReader(data), addr)
+
+    def _answer_query(self, res: ByteReader, addr):
+        res.read_long()
+        flags = res.read_ulong() & FAKE_INFO_FLAGS
+        sent = res.read_long()
+        response = self._launcher_response(flags, sent)
+
+        if len(response) <= self.segment_size:
+            self.send(response, addr)
+            return
+
+        for segment in segment_response(response, self.segment_size):
+            self.send(segment, addr)
+
+    def _launcher_response(self, flags: int, sent: int) -> bytes:
+        data = [struct.pack('<lL', ServerLauncherResponse.CHALLENGE, sent & 0xffffffff), string('3.2.1'), struct.pack('<L', flags)]
+
+        if flags & ServerQueryFlags.NAME:
+            data.append(string(self.name))
+        if flags & ServerQueryFlags.MAPNAME:
+            data.append(string(self.mapname))
+        if flags & ServerQueryFlags.MAXCLIENTS:
+            data.append(struct.pack('<B', self.maxclients))
+        if flags & ServerQueryFlags.MAXPLAYERS:
+            data.append(struct.pack('<B', self.maxplayers))
+        if flags & ServerQueryFlags.PWADS:
+            data.append(struct.pack('<B', len(self.pwads)))
+            data += [string(pwad) for pwad in self.pwads]
+        if flags & ServerQueryFlags.GAMETYPE:
+            data.append(struct.pack('<BBB', self.gametype, 0, 0))
+        if flags & ServerQueryFlags.IWAD:
+            data.append(string('doom2.wad'))
+        if flags & ServerQueryFlags.NUMPLAYERS:
+            data.append(struct.pack('<B', len(self.players)))
+        if flags & ServerQueryFlags.PLAYERDATA:
+            # Only team modes have a team in the records
+            teams = self.gametype in TEAM_GAMEMODES
+
+            for player in self.players.values():
+                data.append(string(player.name))
+                data.append(struct.pack('<hhBB', player.frags, player.ping, player.spectating, player.bot))
+
+                if teams:
+                    data.append(struct.pack('<B', player.team))
+
+                data.append(struct.pack('<B', player.time))
+
+        return b''.join(data)
+
+    def _player_data(self) -> bytes:
+        return bytes([RConServerHeaders.UPDATE, RConServerUpdate.PLAYERDATA, len(self.players)]) + \
+            b''.join(string(name) for name in self.players)
+
+    def _handle_rcon(self, res: ByteReader, addr):
+        header = res.read_byte()
+
+        match header:
+            case RConClientHeaders.BEGINCONNECTION:
+                protocol = res.read_byte()
+
+                if protocol != RCON_PROTOCOL_VERSION:
+                    self.send(bytes([RConServerHeaders.OLDPROTOCOL, RCON_PROTOCOL_VERSION]) + string('3.2.1'), addr)
+                    return
+
+                self.connections += 1
+                salt = ''.join(random.choice('0123456789abcdef') for i in range(32)).encode()
+                self.clients[addr] = (salt, False)
+                self.send(bytes([RConServerHeaders.SALT]) + salt, addr)
+
+            case RConClientHeaders.PASSWORD if addr in self.clients:
+                salt, logged_in = self.clients[addr]
+
+                if res.read_string() != hashlib.md5(salt + self.password.encode()).hexdigest():
+                    del self.clients[addr]
+                    self.send(bytes([RConServerHeaders.INVALIDPASSWORD]), addr)
+                    return
+
+                self.logins += 1
+                self.clients[addr] = (salt, True)
+                self.send(bytes([RConServerHeaders.LOGGEDIN, RCON_PROTOCOL_VERSION]) + string(self.name), addr)
+                self.send(self._player_data(), addr)
+                self.send(bytes([RConServerHeaders.UPDATE, RConServerUpdate.MAP]) + string(self.mapname), addr)
+
+            case RConClientHeaders.PONG:
+                self.pongs += 1
+
+            case RConClientHeaders.DISCONNECT:
+                self.clients.pop(addr, None)
+
+            case RConClientHeaders.COMMAND if self._logged_in(addr):
+                command = res.read_string()
+                self.received.append(command)
+                self.message(f'-> {command}')
+
+            case RConClientHeaders.TABCOMPLETE if self._logged_in(addr):
+                prefix = res.read_string().lower()
+                matches = [command for command in self.commands if command.lower().startswith(prefix)]
+
+                if len(matches) > FAKE_TAB_COMPLETIONS:
+                    self.send(struct.pack('<Bh', RConServerHeaders.TOOMANYTABCOMPLETES, len(matches)), addr)
+                else:
+                    self.send(bytes([RConServerHeaders.TABCOMPLETE, len(matches)]) + b''.join(string(command) for command in matches), addr)
+
+    def _logged_in(self, addr) -> bool:
+        return self.clients.get(addr, (None, False))[1]
+
+def busy_server(server: FakeZandronumServer, players: int = 64, join_rate: float = 0.05, seed: int = 666) -> Iterator[str | Callable]:
+    """
+    Script of a busy server which never ends: mostly chat, with a player
+    joining or leaving every 1 / join_rate lines.
+    """
+    rng = random.Random(seed)
+    names = [f'\x1c[{rng.choice("ABCDEFGHIJ")}]Player\x1c-{i}' for i in range(players)]
+    chat = ['gg', 'rematch on map07?', 'lol', 'where is the blue key', 'brb', 'nice shot: right through the door']
+
+    while True:
+        if rng.random() < join_rate:
+            name = rng.choice(names)
+            yield partial(server.leave if name in server.players else server.join, name)
+        elif server.players:
+            yield f'{rng.choice(list(server.players))}: {rng.choice(chat)}'
+
+def main():
+    parser = argparse.ArgumentParser(description='Run a fake Zandronum server.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=10666)
+    parser.add_argument('--password', default='secret', help='RCon password')
+    parser.add_argument('--rate', type=float, default=100, help='log lines per second')
+    parser.add_argument('--players', type=int, default=64, help='players who come and go')
+    args = parser.parse_args()
+
+    async def run():
+        server = FakeZandronumServer(args.password)
+        await server.start(args.host, args.port)
+        print(f'Fake server on {args.host}:{server.port}')
+
+        try:
+            await server.play(busy_server(server, args.players), args.rate)
+        finally:
+            server.close()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,302 @@
+"""
+Packets and log lines of a synthetic server, shared by the benchmarks and
+the tests.
+"""
+import re
+import time
+import random
+import struct
+from rconlog import ChatMessage, PlayerConnected, PlayerDisconnected, UserInfo, SystemMessage, USERINFO_KEYS
+from bytereader import ByteReader
+from zandronumserver import (
+    ZandronumGamemode, ZandronumPlayer, ZandronumTeam, ServerQueryFlags, ServerLauncherResponse, TEAM_GAMEMODES,
+)
+from fakeserver import string
+
+# Sections a launcher response carries in the fixtures, everything a
+# real server answers with when asked for 0xFFFFFFFF except for the
+# extended info.
+INFO_FLAGS = ServerQueryFlags(0xFFFFFFFF) & ~ServerQueryFlags.EXTENDED_INFO
+
+def launcher_response(players: int = 0, pwads: int = 0, teams: int = 0, seed: int = 666) -> bytes:
+    """
+    Decoded launcher response of a synthetic server with INFO_FLAGS
+    sections.  The server runs CTF when it has teams and survival
+    otherwise.
+    """
+    rng = random.Random(seed)
+    gametype = ZandronumGamemode.CTF if teams else ZandronumGamemode.SURVIVAL
+
+    data = [
+        struct.pack('<lL', ServerLauncherResponse.CHALLENGE, int(time.time())),
+        string('3.2.1'),
+        struct.pack('<L', INFO_FLAGS),
+        string('[EU] Benchmark Server | Survival | Doom 2 Megawads'),
+        string('https://example.com/wads/'),
+        string('admin@example.com'),
+        string('MAP07'),
+        struct.pack('<BB', 64, 32),
+        struct.pack('<B', pwads),
+    ]
+
+    for i in range(pwads):
+        data.append(string(f'benchmark-pwad-{i:02}-v{rng.randint(1, 9)}.{rng.randint(0, 99)}.pk3'))
+
+    data += [
+        struct.pack('<BBB', gametype, 0, 0),
+        string('DOOM 2'),
+        string('doom2.wad'),
+        struct.pack('<BBBB', 0, 0, 3, 3),
+        struct.pack('<lll', 0x04000000, 0x00020000, 0),
+        struct.pack('<hhhhhh', 0, 20, 13, 0, 0, 0),
+        struct.pack('<f', 1.0),
+        struct.pack('<hh', 0, 0),
+        struct.pack('<B', players),
+    ]
+
+    for i in range(players):
+        data.append(string(f'\x1c[{rng.choice("ABCDEFGHIJ")}]Player\x1c-{i}'))
+        data.append(struct.pack('<hhBB', rng.randint(-5, 100), rng.randint(10, 300), 0, 0))
+
+        if teams:
+            data.append(struct.pack('<B', i % teams))
+
+        data.append(struct.pack('<B', rng.randint(0, 120)))
+
+    data.append(struct.pack('<B', teams))
+    data += [string(f'Team {i}') for i in range(teams)]
+    data += [struct.pack('<L', rng.randint(0, 0xffffff)) for i in range(teams)]
+    data += [struct.pack('<h', rng.randint(0, 10)) for i in range(teams)]
+
+    data += [
+        struct.pack('<B', 0),
+        string(''),
+        string('0123456789abcdef0123456789abcdef'),
+        struct.pack('<Bllllll', 6, 0x04000000, 0x00020000, 0, 0, 0, 0),
+        struct.pack('<B', 1),
+        struct.pack('<BB', 1, 0) if pwads else struct.pack('<B', 0),
+        struct.pack('<B', 0),
+    ]
+
+    return b''.join(data)
+
+def rcon_log(count: int = 10000, seed: int = 666) -> list:
+    """
+    RCon messages of a busy evening on a server, mostly chat with players
+    coming and going and some admin work in between.
+    """
+    rng = random.Random(seed)
+    names = [f'\x1c[{rng.choice("ABCDEFGHIJ")}]Player\x1c-{i}' for i in range(64)]
+    chat = ['gg', 'rematch on map07?', 'lol', 'where is the blue key', 'brb', 'nice shot: right through the door']
+
+    def userinfo(name):
+        return [f'{key}: {name if key == "Name" else rng.randint(0, 255)}' for key in USERINFO_KEYS]
+
+    lines = []
+
+    while len(lines) < count:
+        name = rng.choice(names)
+        address = f'{rng.randint(1, 255)}.{rng.randint(0, 255)}.{rng.randint(0, 255)}.{rng.randint(0, 255)}:{rng.randint(1024, 65535)}'
+        kind = rng.random()
+
+        if kind < 0.7:
+            lines.append(f'{name}: {rng.choice(chat)}')
+        elif kind < 0.8:
+            lines.append(f'{name} ({address}) has connected.')
+            lines += userinfo(name)
+        elif kind < 0.9:
+            lines.append(f'client {name} ({address}) disconnected.')
+        elif kind < 0.95:
+            lines.append(f'-> map map{rng.randint(1, 32):02}')
+        else:
+            lines.append(f'<Server>: Admin (RCON by {name}): kick {rng.choice(names)}')
+
+    return lines[:count]
+
+# How bot.py used to classify RCon messages, one regex after the other
+LEGACY_PLAYER_MSG = re.compile(r'^(.*?)\:\s(.+)$')
+LEGACY_SYSTEM_MSG = re.compile(r'^(->|.+\(RCON by .+\))')
+LEGACY_IP = re.compile(r'\b\d{1,3}(?:\.\d{1,3}){3}(?::\d+)?\b')
+LEGACY_CONNECT = re.compile(r"^(?P<name>.+?) \([^)]*\) has connected\.$")
+LEGACY_DISCONNECT = re.compile(r"^client (?P<name>.+?) \([^)]*\) disconnected\.$")
+
+def legacy_classify(msg: str):
+    m = LEGACY_CONNECT.match(msg)
+    if m:
+        return PlayerConnected(m.group('name'))
+
+    m = LEGACY_DISCONNECT.match(msg)
+    if m:
+        return PlayerDisconnected(m.group('name'))
+
+    keys = tuple(f'{key}:' for key in USERINFO_KEYS) + ('Connect',)
+
+    if msg.strip().startswith(keys[:-1]):
+        key, value = msg.strip().split(':', 1)
+        return UserInfo(key, value.strip())
+
+    if LEGACY_IP.search(msg) or msg.strip().startswith(keys):
+        return SystemMessage(msg)
+
+    playermsg = LEGACY_PLAYER_MSG.match(msg)
+
+    if playermsg and not LEGACY_SYSTEM_MSG.match(msg):
+        return ChatMessage(*playermsg.groups())
+
+    return SystemMessage(msg)
+
+def legacy_parse_info(server, res: ByteReader) -> ServerQueryFlags:
+    """
+    How launcher responses used to be parsed, every section and record
+    right away in one if after the other.  Fixed to read what the server
+    actually sends, so it parses the same responses as parse_info().
+    """
+    send_time = res.read_ulong()
+
+    server.version = res.read_string()
+    res_flags = res.read_ulong()
+
+    if res_flags & ServerQueryFlags.NAME:
+        server.name = res.read_string()
+
+    if res_flags & ServerQueryFlags.URL:
+        server.url = res.read_string()
+
+    if res_flags & ServerQueryFlags.EMAIL:
+        server.email = res.read_string()
+
+    if res_flags & ServerQueryFlags.MAPNAME:
+        server.mapname = res.read_string()
+
+    if res_flags & ServerQueryFlags.MAXCLIENTS:
+        server.maxclients = res.read_byte()
+
+    if res_flags & ServerQueryFlags.MAXPLAYERS:
+        server.maxplayers = res.read_byte()
+
+    if res_flags & ServerQueryFlags.PWADS:
+        n = res.read_byte()
+        server.pwads = []
+
+        for i in range(n):
+            server.pwads.append(res.read_string())
+
+    if res_flags & ServerQueryFlags.GAMETYPE:
+        server.gametype = ZandronumGamemode(res.read_byte())
+        server.instagib = bool(res.read_byte())
+        server.buckshot = bool(res.read_byte())
+
+    if res_flags & ServerQueryFlags.GAMENAME:
+        server.gamename = res.read_string()
+
+    if res_flags & ServerQueryFlags.IWAD:
+        server.iwad = res.read_string()
+
+    if res_flags & ServerQueryFlags.FORCEPASSWORD:
+        server.forcepassword = bool(res.read_byte())
+
+    if res_flags & ServerQueryFlags.FORCEJOINPASSWORD:
+        server.forcejoinpassword = bool(res.read_byte())
+
+    if res_flags & ServerQueryFlags.GAMESKILL:
+        server.skill = res.read_byte()
+
+    if res_flags & ServerQueryFlags.BOTSKILL:
+        server.botskill = res.read_byte()
+
+    if res_flags & ServerQueryFlags.DMFLAGS:
+        server.dmflags = res.read_long()
+        server.dmflags2 = res.read_long()
+        server.compatflags = res.read_long()
+
+    if res_flags & ServerQueryFlags.LIMITS:
+        server.fraglimit = res.read_short()
+        server.timelimit = res.read_short()
+
+        if server.timelimit > 0:
+            server.timeleft = res.read_short()
+
+        server.duellimit = res.read_short()
+        server.pointlimit = res.read_short()
+        server.winlimit = res.read_short()
+
+    if res_flags & ServerQueryFlags.TEAMDAMAGE:
+        server.teamdamage = res.read_float()
+
+    if res_flags & ServerQueryFlags.TEAMSCORES:
+        res.read_short()
+        res.read_short()
+
+    if res_flags & ServerQueryFlags.NUMPLAYERS:
+        server.numplayers = res.read_byte()
+
+    if res_flags & ServerQueryFlags.PLAYERDATA:
+        server.players = []
+
+        for i in range(server.numplayers):
+            player = ZandronumPlayer(name=res.read_string())
+
+            player.frags = res.read_short()
+            player.ping = res.read_short()
+            player.spectating = bool(res.read_byte())
+            player.bot = bool(res.read_byte())
+
+            if server.gametype in TEAM_GAMEMODES:
+                player.team = res.read_byte()
+
+            player.time = res.read_byte()
+
+            server.players.append(player)
+
+    if res_flags & ServerQueryFlags.TEAMINFO_NUMBER:
+        server.numteams = res.read_byte()
+        server.teams = [ZandronumTeam(name='') for i in range(server.numteams)]
+
+    if res_flags & ServerQueryFlags.TEAMINFO_NAME:
+        for i in range(server.numteams):
+            server.teams[i].name = res.read_string()
+
+    if res_flags & ServerQueryFlags.TEAMINFO_COLOR:
+        for i in range(server.numteams):
+            color = res.read_ulong()
+            server.teams[i].set_color((color >> 16) & 0xff, (color >> 8) & 0xff, color & 0xff)
+
+    if res_flags & ServerQueryFlags.TEAMINFO_SCORE:
+        for i in range(server.numteams):
+            server.teams[i].score = res.read_short()
+
+    if res_flags & ServerQueryFlags.TESTING_SERVER:
+        server.testing = bool(res.read_byte())
+        res.read_string()
+
+    if res_flags & ServerQueryFlags.DATA_MD5SUM:
+        server.md5sum = res.read_string()
+
+    if res_flags & ServerQueryFlags.ALL_DMFLAGS:
+        n = res.read_byte()
+
+        for i, name in enumerate(('dmflags', 'dmflags2', 'zadmflags', 'compatflags', 'zacompatflags', 'compatflags2')):
+            if i < n:
+                setattr(server, name, res.read_long())
+
+        if n > 6:
+            res.skip((n - 6) * 4)
+
+    if res_flags & ServerQueryFlags.SECURITY_SETTINGS:
+        server.security_settings = bool(res.read_byte())
+
+    if res_flags & ServerQueryFlags.OPTIONAL_WADS:
+        n = res.read_byte()
+        server.optional_wads = []
+
+        for i in range(n):
+            server.optional_wads.append(res.read_byte())
+
+    if res_flags & ServerQueryFlags.DEH:
+        n = res.read_byte()
+        server.deh = []
+
+        for i in range(n):
+            server.deh.append(res.read_string())
+
+    return ServerQueryFlags(res_flags)
@@ -0,0 +1,247 @@
+import socket
+import asyncio
+import ipaddress
+from dataclasses import dataclass
+from collections.abc import AsyncIterable
+from typing import AsyncIterator, Iterable, Tuple
+import huffman
+from bytereader import CheckedByteReader, LONG
+from zandronumserver import (
+    ZandronumInfo, ServerQueryFlags, ServerLauncherResponse, LAUNCHER_TIMEOUT,
+    SegmentedResponse, launcher_query, check_launcher_status,
+)
+from metrics import METRICS, LAUNCHER_SECONDS, LAUNCHER_ERRORS, huffman_encode, huffman_decode
+
+# Launcher queries sent per second over the shared socket
+FLEET_RATE = 500
+
+# Seconds between two queries to the same server, Zandronum answers
+# IGNORING to addresses which query it more often than that.
+FLEET_MIN_INTERVAL = 5
+
+@dataclass
+class FleetResult:
+    address: Tuple[str, int]
+    info: ZandronumInfo = None
+    flags: ServerQueryFlags = 0
+    error: Exception = None
+    ping: float = 0.0 # in seconds
+
+class FleetProtocol(asyncio.DatagramProtocol):
+    def __init__(self, fleet):
+        self._fleet = fleet
+
+    def datagram_received(self, data, addr):
+        self._fleet._datagram_received(data, addr)
+
+class ZandronumFleet:
+    """
+    Queries many servers over a single UDP socket.  Replies are matched to
+    queries by their source address, so there is one query in flight per
+    address at a time.
+
+        fleet = ZandronumFleet()
+
+        async for result in fleet.poll([('127.0.0.1', 10666), ...]):
+            print(result.address, result.error or result.info.name)
+    """
+
+    def __init__(self, flags: ServerQueryFlags = 0xFFFFFFFF, timeout: float = LAUNCHER_TIMEOUT,
+                 rate: float = FLEET_RATE, min_interval: float = FLEET_MIN_INTERVAL):
+        self.flags = flags
+        self.timeout = timeout
+        self.rate = rate
+        self.min_interval = min_interval
+
+        # Latest info of every target ever polled
+        self.servers = {}
+
+        self._huffman = huffman.SKULLTAG_HUFFMAN
+        self._transport = None
+        self._pending = {}
+        self._segments = {}
+        self._last_query = {}
+        self._next_send = 0.0
+        self._addresses = {}
+
+    def __del__(self):
+        self.close()
+
+    async def connect(self):
+        """Open the shared socket on the running event loop."""
+        if self._transport and not self._transport.is_closing():
+            return
+
+        loop = asyncio.get_running_loop()
+        self._transport, _ = await loop.create_datagram_endpoint(
+            lambda: FleetProtocol(self),
+            local_addr=('0.0.0.0', 0),
+            family=socket.AF_INET,
+        )
+
+    def close(self):
+        if self._transport:
+            self._transport.close()
+            self._transport = None
+
+    def _datagram_received(self, data: bytes, addr):
+        future = self._pending.get(addr)
+
+        # Late reply to a query that timed out, or somebody else talking
+        if future is None or future.done():
+            return
+
+        try:
+            data = huffman_decode(self._huffman, data)
+
+            if len(data) >= 4 and LONG.unpack_from(data)[0] == ServerLauncherResponse.CHALLENGE_SEGMENTED:
+                segments = self._segments.setdefault(addr, SegmentedResponse())
+                res = CheckedByteReader(data)
+                res.skip(4)
+
+                # The reply is in once its last segment is
+                if not segments.add(res):
+                    return
+
+                data = segments.buffer
+
+            future.set_result((data, asyncio.get_running_loop().time()))
+        except (ValueError, IndexError) as e:
+            future.set_exception(ValueError(f'Malformed packet: {e}'))
+
+    async def _resolve(self, host: str, port: int) -> Tuple[str, int]:
+        """Address replies from this target will come from."""
+        target = (host, port)
+
+        if target not in self._addresses:
+            try:
+                self._addresses[target] = (str(ipaddress.IPv4Address(host)), port)
+            except ValueError:
+                loop = asyncio.get_running_loop()
+                info = await loop.getaddrinfo(host, port, family=socket.AF_INET, type=socket.SOCK_DGRAM)
+                self._addresses[target] = info[0][4][:2]
+
+        return self._addresses[target]
+
+    async def _wait_turn(self, address: Tuple[str, int]):
+        """Wait until address may be queried again and the socket is free."""
+        loop = asyncio.get_running_loop()
+
+        ready = self._last_query.get(address, -float('inf')) + self.min_interval
+
+        if ready > loop.time():
+            await asyncio.sleep(ready - loop.time())
+
+        now = loop.time()
+        slot = max(now, self._next_send)
+        self._next_send = slot + 1 / self.rate
+        self._last_query[address] = slot
+
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    async def _request(self, address: Tuple[str, int]) -> Tuple[bytes, float]:
+        """Send a query to address and wait for its reply and the time it came in."""
+        # Targets which resolve to the same address share the reply
+        future = self._pending.get(address)
+
+        if future is not None:
+            return await asyncio.shield(future)
+
+        future = self._pending[address] = asyncio.get_running_loop().create_future()
+
+        try:
+            await self._wait_turn(address)
+            self._transport.sendto(huffman_encode(self._huffman, launcher_query(self.flags)), address)
+
+            try:
+                return await asyncio.wait_for(asyncio.shield(future), self.timeout)
+            except TimeoutError:
+                LAUNCHER_ERRORS.inc('timeout')
+                error = TimeoutError('Connection timed out while waiting for response from server.')
+
+                # Fail everybody sharing the reply, and mark the error as
+                # retrieved in case nobody does.
+                future.set_exception(error)
+                future.exception()
+
+                raise error
+        finally:
+            del self._pending[address]
+            self._segments.pop(address, None)
+
+    async def _query(self, target: Tuple[str, int]) -> FleetResult:
+        result = FleetResult(target)
+
+        try:
+            address = await self._resolve(*target)
+
+            data, received = await self._request(address)
+            result.ping = received - self._last_query[address]
+
+            if METRICS.enabled:
+                LAUNCHER_SECONDS.observe(result.ping, 'fleet')
+
+            res = CheckedByteReader(data)
+            check_launcher_status(res.read_long())
+
+            info = self.servers.get(target) or ZandronumInfo()
+            result.flags = info.parse_info(res)
+            result.info = self.servers[target] = info
+        except Exception as e:
+            result.error = e
+
+        return result
+
+    async def poll(self, targets: Iterable[Tuple[str, int]] | AsyncIterable[Tuple[str, int]]) -> AsyncIterator[FleetResult]:
+        """
+        Query every (host, port) in targets and yield their results as they
+        arrive.  Failures are yielded too, with error set.  targets can be
+        an async iterable, like a master server list, in which case every
+        target is queried as soon as it comes in.
+        """
+        await self.connect()
+
+        results = asyncio.Queue()
+        tasks = {}
+
+        def start(target):
+            if target not in tasks:
+                tasks[target] = asyncio.ensure_future(self._query(target))
+                tasks[target].add_done_callback(lambda task: task.cancelled() or results.put_nowait(task.result()))
+
+        if isinstance(targets, AsyncIterable):
+            async def feed():
+                async for target in targets:
+                    start(target)
+
+            # The feeder is done once results get None from it
+            feeder = asyncio.ensure_future(feed())
+            feeder.add_done_callback(lambda task: results.put_nowait(None))
+        else:
+            feeder = None
+
+            for target in targets:
+                start(target)
+
+        finished = 0
+
+        try:
+            while feeder or finished < len(tasks):
+                result = await results.get()
+
+                if result is None:
+                    if not feeder.cancelled() and feeder.exception():
+                        raise feeder.exception()
+
+                    feeder = None
+                    continue
+
+                finished += 1
+                yield result
+        finally:
+            if feeder:
+                feeder.cancel()
+
+            for task in tasks.values():
+                task.cancel()
@@ -50,9 +50,15 @@ class HuffmanObject(object):
         self.huffman_freqs = freqs
         self.huffman_tree = []
         self.huffman_table = [None] * 256
+        self.encode_table = [None] * 256
+        self.decode_table = []
+        self.decode_bits = 0
+        self.min_code_length = 0
 
         self.__build_binary_tree()
         self.__binary_tree_to_lookup_table(self.huffman_tree)
+        self.__build_encode_table()
+        self.__build_decode_table()
 
     def __build_binary_tree(self):
         """
@@ -111,6 +117,42 @@ class HuffmanObject(object):
         else:
             self.huffman_table[branch['asc']] = binary_path
 
+    def __build_encode_table(self):
+        """
+        Create the table used to encode a message.  Each entry holds the
+        code as an integer, first bit in the lowest position, and its
+        length in bits.
+        """
+
+        for byte, code in enumerate(self.huffman_table):
+            self.encode_table[byte] = (int(code[::-1], 2), len(code))
+
+    def __build_decode_table(self):
+        """
+        Create the table used to decode a message several bits at a
+        time.  It is indexed by the next decode_bits bits of the stream
+        (first bit in the lowest position), which is enough to hold the
+        longest code, so any code is decoded with a single lookup.  Each
+        entry packs the decoded byte with the length of its code.
+        """
+
+        lengths = [len(code) for code in self.huffman_table]
+        self.decode_bits = max(lengths)
+        self.min_code_length = min(lengths)
+        self.decode_table = [0] * (1 << self.decode_bits)
+
+        for byte, code in enumerate(self.huffman_table):
+            length = len(code)
+
+            # Codes are stored least significant bit first, so every
+            # index whose low bits match the code decodes to this byte
+            # no matter what follows it.
+            index = int(code[::-1], 2)
+            entry = (byte << 5) | length
+
+            for rest in range(1 << (self.decode_bits - length)):
+                self.decode_table[index | (rest << length)] = entry
+
     def encode(self, data_string):
         """
         Encode a string into a huffman-coded string.
@@ -119,30 +161,54 @@ class HuffmanObject(object):
         if type(data_string) is not bytes:
             raise ValueError('Must pass bytes to encode')
 
-        binary_string = ''
+        table = self.encode_table
+        limit = len(data_string)
+
+        # The first byte is reserved for the number of padding bits.
+        # The message is only worth encoding if it gets shorter, so the
+        # buffer never needs to hold more than the original plus the
+        # padding byte and a partial last byte.
+        encoded = bytearray(limit + 2)
+        size = 1
+
+        # Pack codes into an accumulator and flush whole bytes
+        bits = 0
+        bit_count = 0
 
-        # Match ASCII to entries in the lookup table
         for byte in data_string:
-            binary_string += self.huffman_table[byte]
+            code, length = table[byte]
+            bits |= code << bit_count
+            bit_count += length
+
+            while bit_count >= 8:
+                if size > limit:
+                    return b'\xff' + data_string
+
+                encoded[size] = bits & 0xff
+                size += 1
 
-        # Convert binary string into ASCII
-        encoded_string = b''
-        for i in range(0, len(binary_string), 8):
-            binary = binary_string[i:i+8]
-            encoded_string += bytes([int(binary[::-1], 2)])
+                bits >>= 8
+                bit_count -= 8
+
+        # In the first byte, store the number of padding bits
+        padding_value = 0
+
+        if bit_count:
+            padding_value = 8 - bit_count
+            encoded[size] = bits
+            size += 1
 
         # If the huffman-coded string is longer than the original
         # string, return the original string instead.  Putting an
         # ASCII value 0xff where the padding bit should be signals to
         # the decoder that the message is not encoded.
-        if len(data_string) <= len(encoded_string):
+        if limit <= size - 1:
             return b'\xff' + data_string
 
-        # In the first byte, store the number of padding bits
-        padding_value = (8 - (len(binary_string) % 8)) % 8
-        encoded_string = bytes([padding_value]) + encoded_string
+        encoded[0] = padding_value
+        del encoded[size:]
 
-        return encoded_string
+        return bytes(encoded)
 
     def decode(self, data_string):
         """
@@ -155,31 +221,59 @@ class HuffmanObject(object):
         # Obtain and remove the number of padding bits stored in the
         # first byte.
         padding_length = data_string[0]
-        data_string = data_string[1:]
 
         # If the padding bit is set to 0xff the message is not encoded.
         if padding_length == 0xff:
-            return data_string
+            return data_string[1:]
 
-        # Convert ascii string into binary string
-        binary_string = ''
-        for byte in data_string:
-            binary_string += '{0:08b}'.format(byte)[::-1]
+        table = self.decode_table
+        table_bits = self.decode_bits
+        mask = (1 << table_bits) - 1
+
+        # The shortest code bounds the size of the decoded message.
+        decoded = bytearray(((len(data_string) - 1) * 8) // self.min_code_length)
+        size = 0
+
+        # Feed bytes into an accumulator and decode whole codes as long
+        # as a full table index is available.
+        bits = 0
+        bit_count = 0
+
+        for byte in memoryview(data_string)[1:]:
+            bits |= byte << bit_count
+            bit_count += 8
+
+            while bit_count >= table_bits:
+                entry = table[bits & mask]
+                length = entry & 0x1f
+
+                decoded[size] = entry >> 5
+                size += 1
+
+                bits >>= length
+                bit_count -= length
+
+        # Drain what is left, leaving out the padding bits at the end.
+        bit_count -= padding_length
+
+        while bit_count > 0:
+            entry = table[bits & mask]
+            length = entry & 0x1f
+
+            if length > bit_count:
+                raise ValueError('Huffman-coded string is truncated')
 
-        # Remove padding bits from the end
-        binary_string = binary_string[:len(binary_string) - padding_length]
+            decoded[size] = entry >> 5
+            size += 1
 
-        # Match binary to entries in the huffman tree
-        decoded_string = b''
-        tree_node = self.huffman_tree
+            bits >>= length
+            bit_count -= length
 
-        for bit in binary_string:
-            if bit in tree_node:
-                tree_node = tree_node[bit]
-            else:
-                decoded_string += bytes([tree_node['asc']])
-                tree_node = self.huffman_tree[bit]
+        del decoded[size:]
 
-        decoded_string += bytes([tree_node['asc']])
+        return bytes(decoded)
 
-        return decoded_string
\ No newline at end of file
+# Codec shared by everything talking to Zandronum.  Building the tree and
+# the lookup tables is the expensive part, so it happens once on import
+# instead of once per server.
+SKULLTAG_HUFFMAN = HuffmanObject(SKULLTAG_FREQS)
@@ -0,0 +1,264 @@
+"""
+Leaderboards kept in a local SQLite database.
+
+Frags come from the RCon log, score and time played from launcher
+snapshots.  Recording only adds to counters in memory, a background task
+writes them in one transaction every LEADERBOARD_FLUSH seconds on a
+thread of its own, so nothing on the event loop waits for the disk.
+Totals per map, per week and of all time are kept up to date with every
+write, a leaderboard is just an indexed read of the top rows.
+
+    leaderboard = Leaderboard('leaderboard.db')
+    leaderboard.start()
+    leaderboard.record_frag('Killer', 'Victim', 'MAP01')
+    await leaderboard.top(by='frags', week=week_of(time.time()))
+"""
+import time
+import sqlite3
+import asyncio
+import datetime
+from functools import lru_cache
+from dataclasses import dataclass
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+from rconlog import LogRule, clean_nick
+from serverstate import ServerSnapshot
+
+LEADERBOARD_DB = 'leaderboard.db'
+
+# Seconds between two writes to the database
+LEADERBOARD_FLUSH = 10
+
+# Period of the all time totals, the weekly ones are ISO weeks like 2026-W42
+ALL_TIME = 'all'
+
+EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+
+# Columns a leaderboard can be ordered by
+LEADERBOARD_COLUMNS = ('frags', 'deaths', 'score', 'minutes')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS frags (
+    time INTEGER NOT NULL,
+    map TEXT NOT NULL,
+    killer TEXT,
+    victim TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS frags_time ON frags (time);
+
+-- Totals of every player per period and map, '' is every map
+CREATE TABLE IF NOT EXISTS scores (
+    period TEXT NOT NULL,
+    map TEXT NOT NULL,
+    player TEXT NOT NULL,
+    frags INTEGER NOT NULL DEFAULT 0,
+    deaths INTEGER NOT NULL DEFAULT 0,
+    score INTEGER NOT NULL DEFAULT 0,
+    minutes INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (period, map, player)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS scores_frags ON scores (period, map, frags DESC);
+CREATE INDEX IF NOT EXISTS scores_deaths ON scores (period, map, deaths DESC);
+CREATE INDEX IF NOT EXISTS scores_score ON scores (period, map, score DESC);
+CREATE INDEX IF NOT EXISTS scores_minutes ON scores (period, map, minutes DESC);
+'''
+
+UPSERT = '''
+INSERT INTO scores (period, map, player, frags, deaths, score, minutes) VALUES (?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (period, map, player) DO UPDATE SET
+    frags = frags + excluded.frags,
+    deaths = deaths + excluded.deaths,
+    score = score + excluded.score,
+    minutes = minutes + excluded.minutes
+'''
+
+@dataclass(frozen=True)
+class Frag:
+    victim: str
+    killer: str = None # None if they killed themselves
+
+@dataclass
+class LeaderboardRow:
+    player: str
+    frags: int
+    deaths: int
+    score: int
+    minutes: int
+
+# Obituaries in the RCon log, for LogClassifier.add_rule()
+FRAG_RULES = (
+    LogRule('frag', r"(.+?) (?:was|got) .+? by (.+?)(?:'s? .+)?[.!]$", Frag),
+    LogRule('suicide', r'(.+?) (?:suicides|mutated|died|melted|burned|fell too far|killed (?:him|her|it)self)[.!]$', Frag),
+)
+
+def week_of(when: float) -> str:
+    """ISO week of a timestamp, like 2026-W42."""
+    return _week_of_day(int(when // 86400))
+
+# Weeks start at midnight UTC, so the day decides the week
+@lru_cache(maxsize=64)
+def _week_of_day(day: int) -> str:
+    year, week, weekday = datetime.date.fromordinal(EPOCH_ORDINAL + day).isocalendar()
+    return f'{year}-W{week:02}'
+
+class Leaderboard:
+    def __init__(self, path: str = LEADERBOARD_DB, flush_interval: float = LEADERBOARD_FLUSH):
+        self.path = path
+        self.flush_interval = flush_interval
+
+        # Waiting to be written: raw frags and what to add to the totals
+        self._frags = []
+        self._deltas = defaultdict(lambda: [0, 0, 0, 0])
+
+        # Map and last launcher data of every player, to count what changed since
+        self._seen = {}
+
+        # The connection only ever lives on this one thread
+        self._executor = ThreadPoolExecutor(1, thread_name_prefix='leaderboard')
+        self._db = None
+        self._task = None
+
+    def pending(self) -> int:
+        return len(self._frags) + len(self._deltas)
+
+    def _add(self, week: str, mapname: str, player: str, column: int, amount: int):
+        for key in ((ALL_TIME, '', player), (ALL_TIME, mapname, player), (week, '', player), (week, mapname, player)):
+            self._deltas[key][column] += amount
+
+    def record_frag(self, killer: str, victim: str, mapname: str, when: float = None):
+        """Record a kill, with killer None or the victim for a suicide."""
+        when = time.time() if when is None else when
+        victim = clean_nick(victim)
+        killer = clean_nick(killer) if killer else None
+
+        if killer == victim:
+            killer = None
+
+        week = week_of(when)
+        mapname = mapname.upper()
+
+        self._frags.append((int(when), mapname, killer, victim))
+        self._add(week, mapname, victim, 1, 1)
+
+        if killer:
+            self._add(week, mapname, killer, 0, 1)
+
+    def record_snapshot(self, snapshot: ServerSnapshot, when: float = None):
+        """Add what every player scored and played since the last snapshot."""
+        week = week_of(time.time() if when is None else when)
+        mapname = snapshot.mapname.upper()
+        seen = {}
+
+        for player in snapshot.players:
+            if player.bot:
+                continue
+
+            name = clean_nick(player.name)
+            before_map, before = self._seen.get(name, (None, None))
+
+            # Only launcher data has scores, players without it, like from
+            # RCon, keep what was known of them.
+            if player.frags is None:
+                if before is not None:
+                    seen[name] = (before_map, before)
+
+                continue
+
+            seen[name] = (snapshot.mapname, player)
+
+            if before is None:
+                continue
+
+            # Scores start over with every map
+            score = player.frags - (before.frags if snapshot.mapname == before_map else 0)
+
+            if score > 0:
+                self._add(week, mapname, name, 2, score)
+
+            if player.time > before.time:
+                self._add(week, mapname, name, 3, player.time - before.time)
+
+        self._seen = seen
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._db is None:
+            self._db = sqlite3.connect(self.path)
+            self._db.execute('PRAGMA journal_mode = WAL')
+            self._db.execute('PRAGMA synchronous = NORMAL')
+            self._db.executescript(SCHEMA)
+
+        return self._db
+
+    def _write(self, frags: list, deltas: dict):
+        db = self._connect()
+
+        with db:
+            db.executemany('INSERT INTO frags VALUES (?, ?, ?, ?)', frags)
+            db.executemany(UPSERT, (key + tuple(delta) for key, delta in deltas.items()))
+
+    def _read(self, by: str, period: str, mapname: str, limit: int) -> List[LeaderboardRow]:
+        rows = self._connect().execute(
+            f'SELECT player, frags, deaths, score, minutes FROM scores '
+            f'WHERE period = ? AND map = ? ORDER BY {by} DESC LIMIT ?',
+            (period, mapname, limit),
+        )
+
+        return [LeaderboardRow(*row) for row in rows]
+
+    async def _run_db(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    async def flush(self):
+        """Write everything recorded so far."""
+        if not self._frags and not self._deltas:
+            return
+
+        frags, self._frags = self._frags, []
+        deltas, self._deltas = self._deltas, defaultdict(lambda: [0, 0, 0, 0])
+
+        await self._run_db(self._write, frags, deltas)
+
+    async def top(self, by: str = 'frags', week: str = None, mapname: str = '', limit: int = 10) -> List[LeaderboardRow]:
+        """
+        Best players by a column of all time, or of week.  Whatever wasn't
+        flushed yet doesn't count.
+        """
+        if by not in LEADERBOARD_COLUMNS:
+            raise ValueError(f'Leaderboard can\'t be ordered by {by}')
+
+        return await self._run_db(self._read, by, week or ALL_TIME, mapname.upper(), limit)
+
+    def start(self):
+        """Flush in the background on the running event loop."""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f'Failed to write leaderboard: {e}')
+
+    async def close(self):
+        """Stop flushing in the background, write what's left and close the database."""
+        if self._task:
+            self._task.cancel()
+
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+            self._task = None
+
+        await self.flush()
+
+        if self._db is not None:
+            await self._run_db(self._db.close)
+            self._db = None
+
+        self._executor.shutdown()
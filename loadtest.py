@@ -0,0 +1,215 @@
+"""
+Load test of the chat bridge, from the fake server's log to a stub of
+Discord's webhook endpoint, through the same ZandronumServer, classifier
+and WebhookSink as the bot:
+
+    python loadtest.py --rate 2000 --lines 20000
+
+Every chat line carries a sequence number, so the stub knows how long
+each one took and which never arrived.
+"""
+import os
+import re
+import time
+import random
+import asyncio
+import argparse
+import contextlib
+from dataclasses import dataclass, field
+from functools import partial
+from aiohttp import web
+from fakeserver import FakeZandronumServer
+from rconlog import LogClassifier
+from webhook import WebhookSink, bridge_event
+from zandronumserver import ZandronumServer, RConState
+
+# Sequence number at the end of every chat line of a load test
+SEQUENCE = re.compile(r' #(\d+)$', re.MULTILINE)
+
+@dataclass
+class LoadTestResult:
+    lines: int = 0 # chat lines the server sent
+    received: int = 0 # of them which made it to the stub
+    dropped: int = 0 # by the webhook queue
+    unsent: int = 0 # still queued when the test gave up waiting
+    requests: int = 0 # to the stub
+    rate_limited: int = 0 # 429s the stub answered with
+    seconds: float = 0.0
+    latencies: list = field(default_factory=list, repr=False) # seconds, of every received line
+
+    @property
+    def drop_rate(self) -> float:
+        return 1 - self.received / self.lines if self.lines else 0.0
+
+    def percentile(self, percent: float) -> float:
+        """Latency percent of the received lines took at most, they're sorted."""
+        if not self.latencies:
+            return 0.0
+
+        return self.latencies[min(len(self.latencies) - 1, int(len(self.latencies) * percent / 100))]
+
+class StubDiscord:
+    """
+    Webhook endpoint which accepts limit requests per window seconds,
+    with Discord's rate limit headers, and remembers when every line
+    came in.
+    """
+
+    def __init__(self, limit: int = 5, window: float = 2.0):
+        self.limit = limit
+        self.window = window
+        self.url = None
+        self.arrivals = {} # time.monotonic() by sequence number
+        self.requests = 0
+        self.rate_limited = 0
+
+        self._window_start = 0.0
+        self._count = 0
+        self._runner = None
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post('/webhook', self._handle)
+
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, '127.0.0.1', 0).start()
+
+        host, port = self._runner.addresses[0][:2]
+        self.url = f'http://{host}:{port}/webhook'
+
+    async def close(self):
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def _handle(self, request):
+        now = time.monotonic()
+        self.requests += 1
+
+        if now - self._window_start >= self.window:
+            self._window_start = now
+            self._count = 0
+
+        reset_after = self._window_start + self.window - now
+
+        if self._count >= self.limit:
+            self.rate_limited += 1
+            return web.json_response({'retry_after': reset_after}, status=429)
+
+        self._count += 1
+        payload = await request.json()
+
+        for sequence in SEQUENCE.findall(payload.get('content', '')):
+            self.arrivals.setdefault(int(sequence), now)
+
+        return web.Response(status=204, headers={
+            'X-RateLimit-Remaining': str(self.limit - self._count),
+            'X-RateLimit-Reset-After': f'{reset_after:.3f}',
+        })
+
+async def run_load_test(lines: int = 10000, rate: float = 2000, players: int = 64, join_rate: float = 0.01,
+                        limit: int = 5, drain: float = 10, seed: int = 666) -> LoadTestResult:
+    """
+    Send lines chat lines at rate per second, with players joining and
+    leaving now and then, and wait up to drain seconds for the bridge to
+    send what's left.
+    """
+    rng = random.Random(seed)
+    stub = StubDiscord(limit)
+    fake = FakeZandronumServer()
+    server = None
+    classifier = LogClassifier()
+    sink = None
+
+    # time.monotonic() every chat line was sent at
+    sent = []
+
+    def chat(name: str):
+        fake.message(f'{name}: load test #{len(sent)}')
+        sent.append(time.monotonic())
+
+    def script():
+        names = [f'\x1c[J1]Player\x1c-{i}' for i in range(players)]
+
+        for name in names[:players // 2]:
+            fake.join(name)
+
+        while len(sent) < lines:
+            name = rng.choice(names)
+
+            if rng.random() < join_rate:
+                yield partial(fake.leave if name in fake.players else fake.join, name)
+            else:
+                yield partial(chat, rng.choice(list(fake.players) or names))
+
+    def on_message(msg: str):
+        bridge_event(sink, classifier.classify(msg))
+
+    await stub.start()
+    await fake.start()
+
+    try:
+        sink = WebhookSink(stub.url)
+        sink.start()
+
+        server = ZandronumServer('127.0.0.1', fake.port)
+        server.add_listener('message', on_message)
+        server.start_rcon(fake.password)
+
+        while server.rcon_state != RConState.LOGGED_IN:
+            await asyncio.sleep(0.01)
+
+        start = time.monotonic()
+        await fake.play(script(), rate)
+
+        # Whatever is still on its way over UDP, then the webhook queue
+        await asyncio.sleep(0.5)
+        await sink.close(drain)
+        seconds = time.monotonic() - start
+
+        result = LoadTestResult(
+            lines=len(sent),
+            received=len(stub.arrivals),
+            dropped=sink.stats.dropped,
+            unsent=sink.depth(),
+            requests=stub.requests,
+            rate_limited=stub.rate_limited,
+            seconds=seconds,
+            latencies=sorted(stub.arrivals[i] - sent[i] for i in stub.arrivals if i < len(sent)),
+        )
+    finally:
+        if sink:
+            await sink.close(0)
+
+        if server:
+            await server.stop_rcon()
+            server.close()
+
+        fake.close()
+        await stub.close()
+
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the chat bridge against a fake server and a stub Discord.')
+    parser.add_argument('--lines', type=int, default=10000, help='chat lines to send')
+    parser.add_argument('--rate', type=float, default=2000, help='lines per second')
+    parser.add_argument('--players', type=int, default=64)
+    parser.add_argument('--join-rate', type=float, default=0.01, help='share of lines which are joins or leaves')
+    parser.add_argument('--limit', type=int, default=5, help='webhook requests the stub accepts every 2 seconds')
+    parser.add_argument('--drain', type=float, default=10, help='seconds to wait for the bridge to catch up at the end')
+    args = parser.parse_args()
+
+    # The bridge logs every packet with print, which is part of what's measured
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        result = asyncio.run(run_load_test(args.lines, args.rate, args.players, args.join_rate, args.limit, args.drain))
+
+    print(f'{result.lines} lines in {result.seconds:.2f} s, {result.received} received, '
+          f'{result.dropped} dropped by the queue, {result.unsent} unsent, drop rate {result.drop_rate:.2%}')
+    print(f'{result.requests} webhook requests, {result.rate_limited} rate limited')
+    print(f'latency p50 {result.percentile(50) * 1000:.0f} ms, p95 {result.percentile(95) * 1000:.0f} ms, '
+          f'p99 {result.percentile(99) * 1000:.0f} ms, max {max(result.latencies, default=0) * 1000:.0f} ms')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+import socket
+import struct
+import asyncio
+from enum import IntEnum
+from typing import AsyncIterator, List, Tuple
+import huffman
+from bytereader import ByteReader, CheckedByteReader
+from fleet import ZandronumFleet, FleetResult
+from zandronumserver import ServerQueryFlags
+from metrics import huffman_encode, huffman_decode
+
+MASTER_HOSTNAME = 'master.zandronum.com'
+MASTER_PORT = 15300
+
+# Seconds to wait for the next part of the server list
+MASTER_TIMEOUT = 5
+
+# https://wiki.zandronum.com/Master_server_protocol
+LAUNCHER_MASTER_CHALLENGE = 5660028
+MASTER_SERVER_VERSION = 2
+
+class MasterServerResponse(IntEnum):
+    ENDSERVERLIST       = 2
+    IPISBANNED          = 3
+    REQUESTIGNORED      = 4
+    WRONGVERSION        = 5
+    BEGINSERVERLISTPART = 6
+    ENDSERVERLISTPART   = 7
+    SERVERBLOCK         = 8
+
+def parse_server_list_part(res: ByteReader) -> Tuple[int, bool, List[Tuple[str, int]]]:
+    """
+    Parse one part of the server list.  Returns its number, whether it's
+    the last one and the addresses in it.
+    """
+    status = res.read_long()
+
+    if status == MasterServerResponse.IPISBANNED:
+        raise ConnectionRefusedError('Master server banned you.')
+
+    if status == MasterServerResponse.REQUESTIGNORED:
+        raise ConnectionRefusedError('Master server ignoring you.')
+
+    if status == MasterServerResponse.WRONGVERSION:
+        raise ConnectionRefusedError(f'Master server protocol version ({MASTER_SERVER_VERSION}) is not supported!')
+
+    if status != MasterServerResponse.BEGINSERVERLISTPART:
+        raise ValueError(f'Unexpected master server response {status}')
+
+    number = res.read_byte()
+    addresses = []
+
+    while True:
+        block = res.read_byte()
+
+        if block != MasterServerResponse.SERVERBLOCK:
+            return number, block == MasterServerResponse.ENDSERVERLIST, addresses
+
+        # Every server of a host shares one block
+        while n := res.read_byte():
+            host = socket.inet_ntoa(res.read_bytes(4))
+
+            for i in range(n):
+                addresses.append((host, res.read_ushort()))
+
+class MasterProtocol(asyncio.DatagramProtocol):
+    def __init__(self):
+        self.packets = asyncio.Queue()
+
+    def datagram_received(self, data, addr):
+        self.packets.put_nowait(data)
+
+    def error_received(self, exc):
+        self.packets.put_nowait(ConnectionError(f'Could not receive data from master server. Error: {exc}'))
+
+class ZandronumMaster:
+    """
+    Client for the master server, which lists every public server.
+
+        master = ZandronumMaster()
+
+        async for result in master.crawl():
+            print(result.address, result.error or result.info.name)
+    """
+
+    def __init__(self, hostname: str = MASTER_HOSTNAME, port: int = MASTER_PORT, timeout: float = MASTER_TIMEOUT):
+        self._hostname = hostname
+        self._port = port
+        self.timeout = timeout
+        self._huffman = huffman.SKULLTAG_HUFFMAN
+
+    async def servers(self) -> AsyncIterator[Tuple[str, int]]:
+        """
+        Ask for the server list and yield every address once, as soon as
+        the part with it arrives.  Parts can come in any order.
+        """
+        loop = asyncio.get_running_loop()
+        transport, protocol = await loop.create_datagram_endpoint(
+            MasterProtocol,
+            remote_addr=(self._hostname, self._port),
+            family=socket.AF_INET,
+        )
+
+        try:
+            transport.sendto(huffman_encode(self._huffman, struct.pack('<lh', LAUNCHER_MASTER_CHALLENGE, MASTER_SERVER_VERSION)))
+
+            seen = set()
+            parts = set()
+            total = None
+
+            while total is None or len(parts) < total:
+                try:
+                    packet = await asyncio.wait_for(protocol.packets.get(), self.timeout)
+                except TimeoutError:
+                    raise TimeoutError('Connection timed out while waiting for server list from master server.')
+
+                if isinstance(packet, Exception):
+                    raise packet
+
+                number, last, addresses = parse_server_list_part(CheckedByteReader(huffman_decode(self._huffman, packet)))
+
+                # A part sent twice would list its servers twice
+                if number in parts:
+                    continue
+
+                parts.add(number)
+
+                if last:
+                    total = number + 1
+
+                for address in addresses:
+                    if address not in seen:
+                        seen.add(address)
+                        yield address
+        finally:
+            transport.close()
+
+    async def get_servers(self) -> List[Tuple[str, int]]:
+        return [address async for address in self.servers()]
+
+    async def crawl(self, fleet: ZandronumFleet = None, flags: ServerQueryFlags = 0xFFFFFFFF) -> AsyncIterator[FleetResult]:
+        """
+        Query every server on the list, starting with the first part while
+        the rest of the list is still coming in.
+        """
+        own_fleet = fleet is None
+
+        if own_fleet:
+            fleet = ZandronumFleet(flags)
+
+        try:
+            async for result in fleet.poll(self.servers()):
+                yield result
+        finally:
+            if own_fleet:
+                fleet.close()
@@ -0,0 +1,239 @@
+"""
+Counters and histograms of what the bot is doing, served over HTTP in
+the Prometheus text format.  Nothing is recorded until METRICS.enabled
+is set, hot paths check it before they even read the clock, so it costs
+one attribute lookup when disabled.
+
+    METRICS.enabled = True
+    server = MetricsServer()
+    await server.start()
+
+    if METRICS.enabled:
+        start = time.perf_counter()
+        ...
+        LAUNCHER_SECONDS.observe(time.perf_counter() - start)
+"""
+import time
+import bisect
+from typing import Callable, Tuple
+
+METRICS_HOST = '127.0.0.1'
+METRICS_PORT = 9108
+
+# Upper bounds of histogram buckets, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+HUFFMAN_BUCKETS = (1e-6, 2.5e-6, 5e-6, 1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 1e-3)
+
+def _labels(names: tuple, values: tuple, extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+
+    if extra:
+        pairs.append(extra)
+
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _number(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metric:
+    type = 'untyped'
+
+    def __init__(self, registry: 'MetricsRegistry', name: str, help: str, labels: Tuple[str, ...] = ()):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.labels = labels
+
+    def render(self) -> list:
+        return [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type}'] + self.samples()
+
+    def samples(self) -> list:
+        raise NotImplementedError
+
+class Counter(Metric):
+    type = 'counter'
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self._values = {}
+
+    def inc(self, *labels, amount: float = 1):
+        if self.registry.enabled:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels) -> float:
+        return self._values.get(labels, 0)
+
+    def samples(self) -> list:
+        return [f'{self.name}{_labels(self.labels, key)} {_number(value)}' for key, value in self._values.items()]
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, *args, buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(*args)
+        self.buckets = tuple(buckets)
+
+        # Per labels: count in every bucket, the last one above all bounds, and the sum
+        self._values = {}
+
+    def observe(self, value: float, *labels):
+        if not self.registry.enabled:
+            return
+
+        entry = self._values.get(labels)
+
+        if entry is None:
+            entry = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+
+    def count(self, *labels) -> int:
+        entry = self._values.get(labels)
+        return sum(entry[0]) if entry else 0
+
+    def samples(self) -> list:
+        lines = []
+
+        for key, (counts, total) in self._values.items():
+            cumulative = 0
+
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = 'le="' + _number(bound) + '"'
+                lines.append(f'{self.name}_bucket{_labels(self.labels, key, le)} {cumulative}')
+
+            lines.append(f'{self.name}_sum{_labels(self.labels, key)} {_number(total)}')
+            lines.append(f'{self.name}_count{_labels(self.labels, key)} {cumulative}')
+
+        return lines
+
+class Collected(Metric):
+    """
+    Read from func when scraped, for what is counted anyway, like queue
+    depths or stats objects.  func returns the value, or a dict of values
+    by their tuple of labels.
+    """
+
+    def __init__(self, *args, func: Callable = None, type: str = 'gauge'):
+        super().__init__(*args)
+        self.func = func
+        self.type = type
+
+    def samples(self) -> list:
+        try:
+            values = self.func()
+        except Exception as e:
+            print(f'Failed to collect metric {self.name}: {e}')
+            return []
+
+        if not isinstance(values, dict):
+            values = {(): values}
+
+        return [f'{self.name}{_labels(self.labels, key)} {_number(value)}' for key, value in values.items()]
+
+class MetricsRegistry:
+    def __init__(self):
+        self.enabled = False
+        self._metrics = {}
+
+    def _add(self, metric: Metric) -> Metric:
+        if metric.name in self._metrics:
+            raise ValueError(f'Metric {metric.name} already exists')
+
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labels: Tuple[str, ...] = ()) -> Counter:
+        return self._add(Counter(self, name, help, labels))
+
+    def histogram(self, name: str, help: str, labels: Tuple[str, ...] = (), buckets: tuple = LATENCY_BUCKETS) -> Histogram:
+        return self._add(Histogram(self, name, help, labels, buckets=buckets))
+
+    def collect(self, name: str, help: str, func: Callable, labels: Tuple[str, ...] = (), type: str = 'gauge') -> Collected:
+        return self._add(Collected(self, name, help, labels, func=func, type=type))
+
+    def remove(self, name: str):
+        self._metrics.pop(name, None)
+
+    def render(self) -> str:
+        lines = []
+
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+
+        return '\n'.join(lines) + '\n'
+
+METRICS = MetricsRegistry()
+
+HUFFMAN_SECONDS = METRICS.histogram(
+    'doomer_huffman_seconds', 'Time spent Huffman coding a packet.', ('op',), HUFFMAN_BUCKETS)
+RCON_PACKETS = METRICS.counter(
+    'doomer_rcon_packets_total', 'RCon packets received from the server, by header.', ('header',))
+LAUNCHER_SECONDS = METRICS.histogram(
+    'doomer_launcher_query_seconds', 'Round trip of a launcher query, until its last segment came in.', ('source',))
+LAUNCHER_ERRORS = METRICS.counter(
+    'doomer_launcher_errors_total', 'Launcher queries which failed, by reason.', ('reason',))
+WEBHOOK_SECONDS = METRICS.histogram(
+    'doomer_webhook_send_seconds', 'Time a webhook message took to send, rate limits included.')
+
+def huffman_encode(coder, data: bytes) -> bytes:
+    if not METRICS.enabled:
+        return coder.encode(data)
+
+    start = time.perf_counter()
+    encoded = coder.encode(data)
+    HUFFMAN_SECONDS.observe(time.perf_counter() - start, 'encode')
+    return encoded
+
+def huffman_decode(coder, data: bytes) -> bytes:
+    if not METRICS.enabled:
+        return coder.decode(data)
+
+    start = time.perf_counter()
+    decoded = coder.decode(data)
+    HUFFMAN_SECONDS.observe(time.perf_counter() - start, 'decode')
+    return decoded
+
+class MetricsServer:
+    """Serves a registry at /metrics on a local port."""
+
+    def __init__(self, registry: MetricsRegistry = METRICS, host: str = METRICS_HOST, port: int = METRICS_PORT):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self._runner = None
+
+    async def _handle(self, request):
+        from aiohttp import web
+        return web.Response(text=self.registry.render(), content_type='text/plain', charset='utf-8')
+
+    async def start(self):
+        # Only imported here, so modules recording metrics load without aiohttp
+        from aiohttp import web
+
+        if self._runner is not None:
+            return
+
+        app = web.Application()
+        app.router.add_get('/metrics', self._handle)
+
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+
+        await web.TCPSite(self._runner, self.host, self.port).start()
+
+        # Port 0 picks a free one
+        self.port = self._runner.addresses[0][1]
+
+    async def close(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
@@ -0,0 +1,178 @@
+"""
+History of the players seen on a server, looked up by their nickname
+without color codes and in any case.  Every player keeps the last
+PLAYER_HISTORY samples of their ping, frags and team in fixed size
+arrays, and the start and end of their last session, so memory stays
+bounded no matter how long the bot runs.
+
+    sessions = PlayerSessions()
+    sessions.update(server.snapshot)
+    sessions.get('player').samples()
+    sessions.search('pla')
+"""
+import time
+import bisect
+from array import array
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import List
+from rconlog import clean_nick
+from serverstate import ServerSnapshot
+
+# Samples kept of every player, at one per poll that's about 10 minutes
+PLAYER_HISTORY = 120
+
+# Players kept per server, the ones who left the longest ago go first
+PLAYER_INDEX_SIZE = 1000
+
+def player_key(name: str) -> str:
+    return clean_nick(name).casefold()
+
+@dataclass(frozen=True)
+class PlayerSample:
+    time: int
+    ping: int
+    frags: int
+    team: int
+
+class SampleRing:
+    """The last size samples, oldest overwritten first."""
+
+    __slots__ = ('size', 'times', 'pings', 'frags', 'teams', '_next', '_count')
+
+    def __init__(self, size: int = PLAYER_HISTORY):
+        self.size = size
+        self.times = array('q', bytes(8 * size))
+        self.pings = array('h', bytes(2 * size))
+        self.frags = array('h', bytes(2 * size))
+        self.teams = array('h', bytes(2 * size))
+        self._next = 0
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def append(self, when: int, ping: int, frags: int, team: int):
+        i = self._next
+        self.times[i] = when
+        self.pings[i] = ping
+        self.frags[i] = frags
+        self.teams[i] = team
+        self._next = (i + 1) % self.size
+        self._count = min(self._count + 1, self.size)
+
+    def samples(self) -> List[PlayerSample]:
+        """Samples from oldest to newest."""
+        start = (self._next - self._count) % self.size
+
+        return [
+            PlayerSample(self.times[i], self.pings[i], self.frags[i], self.teams[i])
+            for i in ((start + j) % self.size for j in range(self._count))
+        ]
+
+    def last(self) -> PlayerSample:
+        if not self._count:
+            return None
+
+        i = (self._next - 1) % self.size
+        return PlayerSample(self.times[i], self.pings[i], self.frags[i], self.teams[i])
+
+class PlayerHistory:
+    __slots__ = ('name', 'started', 'ended', 'history')
+
+    def __init__(self, name: str, started: float, size: int = PLAYER_HISTORY):
+        self.name = name # as last seen, with color codes
+        self.started = started
+        self.ended = None # None while they are on the server
+        self.history = SampleRing(size)
+
+    @property
+    def online(self) -> bool:
+        return self.ended is None
+
+    def duration(self, now: float = None) -> float:
+        """Seconds of the current or last session."""
+        end = self.ended if self.ended is not None else time.time() if now is None else now
+        return end - self.started
+
+    def samples(self) -> List[PlayerSample]:
+        return self.history.samples()
+
+class PlayerSessions:
+    def __init__(self, size: int = PLAYER_INDEX_SIZE, history: int = PLAYER_HISTORY):
+        self.size = size
+        self.history = history
+
+        # Oldest seen first, so the next to evict is at the front
+        self._players = OrderedDict()
+        self._online = set()
+
+        # Keys in order, for prefix search
+        self._keys = []
+
+    def __len__(self):
+        return len(self._players)
+
+    def get(self, name: str) -> PlayerHistory:
+        return self._players.get(player_key(name))
+
+    def search(self, prefix: str, limit: int = 25) -> List[PlayerHistory]:
+        """Up to limit players whose name starts with prefix, in alphabetical order."""
+        prefix = player_key(prefix)
+        start = bisect.bisect_left(self._keys, prefix)
+        found = []
+
+        for key in self._keys[start:start + limit]:
+            if not key.startswith(prefix):
+                break
+
+            found.append(self._players[key])
+
+        return found
+
+    def online(self) -> List[PlayerHistory]:
+        return [self._players[key] for key in self._online]
+
+    def update(self, snapshot: ServerSnapshot, when: float = None):
+        """Start and end sessions and take a sample of every player in snapshot."""
+        when = time.time() if when is None else when
+        seen = set()
+
+        for player in snapshot.players:
+            key = player_key(player.name)
+            entry = self._players.get(key)
+
+            if entry is None:
+                entry = self._add(key, player.name, when)
+            elif key not in self._online:
+                entry.started = when
+                entry.ended = None
+
+            entry.name = player.name
+            self._players.move_to_end(key)
+            seen.add(key)
+
+            # RCon only knows names
+            if player.frags is not None:
+                entry.history.append(int(when), player.ping, player.frags, player.team)
+
+        for key in self._online - seen:
+            self._players[key].ended = when
+
+        self._online = seen
+        self._evict()
+
+    def _add(self, key: str, name: str, when: float) -> PlayerHistory:
+        entry = self._players[key] = PlayerHistory(name, when, self.history)
+        bisect.insort(self._keys, key)
+        return entry
+
+    def _evict(self):
+        while len(self._players) > self.size:
+            key = next(iter(self._players))
+
+            if key in self._online:
+                break
+
+            del self._players[key]
+            del self._keys[bisect.bisect_left(self._keys, key)]
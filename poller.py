@@ -0,0 +1,84 @@
+import time
+from dataclasses import dataclass
+from zandronumserver import ZandronumServer, ServerQueryFlags
+
+# Seconds between two checks for due tiers
+POLL_TICK = 5
+
+# Intervals are this many times longer while nobody is playing
+IDLE_FACTOR = 6
+
+# Seconds since the last RCon packet during which RCon counts as flowing
+RCON_QUIET = 30
+
+@dataclass(frozen=True)
+class PollTier:
+    flags: ServerQueryFlags
+    interval: float # in seconds, while somebody is playing
+    rcon: bool = False # paused while RCon updates are flowing
+
+# Cheap sections change during a match, the expensive ones hardly ever.
+# RCon pushes the player count and the map on its own, so the cheap tier
+# rests while it does.
+POLL_TIERS = (
+    PollTier(ServerQueryFlags.NUMPLAYERS | ServerQueryFlags.MAPNAME | ServerQueryFlags.LIMITS, 15, rcon=True),
+    PollTier(
+        ServerQueryFlags.PLAYERDATA | ServerQueryFlags.PWADS | ServerQueryFlags.ALL_DMFLAGS |
+        ServerQueryFlags.NAME | ServerQueryFlags.GAMETYPE | ServerQueryFlags.IWAD | ServerQueryFlags.MAXPLAYERS,
+        120,
+    ),
+)
+
+class InfoPoller:
+    """
+    Keeps a server's info fresh with as few launcher queries as possible.
+    Call poll() every POLL_TICK seconds, it asks the server only for the
+    tiers which are due, all of them in one query.
+
+        poller = InfoPoller(server)
+
+        while True:
+            await poller.poll()
+            await asyncio.sleep(POLL_TICK)
+    """
+
+    def __init__(self, server: ZandronumServer, tiers: tuple = POLL_TIERS,
+                 idle_factor: float = IDLE_FACTOR, rcon_quiet: float = RCON_QUIET):
+        self.server = server
+        self.tiers = tiers
+        self.idle_factor = idle_factor
+        self.rcon_quiet = rcon_quiet
+        self._polled = [-float('inf')] * len(tiers)
+
+    def interval(self, tier: PollTier) -> float:
+        return tier.interval if self.server.numplayers else tier.interval * self.idle_factor
+
+    def due(self, now: float) -> list:
+        """Indexes of the tiers to poll at now."""
+        rcon = now - self.server.rcon_time < self.rcon_quiet
+
+        return [
+            i for i, tier in enumerate(self.tiers)
+            if not (tier.rcon and rcon) and now - self._polled[i] >= self.interval(tier)
+        ]
+
+    async def poll(self) -> ServerQueryFlags:
+        """Query the tiers which are due.  Returns the flags asked for."""
+        now = time.monotonic()
+        due = self.due(now)
+
+        if not due:
+            return ServerQueryFlags(0)
+
+        flags = 0
+
+        for i in due:
+            flags |= self.tiers[i].flags
+            self._polled[i] = now
+
+        # Sections somebody else got more recently than the shortest due
+        # interval are left out by get_info(), the longer tiers are stale
+        # by then anyway.
+        await self.server.get_info(flags, max_age=min(self.interval(self.tiers[i]) for i in due))
+
+        return ServerQueryFlags(flags)
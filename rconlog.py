@@ -0,0 +1,117 @@
+"""
+Sorts RCon log lines into typed events.  Every rule is an alternative of
+one compiled regex, so a line is classified in a single match no matter
+how many rules there are before the one it hits.
+
+    classifier = LogClassifier()
+    classifier.add_rule('frag', '(.+?) was fragged by (.+?)$', lambda victim, killer: ...)
+
+    match classifier.classify(line):
+        case ChatMessage(nick, message):
+            ...
+"""
+import re
+from dataclasses import dataclass
+from typing import Callable
+
+# Color codes in player names, like \x1c[J1] or \x1c-
+NICK_COLOR = re.compile(r'\x1c\[[^\]]*\]|\x1c-')
+
+def clean_nick(nick: str) -> str:
+    return NICK_COLOR.sub('', nick)
+
+@dataclass(frozen=True)
+class ChatMessage:
+    nick: str
+    message: str
+
+@dataclass(frozen=True)
+class PlayerConnected:
+    name: str
+
+@dataclass(frozen=True)
+class PlayerDisconnected:
+    name: str
+
+@dataclass(frozen=True)
+class UserInfo:
+    """A line of a player's userinfo, printed when they connect."""
+    key: str
+    value: str
+
+@dataclass(frozen=True)
+class SystemMessage:
+    text: str
+
+# Userinfo keys the server prints, one per line
+USERINFO_KEYS = (
+    'Name', 'Team', 'Skin', 'Gender', 'PlayerClass', 'Account',
+    'ColorSet', 'SwitchOnPickup', 'MoveBob', 'StillBob',
+    'Wi_NoAutostartMap', 'RailColor', 'Handicap', 'CL_TicsPerUpdate',
+    'CL_ConnectionType', 'CL_ClientFlags', 'Voice_Enable',
+    'Voice_ListenFilter', 'Voice_TransmitFilter', 'Autoaim', 'Color',
+)
+
+@dataclass(frozen=True)
+class LogRule:
+    """
+    pattern is matched at the start of a line, the event is made by
+    calling factory with its groups.  Groups have to be unnamed.
+    """
+    name: str
+    pattern: str
+    factory: Callable
+
+# In order of precedence.  Lines with an IP address in them never count
+# as chat, so nobody's address gets bridged anywhere.
+RULES = (
+    LogRule('connect', r'(.+?) \([^)]*\) has connected\.$', PlayerConnected),
+    LogRule('disconnect', r'client (.+?) \([^)]*\) disconnected\.$', PlayerDisconnected),
+    LogRule('userinfo', r'\s*(' + '|'.join(USERINFO_KEYS) + r'):\s*(.*)', UserInfo),
+    LogRule('connecting', r'(\s*Connect.*)', SystemMessage),
+    LogRule('address', r'(?=.*\b\d{1,3}(?:\.\d{1,3}){3}(?::\d+)?\b)(.*)', SystemMessage),
+    LogRule('system', r'((?:->|.+\(RCON by .+\)).*)', SystemMessage),
+    LogRule('chat', r'(.*?):\s(.+)$', ChatMessage),
+    LogRule('other', r'([\s\S]*)', SystemMessage),
+)
+
+# Rules added later go right before the catch-all, so chat, which most
+# lines are, doesn't pay for them.  Rules for lines with ': ' in them
+# have to go before 'chat' instead.
+PLUGIN_POSITION = 'other'
+
+class LogClassifier:
+    def __init__(self, rules: tuple = RULES):
+        self._rules = list(rules)
+        self._compile()
+
+    def add_rule(self, name: str, pattern: str, factory: Callable, before: str = PLUGIN_POSITION):
+        """Add a rule right before the rule named before."""
+        index = next(i for i, rule in enumerate(self._rules) if rule.name == before)
+        self._rules.insert(index, LogRule(name, pattern, factory))
+        self._compile()
+
+    def _compile(self):
+        alternatives = []
+
+        # What lastindex of a match says about the rule it hit, the
+        # rule's groups follow its own right away.
+        self._dispatch = {}
+        index = 1
+
+        for rule in self._rules:
+            groups = re.compile(rule.pattern).groups
+            alternatives.append(f'({rule.pattern})')
+            self._dispatch[index] = (rule.factory, index + 1, index + 1 + groups)
+            index += 1 + groups
+
+        self._regex = re.compile('|'.join(alternatives))
+
+    def classify(self, line: str):
+        match = self._regex.match(line)
+
+        if match is None:
+            return SystemMessage(line)
+
+        factory, start, end = self._dispatch[match.lastindex]
+        return factory(*match.groups()[start - 1:end - 1])
@@ -0,0 +1,181 @@
+import time
+import heapq
+import asyncio
+import itertools
+from enum import IntEnum
+from dataclasses import dataclass
+from zandronumserver import ZandronumServer
+
+# Commands sent to the server per second
+RCON_COMMAND_RATE = 4
+
+# Commands waiting to be sent, more are dropped
+RCON_QUEUE_SIZE = 200
+
+# Longest command, so its packet stays well under the MTU.  SAY lines are
+# folded into one command up to this size.
+RCON_MAX_COMMAND = 1024
+
+# Quotes and backslashes are escaped in say commands.  ';' and line breaks
+# would start another command, ';' is left out and line breaks are spaces.
+SAY_ESCAPES = str.maketrans({'\\': '\\\\', '"': '\\"', ';': None, '\n': ' ', '\r': ' '})
+SAY_SEPARATORS = str.maketrans({';': None, '\n': ' ', '\r': ' '})
+
+def escape_say(text: str) -> str:
+    """text as it can go between the quotes of a say command."""
+    return text.translate(SAY_ESCAPES)
+
+def truncate(text: str, size: int) -> str:
+    """text cut to at most size bytes of UTF-8."""
+    return text.encode()[:size].decode(errors='ignore')
+
+class CommandPriority(IntEnum):
+    ADMIN = 0
+    CHAT = 1
+
+@dataclass
+class QueuedCommand:
+    command: str
+    fold: bool = False # may be joined with other foldable commands
+    queued: float = 0.0 # time.monotonic() when it was queued
+
+@dataclass
+class RConQueueStats:
+    queued: int = 0
+    dropped: int = 0
+    sent: int = 0 # commands
+    packets: int = 0 # after folding
+    total_latency: float = 0.0 # seconds
+    max_latency: float = 0.0
+
+    @property
+    def latency(self) -> float:
+        """Mean seconds from queueing a command to sending it."""
+        return self.total_latency / self.sent if self.sent else 0.0
+
+class RConCommandQueue:
+    """
+    Sends RCon commands at no more than rate per second, admin commands
+    before chat.  Chat lines waiting together are folded into one
+    command, like 'say "a"; say "b"'.
+
+        commands = RConCommandQueue(server)
+        commands.start()
+        commands.say('hello')
+        commands.command('map map01')
+    """
+
+    def __init__(self, server: ZandronumServer, rate: float = RCON_COMMAND_RATE, maxsize: int = RCON_QUEUE_SIZE):
+        self.server = server
+        self.rate = rate
+        self.maxsize = maxsize
+        self.stats = RConQueueStats()
+
+        self._heap = []
+        self._order = itertools.count()
+        self._ready = asyncio.Event()
+        self._next_send = 0.0
+        self._task = None
+
+    def depth(self) -> int:
+        return len(self._heap)
+
+    def command(self, command: str, priority: CommandPriority = CommandPriority.ADMIN) -> bool:
+        """Queue a command.  Returns False if the queue is full and it was dropped."""
+        return self._put(priority, QueuedCommand(truncate(command, RCON_MAX_COMMAND), False, time.monotonic()))
+
+    def say(self, text: str, escape: bool = True) -> bool:
+        """
+        Queue a chat line.  With escape False, text is already escaped with
+        escape_say() where it has to be, like around color codes.
+        """
+        text = escape_say(text) if escape else text.translate(SAY_SEPARATORS)
+        text = truncate(text, RCON_MAX_COMMAND - len('say ""'))
+
+        # An escape cut in half would escape the closing quote
+        if (len(text) - len(text.rstrip('\\'))) % 2:
+            text = text[:-1]
+
+        return self._put(CommandPriority.CHAT, QueuedCommand(f'say "{text}"', True, time.monotonic()))
+
+    def _put(self, priority: CommandPriority, item: QueuedCommand) -> bool:
+        if len(self._heap) >= self.maxsize:
+            self.stats.dropped += 1
+            return False
+
+        heapq.heappush(self._heap, (priority, next(self._order), item))
+        self.stats.queued += 1
+        self._ready.set()
+        return True
+
+    def start(self):
+        """Start sending on the running event loop."""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        """Stop sending, commands still queued are dropped."""
+        if self._task:
+            self._task.cancel()
+
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+            self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+
+        while True:
+            while not self._heap:
+                self._ready.clear()
+                await self._ready.wait()
+
+            # Take the commands only once it's their turn, so an admin
+            # command queued meanwhile still goes first.
+            now = loop.time()
+
+            if self._next_send > now:
+                await asyncio.sleep(self._next_send - now)
+
+            self._next_send = max(now, self._next_send) + 1 / self.rate
+
+            self._send(self._take())
+
+    def _take(self) -> list:
+        """Commands of the next packet."""
+        priority, order, first = heapq.heappop(self._heap)
+        items = [first]
+
+        if first.fold:
+            size = len(first.command.encode())
+
+            while self._heap:
+                next_priority, order, item = self._heap[0]
+                extra = len(item.command.encode()) + 2
+
+                if not item.fold or next_priority != priority or size + extra > RCON_MAX_COMMAND:
+                    break
+
+                heapq.heappop(self._heap)
+                items.append(item)
+                size += extra
+
+        return items
+
+    def _send(self, items: list):
+        try:
+            self.server.send_command_rcon('; '.join(item.command for item in items))
+        except OSError as e:
+            print(f'Failed to send RCon command: {e}')
+            return
+
+        now = time.monotonic()
+        self.stats.sent += len(items)
+        self.stats.packets += 1
+
+        for item in items:
+            self.stats.total_latency += now - item.queued
+            self.stats.max_latency = max(self.stats.max_latency, now - item.queued)
@@ -0,0 +1,131 @@
+"""
+Replays a capture file through the same decoding and parsing as a live
+server, to reproduce what the bot saw or to benchmark it offline:
+
+    python replay.py incident.zcap
+    python replay.py incident.zcap --speed 1
+
+Listeners can be added to the ReplayServer like to a ZandronumServer.
+"""
+import os
+import time
+import asyncio
+import argparse
+import contextlib
+from dataclasses import dataclass
+from bytereader import ByteReader, CheckedByteReader, LONG
+from capture import CaptureReader, CaptureDirection
+from metrics import huffman_decode
+from zandronumserver import (
+    ZandronumServer, ServerLauncherResponse, SegmentedResponse,
+    LAUNCHER_RESPONSES, check_launcher_status,
+)
+
+@dataclass
+class ReplayStats:
+    packets: int = 0
+    sent: int = 0 # only counted, what the bot sent isn't parsed
+    launcher: int = 0 # whole responses, after reassembling segments
+    rcon: int = 0
+    errors: int = 0
+    seconds: float = 0.0 # time the replay took
+
+class ReplayServer(ZandronumServer):
+    """A server fed from a capture file instead of a socket.  It never sends anything."""
+
+    def __init__(self):
+        super().__init__('127.0.0.1', 0)
+        self.stats = ReplayStats()
+        self._segments = None
+
+    def _send(self, data: bytes) -> int:
+        return len(data)
+
+    async def feed(self, data: bytes):
+        """Parse a received datagram as it was on the wire."""
+        data = huffman_decode(self._huffman, data)
+
+        if len(data) >= 4 and LONG.unpack_from(data)[0] in LAUNCHER_RESPONSES:
+            await self._feed_launcher(CheckedByteReader(data))
+        else:
+            self.stats.rcon += 1
+            self.rcon_time = time.monotonic()
+            await self._handle_rcon(CheckedByteReader(data), '')
+
+    async def _feed_launcher(self, res: ByteReader):
+        status = res.read_long()
+
+        if status == ServerLauncherResponse.CHALLENGE_SEGMENTED:
+            if self._segments is None:
+                self._segments = SegmentedResponse()
+
+            if not self._segments.add(res):
+                return
+
+            res = self._segments.reader()
+            self._segments = None
+            status = res.read_long()
+
+        self.stats.launcher += 1
+        check_launcher_status(status)
+
+        await self._set_snapshot(self._info_snapshot(self.parse_info(res)))
+
+    async def replay(self, path: str, speed: float = None) -> ReplayStats:
+        """
+        Feed every packet of the capture at path, as fast as possible or
+        speed times as fast as they were captured.
+        """
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        first = None
+
+        with CaptureReader(path) as capture:
+            for packet in capture:
+                self.stats.packets += 1
+
+                if speed:
+                    first = packet.time if first is None else first
+                    wait = start + (packet.time - first) / speed - loop.time()
+
+                    if wait > 0:
+                        await asyncio.sleep(wait)
+
+                if packet.direction == CaptureDirection.SENT:
+                    self.stats.sent += 1
+                    continue
+
+                try:
+                    await self.feed(packet.data)
+                except Exception as e:
+                    self.stats.errors += 1
+                    print(f'Failed to replay packet {self.stats.packets}: {e}')
+
+        self.stats.seconds = loop.time() - start
+        return self.stats
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay a packet capture.')
+    parser.add_argument('file', help='capture file written by ZandronumServer.start_capture()')
+    parser.add_argument('--speed', type=float, help='replay at this many times the original speed, as fast as possible by default')
+    parser.add_argument('--quiet', action='store_true', help='only print the summary, for benchmarking')
+    args = parser.parse_args()
+
+    async def run() -> ReplayStats:
+        server = ReplayServer()
+        server.add_listener('message', print)
+
+        try:
+            return await server.replay(args.file, args.speed)
+        finally:
+            server.close()
+
+    with open(os.devnull, 'w') as devnull:
+        with contextlib.redirect_stdout(devnull) if args.quiet else contextlib.nullcontext():
+            stats = asyncio.run(run())
+
+    print(f'{stats.packets} packets ({stats.sent} sent, {stats.launcher} launcher responses, '
+          f'{stats.rcon} RCon packets, {stats.errors} errors) in {stats.seconds:.3f} s')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,166 @@
+"""
+Immutable snapshots of what is known about a server and the events
+between two of them.  ZandronumServer keeps the latest snapshot and
+triggers a 'change' listener for every event, so consumers only hear
+about things which actually changed:
+
+    @server.change
+    async def on_change(event):
+        if isinstance(event, PlayerJoined):
+            print(f'{event.player.name} joined')
+"""
+from dataclasses import dataclass, replace
+from typing import Tuple
+
+@dataclass(frozen=True)
+class PlayerSnapshot:
+    name: str
+    frags: int = None # None if only the name is known, like from RCon
+    ping: int = 0
+    spectating: bool = False
+    bot: bool = False
+    team: int = -1
+    time: int = 0 # in minutes
+
+@dataclass(frozen=True)
+class TeamSnapshot:
+    name: str
+    score: int = 0
+
+@dataclass(frozen=True)
+class ServerSnapshot:
+    name: str = ''
+    version: str = ''
+    mapname: str = ''
+    gametype: int = 0
+    iwad: str = ''
+    maxclients: int = 0
+    maxplayers: int = 0
+    numplayers: int = 0
+    pwads: Tuple[str, ...] = ()
+    players: Tuple[PlayerSnapshot, ...] = ()
+    teams: Tuple[TeamSnapshot, ...] = ()
+
+    @classmethod
+    def from_info(cls, info, players: Tuple[PlayerSnapshot, ...] = None) -> 'ServerSnapshot':
+        """
+        Snapshot of a ZandronumInfo.  players replaces the ones of info,
+        which are only decoded when it's left out.
+        """
+        if players is None:
+            players = tuple(
+                PlayerSnapshot(p.name, p.frags, p.ping, p.spectating, p.bot, p.team, p.time)
+                for p in info.players
+            )
+
+        return cls(
+            name=info.name,
+            version=info.version,
+            mapname=info.mapname,
+            gametype=info.gametype,
+            iwad=info.iwad,
+            maxclients=info.maxclients,
+            maxplayers=info.maxplayers,
+            numplayers=info.numplayers,
+            pwads=tuple(info.pwads),
+            players=players,
+            teams=tuple(TeamSnapshot(t.name, t.score) for t in info.teams),
+        )
+
+    def with_player_names(self, names: list) -> 'ServerSnapshot':
+        """
+        Snapshot with only the players in names, like the RCon player
+        list.  Players already known keep their records.
+        """
+        known = {player.name: player for player in self.players}
+        players = tuple(known.get(name) or PlayerSnapshot(name) for name in names)
+
+        return replace(self, players=players, numplayers=len(players))
+
+@dataclass(frozen=True)
+class PlayerJoined:
+    player: PlayerSnapshot
+
+@dataclass(frozen=True)
+class PlayerLeft:
+    player: PlayerSnapshot
+
+@dataclass(frozen=True)
+class PlayerFragsChanged:
+    player: PlayerSnapshot
+    old: int
+
+@dataclass(frozen=True)
+class TeamScoreChanged:
+    team: TeamSnapshot
+    old: int
+
+@dataclass(frozen=True)
+class MapChanged:
+    old: str
+    new: str
+
+@dataclass(frozen=True)
+class PwadsChanged:
+    old: Tuple[str, ...]
+    new: Tuple[str, ...]
+
+    @property
+    def added(self) -> list:
+        return [pwad for pwad in self.new if pwad not in self.old]
+
+    @property
+    def removed(self) -> list:
+        return [pwad for pwad in self.old if pwad not in self.new]
+
+@dataclass(frozen=True)
+class InfoChanged:
+    """Any other setting of the server, field is the snapshot attribute."""
+    field: str
+    old: object
+    new: object
+
+# Snapshot attributes reported with InfoChanged
+INFO_FIELDS = ('name', 'version', 'gametype', 'iwad', 'maxclients', 'maxplayers')
+
+def diff(old: ServerSnapshot, new: ServerSnapshot) -> list:
+    """
+    Events which turn old into new.  Players are told apart by name, and
+    there are no events without an old snapshot to compare to.
+    """
+    if old is None or old == new:
+        return []
+
+    events = []
+
+    if old.mapname != new.mapname:
+        events.append(MapChanged(old.mapname, new.mapname))
+
+    if old.pwads != new.pwads:
+        events.append(PwadsChanged(old.pwads, new.pwads))
+
+    for name in INFO_FIELDS:
+        if getattr(old, name) != getattr(new, name):
+            events.append(InfoChanged(name, getattr(old, name), getattr(new, name)))
+
+    old_players = {player.name: player for player in old.players}
+    new_players = {player.name: player for player in new.players}
+
+    for name, player in old_players.items():
+        if name not in new_players:
+            events.append(PlayerLeft(player))
+
+    for name, player in new_players.items():
+        before = old_players.get(name)
+
+        if before is None:
+            events.append(PlayerJoined(player))
+        elif None not in (before.frags, player.frags) and before.frags != player.frags:
+            events.append(PlayerFragsChanged(player, before.frags))
+
+    # Teams only change their scores, they are told apart by position
+    for before, team in zip(old.teams, new.teams):
+        if before.score != team.score:
+            events.append(TeamScoreChanged(team, before.score))
+
+    return events
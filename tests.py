@@ -1,7 +1,37 @@
 import unittest
 import subprocess
-import time, os
-from zandronumserver import ZandronumServer
+import time, os, json, random, socket, struct, asyncio, threading, datetime, sqlite3, tempfile, concurrent.futures
+from unittest import mock
+import huffman
+import zandronumserver
+import fakeserver
+import functools
+from bytereader import ByteReader, CheckedByteReader, TruncatedPacketError
+from zandronumserver import ZandronumServer, ZandronumGamemode, ZandronumTeam, ServerQueryFlags, RConState, TooManyCompletions
+from fixtures import launcher_response, INFO_FLAGS, rcon_log, legacy_classify, legacy_parse_info
+from playersessions import PlayerSessions, SampleRing, PlayerSample
+from leaderboard import Leaderboard, Frag, FRAG_RULES, LeaderboardRow, week_of
+from commandindex import CommandIndex, CommandTrie
+from rconqueue import RConCommandQueue, RCON_MAX_COMMAND, escape_say
+from rconlog import LogClassifier, ChatMessage, PlayerConnected, PlayerDisconnected, UserInfo, SystemMessage
+from fleet import ZandronumFleet
+from masterserver import ZandronumMaster, MasterServerResponse
+from poller import InfoPoller, PollTier
+from webhook import WebhookSink
+from capture import PacketCapture, CaptureReader, CaptureDirection, CapturedPacket, RECORD
+from replay import ReplayServer
+from fakeserver import FakeZandronumServer
+from loadtest import run_load_test
+from configstore import ConfigStore, ServerSettings, CONFIG_VERSION
+from metrics import MetricsRegistry, MetricsServer, METRICS, HUFFMAN_SECONDS, RCON_PACKETS, LAUNCHER_SECONDS, LAUNCHER_ERRORS
+import aiohttp
+from embedupdater import EmbedUpdater
+import discord
+from aiohttp import web
+from serverstate import (
+    ServerSnapshot, PlayerSnapshot, TeamSnapshot, PlayerJoined, PlayerLeft, PlayerFragsChanged,
+    TeamScoreChanged, MapChanged, PwadsChanged, InfoChanged, diff,
+)
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -47,5 +77,1950 @@ class TestZandronumServer(unittest.TestCase):
     def test_rcon_login(cls):
         cls.server.login_rcon('testtest')
 
+def reference_encode(codec: huffman.HuffmanObject, data: bytes) -> bytes:
+    """Bit string encoder the bit packing encoder replaced."""
+    binary_string = ''.join(codec.huffman_table[byte] for byte in data)
+
+    encoded = bytes(int(binary_string[i:i+8][::-1], 2) for i in range(0, len(binary_string), 8))
+
+    if len(data) <= len(encoded):
+        return b'\xff' + data
+
+    padding_value = (8 - (len(binary_string) % 8)) % 8
+
+    return bytes([padding_value]) + encoded
+
+def reference_decode(codec: huffman.HuffmanObject, data: bytes) -> bytes:
+    """Bit string and tree walking decoder the table decoder replaced."""
+    padding_length = data[0]
+    data = data[1:]
+
+    if padding_length == 0xff:
+        return data
+
+    binary_string = ''.join('{0:08b}'.format(byte)[::-1] for byte in data)
+    binary_string = binary_string[:len(binary_string) - padding_length]
+
+    decoded = []
+    node = codec.huffman_tree
+
+    for bit in binary_string:
+        if bit in node:
+            node = node[bit]
+        else:
+            decoded.append(node['asc'])
+            node = codec.huffman_tree[bit]
+
+    decoded.append(node['asc'])
+
+    return bytes(decoded)
+
+class TestHuffman(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.codec = huffman.HuffmanObject(huffman.SKULLTAG_FREQS)
+        cls.rng = random.Random(666)
+
+    def random_payloads(self):
+        for size in (1, 2, 7, 8, 9, 64, 1024, 4096):
+            # Skewed towards frequent bytes so most payloads are really
+            # compressed instead of being sent with the 0xff marker.
+            yield bytes(self.rng.choices(range(256), weights=huffman.SKULLTAG_FREQS, k=size))
+            yield self.rng.randbytes(size)
+
+        yield b'\x00' * 100
+        yield b'\xff' * 100
+        yield b'Player: hello there, this is a normal chat line\x00'
+
+    def test_encode_matches_reference(self):
+        for payload in self.random_payloads():
+            with self.subTest(size=len(payload)):
+                self.assertEqual(self.codec.encode(payload), reference_encode(self.codec, payload))
+
+    def test_encode_unencoded_fallback(self):
+        self.assertEqual(self.codec.encode(b''), b'\xff')
+        self.assertEqual(self.codec.encode(b'\xff' * 10), b'\xff' + b'\xff' * 10)
+
+    def test_round_trip(self):
+        for payload in self.random_payloads():
+            with self.subTest(size=len(payload)):
+                self.assertEqual(reference_decode(self.codec, self.codec.encode(payload)), payload)
+                self.assertEqual(self.codec.decode(reference_encode(self.codec, payload)), payload)
+
+    def test_decode_matches_reference(self):
+        for payload in self.random_payloads():
+            encoded = self.codec.encode(payload)
+
+            with self.subTest(size=len(payload), unencoded=encoded[0] == 0xff):
+                self.assertEqual(self.codec.decode(encoded), reference_decode(self.codec, encoded))
+                self.assertEqual(self.codec.decode(encoded), payload)
+
+    def test_decode_truncated(self):
+        # First 8 bits of a 10 bit code, without any padding
+        code = next(c for c in self.codec.huffman_table if len(c) == 10)
+        broken = bytes([0, int(code[:8][::-1], 2)])
+
+        with self.assertRaises(ValueError):
+            self.codec.decode(broken)
+
+class TestByteReader(unittest.TestCase):
+    DATA = b'\x01\xfe\xff\x78\x56\x34\x12\xff\xff\xff\xff\x00\x00\x80\x3fname\x00\x00tail'
+
+    def test_reads(self):
+        for reader in (ByteReader, CheckedByteReader):
+            with self.subTest(reader=reader.__name__):
+                res = reader(self.DATA)
+
+                self.assertEqual(res.read_byte(), 1)
+                self.assertEqual(res.read_short(), -2)
+                self.assertEqual(res.read_ulong(), 0x12345678)
+                self.assertEqual(res.read_long(), -1)
+                self.assertEqual(res.read_float(), 1.0)
+                self.assertEqual(res.read_string(), 'name')
+                self.assertEqual(res.read_string(), '')
+                self.assertEqual(res.remaining(), 4)
+                self.assertEqual(res.read_bytes(4), b'tail')
+                self.assertEqual(res.tell(), len(self.DATA))
+
+    def test_unchecked_short_reads(self):
+        res = ByteReader(b'abc')
+        self.assertEqual(res.read_string(), 'abc')
+        self.assertEqual(res.remaining(), 0)
+
+        res.seek(1)
+        self.assertEqual(res.read_bytes(10), b'bc')
+
+    def test_checked_truncation(self):
+        for read in (
+            lambda res: res.read_short(),
+            lambda res: res.read_long(),
+            lambda res: res.read_ulong(),
+            lambda res: res.read_float(),
+            lambda res: res.read_bytes(3),
+            lambda res: res.read_string(),
+        ):
+            res = CheckedByteReader(b'\x01\x02')
+            res.read_byte()
+
+            with self.assertRaises(TruncatedPacketError):
+                read(res)
+
+class TestParseInfo(unittest.TestCase):
+    def parse(self, payload: bytes) -> ZandronumServer:
+        server = ZandronumServer('127.0.0.1', 10666)
+        res = CheckedByteReader(payload)
+        res.read_long()
+
+        self.assertEqual(server.parse_info(res), INFO_FLAGS)
+        self.assertEqual(res.remaining(), 0)
+
+        return server
+
+    def test_parse(self):
+        server = self.parse(launcher_response(players=32, pwads=50))
+
+        self.assertEqual(server.version, '3.2.1')
+        self.assertEqual(server.mapname, 'MAP07')
+        self.assertEqual(server.gametype, ZandronumGamemode.SURVIVAL)
+        self.assertEqual((server.maxclients, server.maxplayers), (64, 32))
+        self.assertEqual((server.skill, server.botskill), (3, 3))
+        self.assertEqual((server.timelimit, server.timeleft), (20, 13))
+        self.assertEqual(len(server.pwads), 50)
+        self.assertEqual(server.optional_wads, [0])
+        self.assertEqual(server.numplayers, 32)
+        self.assertEqual(len(server.players), 32)
+        self.assertTrue(server.players[5].name.endswith(']Player\x1c-5'))
+        self.assertEqual(server.players[5].team, -1)
+        self.assertTrue(server.players[-1].name.endswith(']Player\x1c-31'))
+        self.assertIs(server.get_player(server.players[5].name), server.players[5])
+
+    def test_parse_teams(self):
+        server = self.parse(launcher_response(players=8, teams=2))
+
+        self.assertEqual(server.gametype, ZandronumGamemode.CTF)
+        self.assertEqual(server.numteams, 2)
+        self.assertEqual([team.name for team in server.teams], ['Team 0', 'Team 1'])
+        self.assertTrue(all(isinstance(team, ZandronumTeam) for team in server.teams))
+        self.assertEqual([player.team for player in server.players], [0, 1] * 4)
+
+    def test_players_decoded_lazily(self):
+        server = self.parse(launcher_response(players=32))
+
+        self.assertEqual(server.players._items.count(None), 32)
+        server.players[3]
+        self.assertEqual(server.players._items.count(None), 31)
+        self.assertIs(server.players[3], server.players[3])
+
+    def test_legacy_parser(self):
+        for payload in (launcher_response(), launcher_response(players=32, pwads=50), launcher_response(players=32, teams=4)):
+            server = self.parse(payload)
+            legacy = ZandronumServer('127.0.0.1', 10666)
+            res = CheckedByteReader(payload)
+            res.read_long()
+
+            self.assertEqual(legacy_parse_info(legacy, res), INFO_FLAGS)
+            self.assertEqual(res.remaining(), 0)
+            self.assertEqual(legacy.players, list(server.players))
+            self.assertEqual(legacy.teams, list(server.teams))
+            self.assertEqual((legacy.pwads, legacy.md5sum, legacy.timeleft), (server.pwads, server.md5sum, server.timeleft))
+
+    def test_truncated(self):
+        payload = launcher_response(players=32)
+
+        with self.assertRaises(TruncatedPacketError):
+            self.parse(payload[:300])
+
+def segmented(response: bytes, size: int, seed: int = 666) -> list:
+    """Segments of a launcher response in shuffled order."""
+    segments = fakeserver.segment_response(response, size)
+    random.Random(seed).shuffle(segments)
+    return segments
+
+# Console commands of the fake server, sv_ has too many to complete at once
+COMMANDS = ['map', 'changemap', 'kick', 'kickfromgame', 'Say', 's', 'fraglimit', 'timelimit', '+attack', '-attack', '?', 'sv_cvar'] + [f'sv_cvar{i}' for i in range(15)]
+
+class FakeServer(FakeZandronumServer):
+    """
+    FakeZandronumServer on an event loop of its own thread, so tests can
+    block or run their own loop meanwhile.  Launcher queries are answered
+    with response, which can be a list of datagrams, like the segments of
+    a response, and everybody logging in is greeted with a chat line.
+    """
+
+    def __init__(self, response: bytes | list, port: int = 0):
+        super().__init__(commands=COMMANDS)
+        self.response = response
+
+        self.loop = asyncio.new_event_loop()
+        started = concurrent.futures.Future()
+        self.thread = threading.Thread(target=self.serve, args=(port, started), daemon=True)
+        self.thread.start()
+        started.result()
+
+    def serve(self, port: int, started: concurrent.futures.Future):
+        try:
+            self.loop.run_until_complete(self.start(port=port))
+        except Exception as e:
+            started.set_exception(e)
+            self.loop.close()
+            return
+
+        started.set_result(None)
+        self.loop.run_forever()
+        self.loop.close()
+
+    def close(self):
+        if self.thread.is_alive():
+            self.loop.call_soon_threadsafe(self._stop)
+            self.thread.join()
+
+    def _stop(self):
+        super().close()
+
+        # After the transport let go of the socket
+        self.loop.call_soon(self.loop.stop)
+
+    def _answer_query(self, res, addr):
+        for response in self.response if isinstance(self.response, list) else [self.response]:
+            self.send(response, addr)
+
+    def _handle_rcon(self, res, addr):
+        logins = self.logins
+        super()._handle_rcon(res, addr)
+
+        if self.logins > logins:
+            self.message('Player: hello')
+
+class TestTransport(unittest.TestCase):
+    def setUp(self):
+        self.fake = FakeServer(launcher_response(players=4))
+        self.server = ZandronumServer('127.0.0.1', self.fake.port)
+
+    def tearDown(self):
+        self.fake.close()
+        del self.server
+
+    def test_update_info(self):
+        # Twice, each call runs its own event loop
+        for i in range(2):
+            self.assertEqual(self.server.update_info(), INFO_FLAGS)
+            self.assertEqual(self.server.numplayers, 4)
+
+    def test_query_info(self):
+        async def query():
+            try:
+                return await asyncio.gather(self.server.query_info(), self.server.query_info())
+            finally:
+                self.server.close()
+
+        self.assertEqual(asyncio.run(query()), [INFO_FLAGS, INFO_FLAGS])
+        self.assertEqual(self.server.mapname, 'MAP07')
+
+    def test_get_info_coalesced(self):
+        async def query():
+            try:
+                await asyncio.gather(*(self.server.get_info() for i in range(10)))
+                await self.server.get_info(ServerQueryFlags.NAME)
+            finally:
+                self.server.close()
+
+        asyncio.run(query())
+
+        self.assertEqual(self.fake.queries, 1)
+        self.assertEqual(self.server.numplayers, 4)
+
+    def test_get_info_expired(self):
+        async def query():
+            try:
+                await self.server.get_info(ServerQueryFlags.NAME)
+                # Only the missing section is stale
+                await self.server.get_info(ServerQueryFlags.NAME | ServerQueryFlags.MAPNAME)
+                await self.server.get_info(ServerQueryFlags.NAME, max_age=0)
+
+                self.server.info_ttl[ServerQueryFlags.MAPNAME] = 0
+                await self.server.get_info(ServerQueryFlags.MAPNAME)
+            finally:
+                self.server.close()
+
+        asyncio.run(query())
+
+        self.assertEqual(self.fake.queries, 4)
+
+    def test_query_timeout(self):
+        self.fake.close()
+
+        with mock.patch.object(zandronumserver, 'LAUNCHER_TIMEOUT', 0.1):
+            with self.assertRaises(TimeoutError):
+                self.server.update_info()
+
+    def test_late_reply(self):
+        class SlowServer(FakeZandronumServer):
+            delay = 0.2
+
+            def _answer_query(self, res, addr):
+                asyncio.get_running_loop().call_later(self.delay, super()._answer_query, res, addr)
+
+        fake = SlowServer()
+        server = ZandronumServer('127.0.0.1', 0)
+
+        async def query():
+            await fake.start()
+            server._port = fake.port
+
+            try:
+                with mock.patch.object(zandronumserver, 'LAUNCHER_TIMEOUT', 0.1):
+                    with self.assertRaises(TimeoutError):
+                        await server.query_info()
+
+                # The reply to the first query comes in meanwhile
+                fake.delay = 0
+                await asyncio.sleep(0.2)
+                fake.mapname = 'MAP02'
+
+                await server.query_info()
+                self.assertEqual(server.mapname, 'MAP02')
+
+                fake.mapname = 'MAP03'
+                await server.query_info()
+                self.assertEqual(server.mapname, 'MAP03')
+            finally:
+                server.close()
+                fake.close()
+
+        asyncio.run(query())
+
+    def test_rcon(self):
+        async def login():
+            received = asyncio.Queue()
+            self.server.add_listener('message', received.put)
+            self.server.start_rcon('secret')
+
+            try:
+                return await asyncio.wait_for(received.get(), 5)
+            finally:
+                self.server.close()
+
+        self.assertEqual(asyncio.run(login()), 'Player: hello')
+
+class TestServerState(unittest.TestCase):
+    def test_diff(self):
+        old = ServerSnapshot(
+            name='Server', mapname='MAP01', pwads=('a.pk3', 'b.pk3'), numplayers=2,
+            players=(PlayerSnapshot('one', 5), PlayerSnapshot('two', 3)),
+            teams=(TeamSnapshot('Blue', 1), TeamSnapshot('Red', 0)),
+        )
+        new = ServerSnapshot(
+            name='Server', mapname='MAP02', pwads=('b.pk3', 'c.pk3'), numplayers=2, maxplayers=8,
+            players=(PlayerSnapshot('two', 4), PlayerSnapshot('three', 0)),
+            teams=(TeamSnapshot('Blue', 1), TeamSnapshot('Red', 2)),
+        )
+
+        self.assertEqual(diff(old, new), [
+            MapChanged('MAP01', 'MAP02'),
+            PwadsChanged(('a.pk3', 'b.pk3'), ('b.pk3', 'c.pk3')),
+            InfoChanged('maxplayers', 0, 8),
+            PlayerLeft(PlayerSnapshot('one', 5)),
+            PlayerFragsChanged(PlayerSnapshot('two', 4), 3),
+            PlayerJoined(PlayerSnapshot('three', 0)),
+            TeamScoreChanged(TeamSnapshot('Red', 2), 0),
+        ])
+        self.assertEqual(diff(old, new)[1].added, ['c.pk3'])
+        self.assertEqual(diff(old, new)[1].removed, ['a.pk3'])
+
+    def test_no_changes(self):
+        snapshot = ServerSnapshot(name='Server', players=(PlayerSnapshot('one', 5),))
+
+        self.assertEqual(diff(None, snapshot), [])
+        self.assertEqual(diff(snapshot, ServerSnapshot(name='Server', players=(PlayerSnapshot('one', 5),))), [])
+
+    def test_rcon_player_names(self):
+        old = ServerSnapshot(players=(PlayerSnapshot('one', 5), PlayerSnapshot('two', 3)), numplayers=2)
+        new = old.with_player_names(['two', 'three'])
+
+        self.assertEqual(new.players, (PlayerSnapshot('two', 3), PlayerSnapshot('three')))
+        self.assertEqual(new.numplayers, 2)
+        self.assertEqual(diff(old, new), [PlayerLeft(PlayerSnapshot('one', 5)), PlayerJoined(PlayerSnapshot('three'))])
+
+        # Frags which weren't known before are no change
+        launcher = ServerSnapshot(players=(PlayerSnapshot('two', 3), PlayerSnapshot('three', 7)), numplayers=2)
+        self.assertEqual(diff(new, launcher), [])
+
+    def test_change_listener(self):
+        fake = FakeServer(launcher_response(players=4))
+        server = ZandronumServer('127.0.0.1', fake.port)
+        events = []
+        server.add_listener('change', events.append)
+
+        async def query():
+            try:
+                await server.query_info()
+                await server.query_info()
+
+                fake.response = launcher_response(players=5)
+                await server.query_info()
+            finally:
+                server.close()
+
+        try:
+            asyncio.run(query())
+        finally:
+            fake.close()
+
+        self.assertEqual(events, [PlayerJoined(server.snapshot.players[4])])
+        self.assertEqual(server.snapshot.numplayers, 5)
+
+    def test_query_without_players(self):
+        fake = FakeZandronumServer()
+        server = ZandronumServer('127.0.0.1', 0)
+        events = []
+
+        async def query():
+            await fake.start()
+            server._port = fake.port
+            fake.join('One')
+
+            try:
+                await server.query_info()
+
+                # The RCon player list knows of somebody the launcher doesn't yet
+                fake.join('NewGuy')
+                await server._set_snapshot(server.snapshot.with_player_names(['One', 'NewGuy']))
+                players = server.snapshot.players
+                server.add_listener('change', events.append)
+
+                await server.query_info(ServerQueryFlags.NUMPLAYERS)
+                self.assertIs(server.snapshot.players, players)
+                self.assertEqual(events, [])
+
+                await server.query_info()
+            finally:
+                server.close()
+                fake.close()
+
+        asyncio.run(query())
+
+        self.assertEqual(events, [])
+        self.assertEqual([player.name for player in server.snapshot.players], ['One', 'NewGuy'])
+
+class TestPoller(unittest.TestCase):
+    tiers = (
+        PollTier(ServerQueryFlags.NUMPLAYERS | ServerQueryFlags.MAPNAME, 10, rcon=True),
+        PollTier(ServerQueryFlags.PWADS, 100),
+    )
+
+    def test_due(self):
+        server = ZandronumServer('127.0.0.1', 10666)
+        poller = InfoPoller(server, self.tiers, idle_factor=6, rcon_quiet=30)
+
+        self.assertEqual(poller.due(0), [0, 1])
+
+        poller._polled = [0, 0]
+        server.numplayers = 1
+        self.assertEqual(poller.due(5), [])
+        self.assertEqual(poller.due(10), [0])
+        self.assertEqual(poller.due(100), [0, 1])
+
+        # Nobody playing
+        server.numplayers = 0
+        self.assertEqual(poller.due(10), [])
+        self.assertEqual(poller.due(60), [0])
+
+        # RCon is flowing
+        server.numplayers = 1
+        server.rcon_time = 80
+        self.assertEqual(poller.due(100), [1])
+        self.assertEqual(poller.due(110), [0, 1])
+
+    def test_poll(self):
+        fake = FakeServer(launcher_response(players=4))
+        server = ZandronumServer('127.0.0.1', fake.port)
+        poller = InfoPoller(server, self.tiers)
+
+        async def poll():
+            try:
+                return [await poller.poll(), await poller.poll()]
+            finally:
+                server.close()
+
+        try:
+            flags = asyncio.run(poll())
+        finally:
+            fake.close()
+
+        self.assertEqual(flags, [self.tiers[0].flags | self.tiers[1].flags, 0])
+        self.assertEqual(fake.queries, 1)
+        self.assertEqual(server.numplayers, 4)
+
+class FakeWebhook:
+    """
+    Local stand-in for a Discord webhook.  responses are (status, headers,
+    body) for the first requests, every other one gets a 204.
+    """
+
+    def __init__(self, responses: list = ()):
+        self.responses = list(responses)
+        self.messages = []
+        self.times = []
+
+    async def handle(self, request):
+        self.messages.append(await request.json())
+        self.times.append(time.monotonic())
+
+        if self.responses:
+            status, headers, body = self.responses.pop(0)
+            return web.json_response(body, status=status, headers=headers)
+
+        return web.Response(status=204)
+
+    async def start(self) -> str:
+        app = web.Application()
+        app.router.add_post('/webhook', self.handle)
+
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, '127.0.0.1', 0).start()
+
+        return f'http://127.0.0.1:{self.runner.addresses[0][1]}/webhook'
+
+    async def close(self):
+        await self.runner.cleanup()
+
+class TestWebhook(unittest.TestCase):
+    def run_sink(self, fake: FakeWebhook, lines: list, **kwargs) -> WebhookSink:
+        async def run():
+            sink = WebhookSink(await fake.start(), **kwargs)
+
+            try:
+                for content, username in lines:
+                    sink.send(content, username=username)
+
+                sink.start()
+            finally:
+                await sink.close()
+                await fake.close()
+
+            return sink
+
+        return asyncio.run(run())
+
+    def test_grouping(self):
+        fake = FakeWebhook()
+        sink = self.run_sink(fake, [
+            ('one', 'Player'), ('two', 'Player'), ('three', 'Player'),
+            ('Map changed', 'Server'), ('four', 'Player'),
+        ], window=0.05)
+
+        self.assertEqual(fake.messages, [
+            {'content': 'one\ntwo\nthree', 'username': 'Player'},
+            {'content': 'Map changed', 'username': 'Server'},
+            {'content': 'four', 'username': 'Player'},
+        ])
+        self.assertEqual((sink.stats.sent, sink.stats.messages, sink.stats.failed), (5, 3, 0))
+
+    def test_message_limit(self):
+        fake = FakeWebhook()
+        self.run_sink(fake, [('x' * 1500, 'Player'), ('y' * 1500, 'Player')], window=0.05)
+
+        self.assertEqual([len(message['content']) for message in fake.messages], [1500, 1500])
+
+    def test_rate_limit(self):
+        fake = FakeWebhook([
+            (429, {}, {'message': 'You are being rate limited.', 'retry_after': 0.1, 'global': False}),
+            (200, {'X-RateLimit-Remaining': '0', 'X-RateLimit-Reset-After': '0.2'}, {}),
+        ])
+        sink = self.run_sink(fake, [('one', 'Player'), ('two', 'Server')], window=0.01)
+
+        self.assertEqual([message['content'] for message in fake.messages], ['one', 'one', 'two'])
+        self.assertGreaterEqual(fake.times[1] - fake.times[0], 0.1)
+        self.assertGreaterEqual(fake.times[2] - fake.times[1], 0.2)
+        self.assertEqual((sink.stats.rate_limited, sink.stats.delayed, sink.stats.sent), (1, 1, 2))
+
+    def test_dropped(self):
+        fake = FakeWebhook()
+        sink = self.run_sink(fake, [(str(i), 'Player') for i in range(5)], window=0.01, maxsize=2)
+
+        self.assertEqual(fake.messages, [{'content': '0\n1', 'username': 'Player'}])
+        self.assertEqual((sink.stats.queued, sink.stats.dropped), (2, 3))
+
+    def test_failure(self):
+        fake = FakeWebhook([(400, {}, {'message': 'Cannot send an empty message'})])
+        sink = self.run_sink(fake, [('one', 'Player'), ('two', 'Server')], window=0.01)
+
+        self.assertEqual((sink.stats.failed, sink.stats.sent), (1, 1))
+
+class FakeMessage:
+    def __init__(self, channel, id: int):
+        self.channel = channel
+        self.id = id
+
+    async def edit(self, embed):
+        if self.id not in self.channel.messages:
+            raise discord.NotFound(mock.Mock(status=404, reason='Not Found'), 'Unknown Message')
+
+        self.channel.calls.append(('edit', self.id, embed.title))
+
+class FakeChannel:
+    """Records the REST calls an EmbedUpdater makes."""
+
+    def __init__(self, id: int = 1):
+        self.id = id
+        self.messages = set()
+        self.calls = []
+
+    async def fetch_message(self, id: int):
+        self.calls.append(('fetch', id))
+
+        if id not in self.messages:
+            raise discord.NotFound(mock.Mock(status=404, reason='Not Found'), 'Unknown Message')
+
+        return FakeMessage(self, id)
+
+    async def send(self, embed):
+        message = FakeMessage(self, len(self.messages) + 100)
+        self.messages.add(message.id)
+        self.calls.append(('send', message.id, embed.title))
+        return message
+
+class TestEmbedUpdater(unittest.TestCase):
+    def setUp(self):
+        self.title = 'Server'
+        self.created = []
+        self.channel = FakeChannel()
+        self.channel.messages.add(7)
+        EmbedUpdater._edited.clear()
+
+    def render(self):
+        return discord.Embed(title=self.title, timestamp=datetime.datetime.now())
+
+    def updater(self, **kwargs) -> EmbedUpdater:
+        updater = EmbedUpdater(self.render, on_created=self.created.append, **kwargs)
+        updater.set_channel(self.channel, 7)
+        return updater
+
+    def test_debounce(self):
+        async def run():
+            updater = self.updater(window=0.05, min_interval=0)
+
+            for i in range(10):
+                self.title = f'Server {i}'
+                updater.request()
+                await asyncio.sleep(0.001)
+
+            await updater._task
+            return updater
+
+        updater = asyncio.run(run())
+
+        self.assertEqual(self.channel.calls, [('fetch', 7), ('edit', 7, 'Server 9')])
+        self.assertEqual(updater.edits, 1)
+
+    def test_identical_embed(self):
+        async def run():
+            updater = self.updater()
+            await updater.update()
+
+            # Only the timestamp differs
+            await updater.update()
+
+            self.title = 'Other'
+            await updater.update()
+            return updater
+
+        updater = asyncio.run(run())
+
+        self.assertEqual(self.channel.calls, [('fetch', 7), ('edit', 7, 'Server'), ('edit', 7, 'Other')])
+        self.assertEqual((updater.edits, updater.skipped), (2, 1))
+
+    def test_min_interval(self):
+        async def run():
+            loop = asyncio.get_running_loop()
+            updater = self.updater(window=0.01, min_interval=0.2)
+            updater.request()
+            await updater._task
+            first = loop.time()
+
+            self.title = 'Other'
+            updater.request()
+            await updater._task
+
+            return loop.time() - first
+
+        self.assertGreaterEqual(asyncio.run(run()), 0.19)
+        self.assertEqual([call[0] for call in self.channel.calls], ['fetch', 'edit', 'edit'])
+
+    def test_min_interval_shared(self):
+        async def run():
+            loop = asyncio.get_running_loop()
+            first = self.updater(window=0.01, min_interval=0.2)
+            first.request()
+            await first._task
+            edited = loop.time()
+
+            # Another message in the same channel waits for the first one's edit
+            self.channel.messages.add(8)
+            second = EmbedUpdater(self.render, window=0.01, min_interval=0.2)
+            second.set_channel(self.channel, 8)
+            second.request()
+            await second._task
+
+            return loop.time() - edited
+
+        self.assertGreaterEqual(asyncio.run(run()), 0.19)
+        self.assertEqual(self.channel.calls, [('fetch', 7), ('edit', 7, 'Server'), ('fetch', 8), ('edit', 8, 'Server')])
+
+    def test_deleted_message(self):
+        async def run():
+            updater = self.updater()
+            await updater.update()
+
+            self.channel.messages.clear()
+            self.title = 'Other'
+            await updater.update()
+            return updater
+
+        updater = asyncio.run(run())
+
+        self.assertEqual(self.channel.calls[-1], ('send', 100, 'Other'))
+        self.assertEqual(updater.message_id, 100)
+        self.assertEqual([message.id for message in self.created], [100])
+
+class TestRConLog(unittest.TestCase):
+    def test_lines(self):
+        classifier = LogClassifier()
+        lines = {
+            '\x1c[J1]Somebody\x1c- (10.0.0.1:10666) has connected.': PlayerConnected('\x1c[J1]Somebody\x1c-'),
+            'client Somebody (10.0.0.1:10666) disconnected.': PlayerDisconnected('Somebody'),
+            'Name: Somebody': UserInfo('Name', 'Somebody'),
+            '  ColorSet: 3': UserInfo('ColorSet', '3'),
+            'Connecting...': SystemMessage('Connecting...'),
+            'Somebody: gg: wp': ChatMessage('Somebody', 'gg: wp'),
+            '<Server>: hello': ChatMessage('<Server>', 'hello'),
+            'Somebody: my server is 10.0.0.1:10666': SystemMessage('Somebody: my server is 10.0.0.1:10666'),
+            '-> map map01': SystemMessage('-> map map01'),
+            '<Server>: Admin (RCON by Somebody): kick Other': SystemMessage('<Server>: Admin (RCON by Somebody): kick Other'),
+            'Somebody was splattered by Other.': SystemMessage('Somebody was splattered by Other.'),
+            '': SystemMessage(''),
+        }
+
+        for line, event in lines.items():
+            with self.subTest(line=line):
+                self.assertEqual(classifier.classify(line), event)
+
+    def test_same_as_legacy(self):
+        classifier = LogClassifier()
+
+        for line in rcon_log(2000):
+            self.assertEqual(classifier.classify(line), legacy_classify(line), line)
+
+    def test_add_rule(self):
+        classifier = LogClassifier()
+        classifier.add_rule('frag', r'(.+?) was splattered by (.+?)\.$', lambda victim, killer: ('frag', victim, killer))
+        classifier.add_rule('notice', r'Notice: (.*)', SystemMessage, before='chat')
+
+        self.assertEqual(classifier.classify('Somebody was splattered by Other.'), ('frag', 'Somebody', 'Other'))
+        self.assertEqual(classifier.classify('Notice: restart soon'), SystemMessage('restart soon'))
+        self.assertEqual(classifier.classify('Somebody: gg'), ChatMessage('Somebody', 'gg'))
+
+class TestRConQueue(unittest.TestCase):
+    def setUp(self):
+        self.fake = FakeServer(b'')
+        self.server = ZandronumServer('127.0.0.1', self.fake.port)
+
+    def tearDown(self):
+        self.fake.close()
+        del self.server
+
+    def run_queue(self, queue: RConCommandQueue, count: int, timeout: float = 5):
+        async def run():
+            deadline = time.monotonic() + timeout
+            self.server.start_rcon('secret')
+
+            # The fake server only takes commands once logged in
+            while self.server.rcon_state != RConState.LOGGED_IN and time.monotonic() < deadline:
+                await asyncio.sleep(0.01)
+
+            queue.start()
+
+            try:
+                # The fake server gets the packets on its own thread
+                while len(self.fake.received) < count and time.monotonic() < deadline:
+                    await asyncio.sleep(0.01)
+            finally:
+                await queue.close()
+                await self.server.stop_rcon()
+                self.server.close()
+
+        asyncio.run(run())
+        return list(self.fake.received)
+
+    def test_fold(self):
+        queue = RConCommandQueue(self.server, rate=100)
+
+        for i in range(5):
+            queue.say(f'line {i}')
+
+        queue.command('map map01')
+
+        self.assertEqual(self.run_queue(queue, 2), [
+            'map map01',
+            'say "line 0"; say "line 1"; say "line 2"; say "line 3"; say "line 4"',
+        ])
+        self.assertEqual((queue.stats.sent, queue.stats.packets, queue.depth()), (6, 2, 0))
+
+    def test_max_command(self):
+        queue = RConCommandQueue(self.server, rate=100)
+
+        for i in range(20):
+            queue.say('x' * 200)
+
+        messages = self.run_queue(queue, 5)
+
+        self.assertEqual(sum(message.count('say') for message in messages), 20)
+        self.assertTrue(all(len(message) <= RCON_MAX_COMMAND for message in messages))
+
+    def test_say_escaped(self):
+        queue = RConCommandQueue(self.server, rate=100)
+        queue.say('a"; kick all; say "b')
+        queue.say('back\\')
+        queue.say('two\nlines')
+        queue.say('\\c[J1]' + escape_say('x"'), escape=False)
+
+        self.assertEqual(self.run_queue(queue, 1), [
+            'say "a\\" kick all say \\"b"; say "back\\\\"; say "two lines"; say "\\c[J1]x\\""',
+        ])
+
+    def test_say_truncated(self):
+        queue = RConCommandQueue(self.server, rate=100)
+        queue.say('x' * 2000)
+        queue.say('"' * 2000)
+        queue.command('kick ' + 'x' * 2000)
+
+        messages = self.run_queue(queue, 3)
+
+        self.assertEqual(len(messages), 3)
+        self.assertTrue(all(len(message.encode()) <= RCON_MAX_COMMAND for message in messages))
+        self.assertTrue(messages[2].startswith('say "\\"') and messages[2].endswith('\\""'))
+
+    def test_rate(self):
+        queue = RConCommandQueue(self.server, rate=20)
+
+        for i in range(5):
+            queue.command(f'kick {i}')
+
+        start = time.monotonic()
+        self.assertEqual(self.run_queue(queue, 5), [f'kick {i}' for i in range(5)])
+
+        # The first one goes right away
+        self.assertGreaterEqual(time.monotonic() - start, 4 / 20)
+        self.assertGreaterEqual(queue.stats.max_latency, 0.15)
+
+    def test_dropped(self):
+        queue = RConCommandQueue(self.server, maxsize=3)
+
+        self.assertEqual([queue.say(str(i)) for i in range(5)], [True, True, True, False, False])
+        self.assertEqual((queue.stats.queued, queue.stats.dropped, queue.depth()), (3, 2, 3))
+
+class TestLeaderboard(unittest.TestCase):
+    # Monday and Sunday of one week, and the Monday after
+    WEEK = datetime.datetime(2026, 10, 12, 12, tzinfo=datetime.timezone.utc).timestamp()
+    SUNDAY = WEEK + 6 * 86400
+    NEXT_WEEK = WEEK + 7 * 86400
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'leaderboard.db')
+
+    def run_leaderboard(self, record, *queries) -> list:
+        async def run():
+            leaderboard = Leaderboard(self.path)
+
+            try:
+                record(leaderboard)
+                await leaderboard.flush()
+                return [await leaderboard.top(**query) for query in queries]
+            finally:
+                await leaderboard.close()
+
+        return asyncio.run(run())
+
+    def test_frags(self):
+        def record(leaderboard):
+            leaderboard.record_frag('\x1c[J1]One\x1c-', 'Two', 'MAP01', self.WEEK)
+            leaderboard.record_frag('One', 'Two', 'map02', self.SUNDAY)
+            leaderboard.record_frag('Two', 'One', 'MAP01', self.NEXT_WEEK)
+            leaderboard.record_frag(None, 'Two', 'MAP01', self.NEXT_WEEK)
+            leaderboard.record_frag('One', 'One', 'MAP01', self.NEXT_WEEK)
+
+        all_time, week, next_week, map02, deaths = self.run_leaderboard(
+            record,
+            {},
+            {'week': week_of(self.WEEK)},
+            {'week': week_of(self.NEXT_WEEK)},
+            {'mapname': 'MAP02'},
+            {'by': 'deaths', 'limit': 1},
+        )
+
+        self.assertEqual(all_time, [LeaderboardRow('One', 2, 2, 0, 0), LeaderboardRow('Two', 1, 3, 0, 0)])
+        self.assertEqual(week, [LeaderboardRow('One', 2, 0, 0, 0), LeaderboardRow('Two', 0, 2, 0, 0)])
+        self.assertEqual(next_week, [LeaderboardRow('Two', 1, 1, 0, 0), LeaderboardRow('One', 0, 2, 0, 0)])
+        self.assertEqual(map02, [LeaderboardRow('One', 1, 0, 0, 0), LeaderboardRow('Two', 0, 1, 0, 0)])
+        self.assertEqual(deaths, [LeaderboardRow('Two', 1, 3, 0, 0)])
+
+        with sqlite3.connect(self.path) as db:
+            self.assertEqual(db.execute('SELECT COUNT(*) FROM frags').fetchone(), (5,))
+
+    def test_snapshots(self):
+        def snapshot(mapname, *players):
+            return ServerSnapshot(mapname=mapname, players=tuple(PlayerSnapshot(*player) for player in players))
+
+        def record(leaderboard):
+            leaderboard.record_snapshot(snapshot('MAP01', ('One', 5, 0, False, False, -1, 10), ('Bot', 9, 0, False, True, -1, 10)), self.WEEK)
+            leaderboard.record_snapshot(snapshot('MAP01', ('One', 8, 0, False, False, -1, 12), ('Bot', 20, 0, False, True, -1, 12)), self.WEEK)
+            # New map, scores start over
+            leaderboard.record_snapshot(snapshot('MAP02', ('One', 2, 0, False, False, -1, 13), ('Two', 4, 0, False, False, -1, 1)), self.WEEK)
+            # Only names from RCon, what was known of them is kept
+            leaderboard.record_snapshot(snapshot('MAP02', ('One',), ('Two',)), self.WEEK)
+            leaderboard.record_snapshot(snapshot('MAP02', ('One', 3, 0, False, False, -1, 14), ('Two', 1, 0, False, False, -1, 2)), self.WEEK)
+
+        rows, = self.run_leaderboard(record, {'by': 'score'})
+
+        self.assertEqual(rows, [LeaderboardRow('One', 0, 0, 6, 4), LeaderboardRow('Two', 0, 0, 0, 1)])
+
+    def test_partial_snapshots(self):
+        def snapshot(mapname, *players):
+            return ServerSnapshot(mapname=mapname, players=tuple(PlayerSnapshot(*player) for player in players))
+
+        def record(leaderboard):
+            leaderboard.record_snapshot(snapshot('MAP01', ('One', 5, 0, False, False, -1, 10), ('Two', 2, 0, False, False, -1, 10)), self.WEEK)
+            # Two only known by name while the map changes
+            leaderboard.record_snapshot(snapshot('MAP02', ('One', 1, 0, False, False, -1, 11), ('Two',)), self.WEEK)
+            leaderboard.record_snapshot(snapshot('MAP02', ('One',), ('Two',)), self.WEEK)
+            leaderboard.record_snapshot(snapshot('MAP02', ('One', 4, 0, False, False, -1, 12), ('Two', 3, 0, False, False, -1, 12)), self.WEEK)
+            # Three left, and starts over when back
+            leaderboard.record_snapshot(snapshot('MAP02', ('Three', 1, 0, False, False, -1, 1)), self.WEEK)
+            leaderboard.record_snapshot(snapshot('MAP02'), self.WEEK)
+            leaderboard.record_snapshot(snapshot('MAP02', ('Three', 6, 0, False, False, -1, 2)), self.WEEK)
+
+        rows, = self.run_leaderboard(record, {'by': 'score'})
+
+        # Two's frags are all from the new map, Three scored nothing after coming back
+        self.assertEqual(rows, [LeaderboardRow('One', 0, 0, 4, 2), LeaderboardRow('Two', 0, 0, 3, 2)])
+
+    def test_write_behind(self):
+        async def run():
+            leaderboard = Leaderboard(self.path, flush_interval=0.05)
+            leaderboard.start()
+
+            try:
+                for i in range(100):
+                    leaderboard.record_frag('One', 'Two', 'MAP01')
+
+                # Nothing is written until the next flush
+                self.assertEqual(await leaderboard.top(), [])
+                self.assertGreater(leaderboard.pending(), 100)
+
+                await asyncio.sleep(0.2)
+                self.assertEqual(leaderboard.pending(), 0)
+                return await leaderboard.top()
+            finally:
+                await leaderboard.close()
+
+        self.assertEqual(asyncio.run(run()), [LeaderboardRow('One', 100, 0, 0, 0), LeaderboardRow('Two', 0, 100, 0, 0)])
+
+    def test_frag_rules(self):
+        classifier = LogClassifier()
+
+        for rule in FRAG_RULES:
+            classifier.add_rule(rule.name, rule.pattern, rule.factory)
+
+        self.assertEqual(classifier.classify("One was splattered by Two's super shotgun."), Frag('One', 'Two'))
+        self.assertEqual(classifier.classify('One was fragged by Two.'), Frag('One', 'Two'))
+        self.assertEqual(classifier.classify('One suicides.'), Frag('One'))
+        self.assertEqual(classifier.classify('One: was fragged by Two.'), ChatMessage('One', 'was fragged by Two.'))
+
+    def test_order(self):
+        with self.assertRaises(ValueError):
+            self.run_leaderboard(lambda leaderboard: None, {'by': 'frags; DROP TABLE scores'})
+
+class TestPlayerSessions(unittest.TestCase):
+    def snapshot(self, *players) -> ServerSnapshot:
+        return ServerSnapshot(players=tuple(PlayerSnapshot(*player) for player in players))
+
+    def test_ring(self):
+        ring = SampleRing(3)
+        self.assertIsNone(ring.last())
+
+        for i in range(5):
+            ring.append(i, 10 * i, i, -1)
+
+        self.assertEqual(len(ring), 3)
+        self.assertEqual(ring.samples(), [PlayerSample(i, 10 * i, i, -1) for i in (2, 3, 4)])
+        self.assertEqual(ring.last(), PlayerSample(4, 40, 4, -1))
+
+    def test_sessions(self):
+        sessions = PlayerSessions(history=2)
+        sessions.update(self.snapshot(('\x1c[J1]One\x1c-', 1, 50, False, False, 0), ('Two', 0, 80)), 100)
+        sessions.update(self.snapshot(('\x1c[J1]One\x1c-', 2, 60, False, False, 1)), 200)
+        # RCon only knows names, so nothing is sampled
+        sessions.update(self.snapshot(('One',)), 300)
+
+        one = sessions.get('ONE')
+        self.assertEqual(one.name, 'One')
+        self.assertTrue(one.online)
+        self.assertEqual(one.duration(400), 300)
+        self.assertEqual(one.samples(), [PlayerSample(100, 50, 1, 0), PlayerSample(200, 60, 2, 1)])
+
+        two = sessions.get('two')
+        self.assertFalse(two.online)
+        self.assertEqual((two.started, two.ended), (100, 200))
+
+        # Back for a new session
+        sessions.update(self.snapshot(('Two', 0, 70)), 500)
+        self.assertEqual((two.started, two.ended), (500, None))
+        self.assertEqual((one.started, one.ended), (100, 500))
+        self.assertIsNone(sessions.get('Three'))
+
+    def test_search(self):
+        sessions = PlayerSessions()
+        sessions.update(self.snapshot(('Doomguy',), ('\x1c[J1]doomer\x1c-',), ('Dog',), ('Marine',)))
+
+        self.assertEqual([entry.name for entry in sessions.search('DOO')], ['\x1c[J1]doomer\x1c-', 'Doomguy'])
+        self.assertEqual([entry.name for entry in sessions.search('d', limit=1)], ['Dog'])
+        self.assertEqual(sessions.search('x'), [])
+        self.assertEqual(len(sessions.search('')), 4)
+
+    def test_evict(self):
+        sessions = PlayerSessions(size=2)
+
+        for name in ('One', 'Two', 'Three'):
+            sessions.update(self.snapshot((name, 0)))
+
+        self.assertEqual(len(sessions), 2)
+        self.assertIsNone(sessions.get('One'))
+        self.assertEqual([entry.name for entry in sessions.search('t')], ['Three', 'Two'])
+
+        # Nobody online is evicted
+        sessions.update(self.snapshot(('One', 0), ('Two', 0), ('Three', 0)))
+        self.assertEqual(len(sessions), 3)
+
+    def test_partial_snapshot(self):
+        fake = FakeZandronumServer()
+        server = ZandronumServer('127.0.0.1', 0)
+        sessions = PlayerSessions()
+
+        async def poll():
+            await fake.start()
+            server._port = fake.port
+            fake.join('One')
+
+            try:
+                await server.query_info()
+                sessions.update(server.snapshot, 100)
+
+                # Seen by RCon first, the cheap query doesn't know of him
+                fake.join('NewGuy')
+                await server._set_snapshot(server.snapshot.with_player_names(['One', 'NewGuy']))
+                sessions.update(server.snapshot, 200)
+
+                await server.query_info(ServerQueryFlags.NUMPLAYERS)
+                sessions.update(server.snapshot, 300)
+
+                await server.query_info()
+                sessions.update(server.snapshot, 400)
+            finally:
+                server.close()
+                fake.close()
+
+        asyncio.run(poll())
+
+        one = sessions.get('One')
+        self.assertEqual((one.started, one.ended), (100, None))
+        self.assertEqual([sample.time for sample in one.samples()], [100, 200, 300, 400])
+
+        new_guy = sessions.get('NewGuy')
+        self.assertEqual((new_guy.started, new_guy.ended), (200, None))
+        self.assertEqual([sample.time for sample in new_guy.samples()], [400])
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.addCleanup(setattr, METRICS, 'enabled', False)
+
+    def test_render(self):
+        registry = MetricsRegistry()
+        registry.enabled = True
+        packets = registry.counter('packets_total', 'Packets.', ('header',))
+        latency = registry.histogram('latency_seconds', 'Latency.', buckets=(0.1, 1))
+        registry.collect('depth', 'Depth.', lambda: 3)
+        registry.collect('lines_total', 'Lines.', lambda: {('sent',): 5}, ('state',), 'counter')
+
+        packets.inc('message')
+        packets.inc('message')
+        packets.inc('say "hi"')
+
+        for value in (0.05, 0.1, 0.5, 2):
+            latency.observe(value)
+
+        self.assertEqual(registry.render(), '\n'.join([
+            '# HELP packets_total Packets.',
+            '# TYPE packets_total counter',
+            'packets_total{header="message"} 2',
+            'packets_total{header="say \\"hi\\""} 1',
+            '# HELP latency_seconds Latency.',
+            '# TYPE latency_seconds histogram',
+            'latency_seconds_bucket{le="0.1"} 2',
+            'latency_seconds_bucket{le="1"} 3',
+            'latency_seconds_bucket{le="+Inf"} 4',
+            'latency_seconds_sum 2.65',
+            'latency_seconds_count 4',
+            '# HELP depth Depth.',
+            '# TYPE depth gauge',
+            'depth 3',
+            '# HELP lines_total Lines.',
+            '# TYPE lines_total counter',
+            'lines_total{state="sent"} 5',
+        ]) + '\n')
+
+        with self.assertRaises(ValueError):
+            registry.counter('depth', 'Again.')
+
+    def test_disabled(self):
+        registry = MetricsRegistry()
+        packets = registry.counter('packets_total', 'Packets.')
+        latency = registry.histogram('latency_seconds', 'Latency.')
+
+        packets.inc()
+        latency.observe(1)
+
+        self.assertEqual(packets.value(), 0)
+        self.assertEqual(latency.count(), 0)
+
+    def test_server(self):
+        fake = FakeServer(launcher_response(players=4))
+        server = ZandronumServer('127.0.0.1', fake.port)
+        METRICS.enabled = True
+
+        queries = LAUNCHER_SECONDS.count('server')
+        decoded = HUFFMAN_SECONDS.count('decode')
+        logins = RCON_PACKETS.value('loggedin')
+        timeouts = LAUNCHER_ERRORS.value('timeout')
+
+        async def run():
+            metrics = MetricsServer(port=0)
+            await metrics.start()
+            received = asyncio.Queue()
+            server.add_listener('message', received.put)
+
+            try:
+                await server.query_info()
+                server.start_rcon('secret')
+                await asyncio.wait_for(received.get(), 5)
+
+                fake.close()
+
+                with mock.patch.object(zandronumserver, 'LAUNCHER_TIMEOUT', 0.1):
+                    with self.assertRaises(TimeoutError):
+                        await server.query_info()
+
+                async with aiohttp.ClientSession() as session:
+                    async with session.get(f'http://127.0.0.1:{metrics.port}/metrics') as response:
+                        return response.content_type, await response.text()
+            finally:
+                server.close()
+                await metrics.close()
+
+        content_type, text = asyncio.run(run())
+
+        self.assertEqual(content_type, 'text/plain')
+        self.assertIn('# TYPE doomer_launcher_query_seconds histogram', text)
+        self.assertIn('doomer_rcon_packets_total{header="message"}', text)
+        self.assertEqual(LAUNCHER_SECONDS.count('server'), queries + 1)
+        self.assertGreaterEqual(HUFFMAN_SECONDS.count('decode'), decoded + 4)
+        self.assertEqual(RCON_PACKETS.value('loggedin'), logins + 1)
+        self.assertEqual(LAUNCHER_ERRORS.value('timeout'), timeouts + 1)
+
+class TestCapture(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'test.zcap')
+
+    def test_file(self):
+        capture = PacketCapture(self.path)
+        capture.write(CaptureDirection.SENT, b'query', 1.5)
+        capture.close()
+
+        # Appended to, and a record cut off at the end is left out
+        capture = PacketCapture(self.path)
+        capture.write(CaptureDirection.RECEIVED, b'response', 2.5)
+        capture.write(CaptureDirection.RECEIVED, b'', 3.5)
+
+        # On disk before the capture is closed
+        with CaptureReader(self.path) as reader:
+            self.assertEqual(len(list(reader)), 3)
+
+        capture.close()
+
+        with open(self.path, 'ab') as f:
+            f.write(RECORD.pack(4.5, CaptureDirection.RECEIVED, 100) + b'cut')
+
+        with CaptureReader(self.path) as reader:
+            self.assertEqual(list(reader), [
+                CapturedPacket(1.5, CaptureDirection.SENT, b'query'),
+                CapturedPacket(2.5, CaptureDirection.RECEIVED, b'response'),
+                CapturedPacket(3.5, CaptureDirection.RECEIVED, b''),
+            ])
+
+    def test_not_capture(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'something else')
+
+        with self.assertRaises(ValueError):
+            CaptureReader(self.path)
+
+        with self.assertRaises(ValueError):
+            PacketCapture(self.path)
+
+    def test_replay(self):
+        response = launcher_response(players=8, pwads=20)
+        fake = FakeServer(segmented(response, 200))
+        server = ZandronumServer('127.0.0.1', fake.port)
+        server.start_capture(self.path)
+
+        async def record():
+            received = asyncio.Queue()
+            server.add_listener('message', received.put)
+
+            try:
+                await server.query_info()
+                server.start_rcon('secret')
+                await asyncio.wait_for(received.get(), 5)
+            finally:
+                await server.stop_rcon()
+                server.close()
+
+        async def replay():
+            replayed = ReplayServer()
+            messages = []
+            replayed.add_listener('message', messages.append)
+
+            try:
+                return replayed, messages, await replayed.replay(self.path)
+            finally:
+                replayed.close()
+
+        try:
+            asyncio.run(record())
+        finally:
+            server.stop_capture()
+            fake.close()
+
+        replayed, messages, stats = asyncio.run(replay())
+
+        self.assertEqual(stats.errors, 0)
+        self.assertEqual(stats.launcher, 1)
+        self.assertGreaterEqual(stats.sent, 3) # query, login and password
+        self.assertGreaterEqual(stats.rcon, 3) # salt, logged in and the message
+        self.assertEqual(messages, ['Player: hello'])
+        self.assertEqual(replayed.snapshot.players, server.snapshot.players)
+        self.assertEqual(replayed.pwads, server.pwads)
+        self.assertEqual(replayed.rcon_state, RConState.LOGGED_IN)
+
+        # The password hash isn't in the file
+        with CaptureReader(self.path) as reader:
+            sent = [huffman.SKULLTAG_HUFFMAN.decode(packet.data) for packet in reader if packet.direction == CaptureDirection.SENT]
+
+        self.assertIn(zandronumserver.REDACTED_PASSWORD, sent)
+        self.assertFalse(any(packet[0] == zandronumserver.RConClientHeaders.PASSWORD and len(packet) > 2 for packet in sent))
+
+    def test_speed(self):
+        capture = PacketCapture(self.path)
+        capture.write(CaptureDirection.SENT, b'', 10.0)
+        capture.write(CaptureDirection.SENT, b'', 10.4)
+        capture.close()
+
+        async def replay(speed: float):
+            replayed = ReplayServer()
+
+            try:
+                return await replayed.replay(self.path, speed)
+            finally:
+                replayed.close()
+
+        self.assertGreaterEqual(asyncio.run(replay(2)).seconds, 0.19)
+        self.assertLess(asyncio.run(replay(None)).seconds, 0.19)
+
+class TestFakeServer(unittest.TestCase):
+    def test_launcher(self):
+        async def query():
+            fake = FakeZandronumServer(segment_size=64)
+            await fake.start()
+            server = ZandronumServer('127.0.0.1', fake.port)
+
+            for i in range(20):
+                fake.join(f'Player{i}')
+
+            fake.leave('Player0')
+
+            try:
+                flags = await server.query_info()
+                return flags, server.mapname, [player.name for player in server.players]
+            finally:
+                server.close()
+                fake.close()
+
+        flags, mapname, players = asyncio.run(query())
+
+        self.assertEqual(flags, fakeserver.FAKE_INFO_FLAGS)
+        self.assertEqual(mapname, 'MAP01')
+        self.assertEqual(players, [f'Player{i}' for i in range(1, 20)])
+
+    def test_launcher_teams(self):
+        async def query():
+            fake = FakeZandronumServer()
+            fake.gametype = ZandronumGamemode.CTF
+            await fake.start()
+            server = ZandronumServer('127.0.0.1', fake.port)
+
+            for i in range(4):
+                fake.join(f'Player{i}')
+
+            fake.join('Blue', team=0)
+
+            try:
+                await server.query_info()
+                return server.gametype, [(player.name, player.team) for player in server.players]
+            finally:
+                server.close()
+                fake.close()
+
+        gametype, players = asyncio.run(query())
+
+        self.assertEqual(gametype, ZandronumGamemode.CTF)
+        self.assertEqual(players, [('Player0', 0), ('Player1', 1), ('Player2', 0), ('Player3', 1), ('Blue', 0)])
+
+    def test_rcon(self):
+        async def session():
+            fake = FakeZandronumServer(password='secret')
+            await fake.start()
+            server = ZandronumServer('127.0.0.1', fake.port)
+            messages = []
+            server.add_listener('message', messages.append)
+            server.start_rcon('secret')
+
+            try:
+                while server.rcon_state != RConState.LOGGED_IN:
+                    await asyncio.sleep(0.01)
+
+                await fake.play([
+                    functools.partial(fake.join, 'One'),
+                    functools.partial(fake.join, 'Two'),
+                    'One: hello',
+                    functools.partial(fake.leave, 'Two'),
+                    functools.partial(fake.change_map, 'MAP02'),
+                ], rate=1000)
+
+                completions = await server.tab_complete('kick')
+                server.send_command_rcon('fraglimit 10')
+                await asyncio.sleep(0.2)
+
+                return fake, server.snapshot, messages, completions
+            finally:
+                await server.stop_rcon()
+                server.close()
+                fake.close()
+
+        with mock.patch.object(zandronumserver, 'RCON_KEEPALIVE', 0.05):
+            fake, snapshot, messages, completions = asyncio.run(session())
+
+        self.assertEqual(messages, [
+            'One (127.0.0.1:10667) has connected.',
+            'Two (127.0.0.1:10667) has connected.',
+            'One: hello',
+            'client Two (127.0.0.1:10667) disconnected.',
+            '-> map MAP02',
+            '-> fraglimit 10',
+        ])
+        self.assertEqual([player.name for player in snapshot.players], ['One'])
+        self.assertEqual(snapshot.mapname, 'MAP02')
+        self.assertEqual(completions, ['kick', 'kickfromgame'])
+        self.assertEqual(fake.received, ['fraglimit 10'])
+        self.assertEqual(fake.logins, 1)
+        self.assertGreater(fake.pongs, 0)
+
+    def test_wrong_password(self):
+        async def session():
+            fake = FakeZandronumServer(password='other')
+            await fake.start()
+            server = ZandronumServer('127.0.0.1', fake.port)
+            server.start_rcon('secret')
+
+            try:
+                await asyncio.sleep(0.2)
+                return fake.logins, server.rcon_state
+            finally:
+                await server.stop_rcon()
+                server.close()
+                fake.close()
+
+        logins, state = asyncio.run(session())
+
+        self.assertEqual(logins, 0)
+        self.assertNotEqual(state, RConState.LOGGED_IN)
+
+    def test_load(self):
+        # One player, so the bridge can join every line into few messages
+        result = asyncio.run(run_load_test(lines=500, rate=2000, players=1, join_rate=0, limit=1000, drain=5))
+
+        self.assertEqual(result.lines, 500)
+        self.assertEqual(result.received, 500)
+        self.assertEqual(result.drop_rate, 0)
+        self.assertLess(result.requests, 50)
+        self.assertLessEqual(result.percentile(50), result.percentile(99))
+
+class TestSegmented(unittest.TestCase):
+    response = launcher_response(players=32, pwads=50, teams=2)
+
+    def expected(self) -> ZandronumServer:
+        server = ZandronumServer('127.0.0.1', 10666)
+        res = ByteReader(self.response)
+        res.read_long()
+        server.parse_info(res)
+        return server
+
+    def query(self, segments: list) -> ZandronumServer:
+        fake = FakeServer(segments)
+        server = ZandronumServer('127.0.0.1', fake.port)
+
+        try:
+            self.assertEqual(server.update_info(), INFO_FLAGS)
+        finally:
+            fake.close()
+
+        return server
+
+    def assertSameInfo(self, server: ZandronumServer):
+        expected = self.expected()
+
+        self.assertEqual(server.pwads, expected.pwads)
+        self.assertEqual(list(server.players), list(expected.players))
+        self.assertEqual(list(server.teams), list(expected.teams))
+        self.assertEqual(server.md5sum, expected.md5sum)
+
+    def test_shuffled(self):
+        for seed in range(5):
+            with self.subTest(seed=seed):
+                self.assertSameInfo(self.query(segmented(self.response, 200, seed)))
+
+    def test_duplicate_segment(self):
+        segments = segmented(self.response, 300)
+        self.assertSameInfo(self.query(segments[:2] + segments))
+
+    def test_reader_is_not_copied(self):
+        segments = zandronumserver.SegmentedResponse()
+
+        for segment in segmented(self.response, 500):
+            res = CheckedByteReader(segment)
+            res.read_long()
+            complete = segments.add(res)
+
+        self.assertTrue(complete)
+        self.assertEqual(bytes(segments.buffer), struct.pack('<l', zandronumserver.ServerLauncherResponse.CHALLENGE) + self.response[4:])
+        self.assertIs(segments.reader().data, segments.buffer)
+
+    def test_bad_segment(self):
+        segments = zandronumserver.SegmentedResponse()
+        first, second = segmented(self.response, 500)[:2]
+
+        res = CheckedByteReader(first)
+        res.read_long()
+        segments.add(res)
+
+        # Claims a different total size
+        res = CheckedByteReader(second[:10] + struct.pack('<H', 1) + second[12:])
+        res.read_long()
+
+        with self.assertRaises(ValueError):
+            segments.add(res)
+
+    def test_lost_segment(self):
+        fake = FakeServer(segmented(self.response, 200)[1:])
+        server = ZandronumServer('127.0.0.1', fake.port)
+
+        try:
+            with mock.patch.object(zandronumserver, 'LAUNCHER_TIMEOUT', 0.2):
+                with self.assertRaisesRegex(TimeoutError, 'segments'):
+                    server.update_info()
+        finally:
+            fake.close()
+
+    def test_fleet(self):
+        async def poll():
+            launchers = await fake_launchers([segmented(self.response, 200, seed) for seed in range(10)])
+            fleet = ZandronumFleet(timeout=1, rate=10000)
+
+            try:
+                return [result async for result in fleet.poll(launcher.address for launcher in launchers)]
+            finally:
+                fleet.close()
+
+                for launcher in launchers:
+                    launcher.transport.close()
+
+        results = asyncio.run(poll())
+
+        self.assertEqual(len(results), 10)
+
+        for result in results:
+            self.assertIsNone(result.error)
+            self.assertEqual(result.flags, INFO_FLAGS)
+            self.assertEqual(result.info.pwads, self.expected().pwads)
+
+class TestRConSession(unittest.TestCase):
+    timeouts = {
+        'RCON_KEEPALIVE': 0.05,
+        'RCON_LIVENESS': 0.2,
+        'RCON_LOGIN_TIMEOUT': 0.3,
+        'RCON_BACKOFF_MIN': 0.05,
+        'RCON_BACKOFF_MAX': 0.2,
+        'LAUNCHER_TIMEOUT': 0.2,
+    }
+
+    def setUp(self):
+        patcher = mock.patch.multiple(zandronumserver, **self.timeouts)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_restart(self):
+        fake = FakeServer(launcher_response())
+        server = ZandronumServer('127.0.0.1', fake.port)
+        states = asyncio.Queue()
+        server.add_listener('rcon_state', states.put)
+
+        async def wait_for(state):
+            while await asyncio.wait_for(states.get(), 5) != state:
+                pass
+
+        async def run():
+            nonlocal fake
+            server.start_rcon('secret')
+
+            try:
+                await wait_for(RConState.LOGGED_IN)
+
+                # Keepalive goes on while the server is quiet
+                await asyncio.sleep(0.3)
+                self.assertGreaterEqual(fake.pongs, 3)
+
+                port = fake.port
+                fake.close()
+                await wait_for(RConState.RECONNECTING)
+
+                # Nobody there for a while
+                await asyncio.sleep(0.3)
+
+                fake = FakeServer(launcher_response(), port=port)
+                await wait_for(RConState.LOGGED_IN)
+            finally:
+                await server.stop_rcon()
+                server.close()
+
+        try:
+            asyncio.run(run())
+        finally:
+            fake.close()
+
+        self.assertEqual(fake.logins, 1)
+        self.assertGreaterEqual(server.rcon_reconnects, 1)
+        self.assertEqual(server.rcon_state, RConState.DISCONNECTED)
+
+    def test_backoff(self):
+        fake = FakeServer(launcher_response())
+        server = ZandronumServer('127.0.0.1', fake.port)
+
+        async def run():
+            server.start_rcon('wrong')
+
+            try:
+                await asyncio.sleep(1)
+            finally:
+                await server.stop_rcon()
+                server.close()
+
+        try:
+            asyncio.run(run())
+        finally:
+            fake.close()
+
+        # Delays of 0.05, 0.1, then 0.2 at most, with jitter, instead of
+        # trying again right away.
+        self.assertGreaterEqual(fake.connections, 3)
+        self.assertLessEqual(fake.connections, 12)
+        self.assertEqual(fake.logins, 0)
+
+class TestCommandIndex(unittest.TestCase):
+    def test_trie(self):
+        trie = CommandTrie()
+
+        for word in ['kick', 'kickfromgame', 'Kill', 'map', 'kick']:
+            trie.add(word)
+
+        self.assertEqual(len(trie), 4)
+        self.assertEqual(trie.complete('ki'), ['kick', 'kickfromgame', 'Kill'])
+        self.assertEqual(trie.complete('KICK'), ['kick', 'kickfromgame'])
+        self.assertEqual(trie.complete('k', limit=2), ['kick', 'kickfromgame'])
+        self.assertEqual(trie.complete('x'), [])
+        self.assertEqual(trie.complete(''), ['kick', 'kickfromgame', 'Kill', 'map'])
+
+    def test_tab_complete(self):
+        fake = FakeServer(launcher_response())
+        server = ZandronumServer('127.0.0.1', fake.port)
+        index = CommandIndex(server)
+        logged_in = asyncio.Event()
+        server.add_listener('rcon_state', lambda state: state == RConState.LOGGED_IN and logged_in.set())
+
+        async def run():
+            server.start_rcon('secret')
+
+            try:
+                await asyncio.wait_for(logged_in.wait(), 5)
+
+                self.assertEqual(await server.tab_complete('kick'), ['kick', 'kickfromgame'])
+
+                with self.assertRaises(TooManyCompletions) as e:
+                    await server.tab_complete('sv_')
+
+                self.assertEqual(e.exception.count, 16)
+
+                await index.refresh()
+            finally:
+                await server.stop_rcon()
+                server.close()
+
+        with mock.patch('commandindex.INDEX_REQUEST_INTERVAL', 0):
+            try:
+                asyncio.run(run())
+            finally:
+                fake.close()
+
+        self.assertEqual(sorted(index.complete('', limit=100)), sorted(COMMANDS))
+        self.assertEqual(index.complete('sv_cvar1'), ['sv_cvar1'] + [f'sv_cvar{i}' for i in range(10, 15)])
+        self.assertEqual(index.complete('s'), ['s', 'Say', 'sv_cvar'] + sorted(f'sv_cvar{i}' for i in range(15))[:22])
+
+        # Commands named like a prefix with too many completions
+        self.assertEqual(index.complete('sv_cvar', limit=2), ['sv_cvar', 'sv_cvar0'])
+        self.assertEqual(index.complete('s', limit=1), ['s'])
+        self.assertEqual(index.complete('+'), ['+attack'])
+        self.assertEqual(index.complete('-A'), ['-attack'])
+        self.assertEqual(index.complete('?'), ['?'])
+
+    def test_not_logged_in(self):
+        server = ZandronumServer('127.0.0.1', 10666)
+
+        with self.assertRaises(ConnectionError):
+            asyncio.run(server.tab_complete('map'))
+
+class FakeLauncher(asyncio.DatagramProtocol):
+    """
+    Answers launcher queries on the event loop with a fixed reply, if any.
+    reply can be a list of datagrams.
+    """
+
+    def __init__(self, reply: bytes | list = None):
+        self.reply = reply
+        self.queries = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.queries += 1
+
+        if self.reply is None:
+            return
+
+        for reply in self.reply if isinstance(self.reply, list) else [self.reply]:
+            self.transport.sendto(huffman.SKULLTAG_HUFFMAN.encode(reply), addr)
+
+async def fake_launchers(replies: list) -> list:
+    loop = asyncio.get_running_loop()
+    launchers = []
+
+    for reply in replies:
+        transport, launcher = await loop.create_datagram_endpoint(
+            lambda: FakeLauncher(reply), local_addr=('127.0.0.1', 0))
+        launcher.address = transport.get_extra_info('sockname')
+        launchers.append(launcher)
+
+    return launchers
+
+class TestFleet(unittest.TestCase):
+    def test_poll(self):
+        ignoring = zandronumserver.ServerLauncherResponse.IGNORING.to_bytes(4, 'little')
+        replies = [launcher_response(players=i % 8) for i in range(100)] + [None] * 5 + [ignoring] * 5
+
+        async def poll():
+            launchers = await fake_launchers(replies)
+            fleet = ZandronumFleet(timeout=0.5, rate=10000)
+            results = {}
+
+            try:
+                async for result in fleet.poll(launcher.address for launcher in launchers):
+                    results[result.address] = result
+            finally:
+                fleet.close()
+
+                for launcher in launchers:
+                    launcher.transport.close()
+
+            return launchers, results
+
+        launchers, results = asyncio.run(poll())
+
+        self.assertEqual(len(results), len(replies))
+
+        for i, launcher in enumerate(launchers):
+            result = results[launcher.address]
+
+            if i < 100:
+                self.assertIsNone(result.error)
+                self.assertEqual(result.flags, INFO_FLAGS)
+                self.assertEqual(result.info.numplayers, i % 8)
+            elif i < 105:
+                self.assertIsInstance(result.error, TimeoutError)
+            else:
+                self.assertIsInstance(result.error, ConnectionRefusedError)
+
+    def test_min_interval(self):
+        async def poll():
+            launchers = await fake_launchers([launcher_response()])
+            fleet = ZandronumFleet(timeout=0.5, min_interval=0.3)
+            loop = asyncio.get_running_loop()
+
+            try:
+                start = loop.time()
+
+                for i in range(2):
+                    async for result in fleet.poll([launchers[0].address]):
+                        self.assertIsNone(result.error)
+
+                return loop.time() - start
+            finally:
+                fleet.close()
+                launchers[0].transport.close()
+
+        self.assertGreaterEqual(asyncio.run(poll()), 0.3)
+
+def server_list_parts(addresses: list, per_part: int) -> list:
+    """Master server list parts, with one block per address."""
+    parts = []
+    count = (len(addresses) + per_part - 1) // per_part
+
+    for number in range(count):
+        data = struct.pack('<lB', MasterServerResponse.BEGINSERVERLISTPART, number)
+
+        for host, port in addresses[number * per_part:(number + 1) * per_part]:
+            data += struct.pack('<BB', MasterServerResponse.SERVERBLOCK, 1) + socket.inet_aton(host) + struct.pack('<H', port)
+            data += b'\x00'
+
+        last = MasterServerResponse.ENDSERVERLIST if number == count - 1 else MasterServerResponse.ENDSERVERLISTPART
+        parts.append(data + bytes([last]))
+
+    return parts
+
+class FakeMaster(asyncio.DatagramProtocol):
+    """Sends the server list parts in shuffled order, one of them twice."""
+
+    def __init__(self, parts: list):
+        self.parts = parts
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        parts = self.parts + self.parts[:1]
+        random.Random(666).shuffle(parts)
+
+        for part in parts:
+            self.transport.sendto(huffman.SKULLTAG_HUFFMAN.encode(part), addr)
+
+class TestMaster(unittest.TestCase):
+    def test_crawl(self):
+        async def crawl():
+            launchers = await fake_launchers([launcher_response(players=i % 4) for i in range(60)])
+            addresses = [launcher.address for launcher in launchers]
+
+            # Every server listed twice
+            transport, master = await asyncio.get_running_loop().create_datagram_endpoint(
+                lambda: FakeMaster(server_list_parts(addresses + addresses[::-1], 7)), local_addr=('127.0.0.1', 0))
+
+            fleet = ZandronumFleet(rate=10000)
+
+            try:
+                client = ZandronumMaster(*transport.get_extra_info('sockname'), timeout=1)
+
+                return addresses, await client.get_servers(), [result async for result in client.crawl(fleet)]
+            finally:
+                fleet.close()
+                transport.close()
+
+                for launcher in launchers:
+                    launcher.transport.close()
+
+        addresses, servers, results = asyncio.run(crawl())
+
+        self.assertEqual(sorted(servers), sorted(addresses))
+        self.assertEqual(sorted(result.address for result in results), sorted(addresses))
+        self.assertTrue(all(result.error is None for result in results))
+
+    def test_server_list_timeout(self):
+        async def servers():
+            transport, master = await asyncio.get_running_loop().create_datagram_endpoint(
+                lambda: FakeLauncher(), local_addr=('127.0.0.1', 0))
+
+            try:
+                return await ZandronumMaster(*transport.get_extra_info('sockname'), timeout=0.1).get_servers()
+            finally:
+                transport.close()
+
+        with self.assertRaises(TimeoutError):
+            asyncio.run(servers())
+
+class TestConfigStore(unittest.TestCase):
+    SERVER = '127.0.0.1:10666'
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.path = os.path.join(directory.name, 'config.json')
+
+    def read(self) -> dict:
+        with open(self.path, encoding='utf-8') as f:
+            return json.load(f)
+
+    def test_round_trip(self):
+        async def run():
+            store = ConfigStore(self.path)
+            await store.load()
+            store.update(1, self.SERVER, info_channel_id=10, info_message_id=11)
+            store.update(1, '127.0.0.1:10667', chat_channel_id=12)
+            store.update(2, self.SERVER, chat_webhook_url='https://example.com/webhook')
+            await store.close()
+
+            store = ConfigStore(self.path)
+            await store.load()
+            await store.close()
+            return store
+
+        store = asyncio.run(run())
+
+        self.assertEqual(store.get(1, self.SERVER), ServerSettings(info_channel_id=10, info_message_id=11))
+        self.assertEqual(store.get(1, '127.0.0.1:10667').chat_channel_id, 12)
+        self.assertEqual(store.get(3, self.SERVER), ServerSettings())
+        self.assertEqual([guild_id for guild_id, settings in store.guilds(self.SERVER)], [1, 2])
+        self.assertFalse(store.pending())
+
+    def test_unknown_setting(self):
+        with self.assertRaises(ValueError):
+            ConfigStore(self.path).update(1, self.SERVER, info_channel=10)
+
+    def test_batched(self):
+        async def run():
+            store = ConfigStore(self.path, flush_interval=0.05)
+            await store.load()
+            store.start()
+
+            with mock.patch.object(store, '_write', wraps=store._write) as write:
+                for i in range(100):
+                    store.update(1, self.SERVER, info_message_id=i)
+
+                # Nothing is written in the request path
+                self.assertFalse(os.path.exists(self.path))
+                await asyncio.sleep(0.2)
+                await store.close()
+
+                return write.call_count
+
+        self.assertEqual(asyncio.run(run()), 1)
+        self.assertEqual(self.read()['guilds']['1'][self.SERVER]['info_message_id'], 99)
+
+    def test_atomic_replace(self):
+        async def run():
+            store = ConfigStore(self.path)
+            await store.load()
+            store.update(1, self.SERVER, info_channel_id=10)
+            await store.flush()
+
+            with mock.patch('json.dump', side_effect=OSError('disk full')):
+                store.update(1, self.SERVER, info_channel_id=20)
+
+                with self.assertRaises(OSError):
+                    await store.flush()
+
+            # Still to be written, the next flush tries again
+            self.assertTrue(store.pending())
+            await store.close()
+
+        asyncio.run(run())
+
+        self.assertEqual(self.read()['guilds']['1'][self.SERVER]['info_channel_id'], 20)
+        self.assertEqual(os.listdir(self.directory), ['config.json'])
+
+    def test_legacy_config(self):
+        with open(self.path, 'w', encoding='utf-8') as f:
+            json.dump({'info-channel-id': 10, 'info-message-id': 11}, f)
+
+        async def run():
+            store = ConfigStore(self.path)
+            await store.load(1, self.SERVER)
+            await store.close()
+            return store
+
+        store = asyncio.run(run())
+
+        self.assertEqual(store.get(1, self.SERVER), ServerSettings(info_channel_id=10, info_message_id=11))
+        self.assertEqual(self.read()['version'], CONFIG_VERSION)
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,229 @@
+import time
+import asyncio
+import aiohttp
+from dataclasses import dataclass
+from metrics import METRICS, WEBHOOK_SECONDS
+from rconlog import ChatMessage, PlayerConnected, PlayerDisconnected, clean_nick
+
+# Seconds consecutive lines of one sender are collected into one message
+WEBHOOK_WINDOW = 0.5
+
+# Lines waiting to be sent, more are dropped instead of falling behind
+WEBHOOK_QUEUE_SIZE = 500
+
+# Longest message content Discord accepts
+WEBHOOK_MESSAGE_LIMIT = 2000
+
+# Avatar of players in the chat bridge
+PLAYER_AVATAR = 'https://sffempire.ru/bot/playeravatar.png'
+
+@dataclass
+class WebhookLine:
+    content: str
+    username: str = None
+    avatar_url: str = None
+    queued: float = 0.0 # time.monotonic() when it was queued
+
+    @property
+    def sender(self) -> tuple:
+        return self.username, self.avatar_url
+
+@dataclass
+class WebhookStats:
+    queued: int = 0
+    sent: int = 0 # lines
+    messages: int = 0 # requests which went through
+    dropped: int = 0 # lines that didn't fit in the queue
+    failed: int = 0 # lines lost to errors
+    delayed: int = 0 # messages held back by a rate limit
+    rate_limited: int = 0 # 429 responses
+    max_latency: float = 0.0 # seconds from queueing a line to sending it
+
+class WebhookSink:
+    """
+    Sends lines to a Discord webhook from a background task, without
+    blocking whoever calls send().  Consecutive lines of the same sender
+    within WEBHOOK_WINDOW are joined into one message, and the rate limit
+    Discord reports in its response headers is waited out before the next
+    request.
+
+        sink = WebhookSink(url)
+        sink.start()
+        sink.send('hello', username='Player')
+        ...
+        await sink.close()
+    """
+
+    def __init__(self, url: str, window: float = WEBHOOK_WINDOW, maxsize: int = WEBHOOK_QUEUE_SIZE,
+                 session: aiohttp.ClientSession = None):
+        self.url = url
+        self.window = window
+        self.stats = WebhookStats()
+
+        self._queue = asyncio.Queue(maxsize)
+        self._carry = None
+        self._session = session
+        self._own_session = session is None
+        self._task = None
+
+        # Requests left in the current rate limit bucket and when it resets
+        self._remaining = None
+        self._reset = 0.0
+
+    def depth(self) -> int:
+        """Lines waiting to be sent."""
+        return self._queue.qsize() + (self._carry is not None)
+
+    def send(self, content: str, username: str = None, avatar_url: str = None) -> bool:
+        """Queue a line.  Returns False if the queue is full and it was dropped."""
+        try:
+            line = WebhookLine(content[:WEBHOOK_MESSAGE_LIMIT], username, avatar_url, time.monotonic())
+            self._queue.put_nowait(line)
+        except asyncio.QueueFull:
+            self.stats.dropped += 1
+            return False
+
+        self.stats.queued += 1
+        return True
+
+    def start(self):
+        """Start sending on the running event loop."""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self, timeout: float = None):
+        """Send every queued line, or what can be sent within timeout seconds, then stop."""
+        if self._task and not self._task.done():
+            try:
+                await asyncio.wait_for(self._queue.join(), timeout)
+            except TimeoutError:
+                pass
+
+            self._task.cancel()
+
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+        self._task = None
+
+        if self._own_session and self._session:
+            await self._session.close()
+            self._session = None
+
+    async def _run(self):
+        if self._session is None:
+            self._session = aiohttp.ClientSession()
+
+        while True:
+            lines = await self._next_batch()
+
+            try:
+                await self._post(lines)
+            except Exception as e:
+                self.stats.failed += len(lines)
+                print(f'Failed to send webhook message: {e}')
+            finally:
+                for line in lines:
+                    self._queue.task_done()
+
+    async def _next_batch(self) -> list:
+        """Lines of the next message, all of them from one sender."""
+        loop = asyncio.get_running_loop()
+
+        first = self._carry or await self._queue.get()
+        self._carry = None
+
+        lines = [first]
+        size = len(first.content)
+        deadline = loop.time() + self.window
+
+        while True:
+            try:
+                line = self._queue.get_nowait()
+            except asyncio.QueueEmpty:
+                timeout = deadline - loop.time()
+
+                if timeout <= 0:
+                    break
+
+                try:
+                    line = await asyncio.wait_for(self._queue.get(), timeout)
+                except TimeoutError:
+                    break
+
+            # The next message starts with it
+            if line.sender != first.sender or size + 1 + len(line.content) > WEBHOOK_MESSAGE_LIMIT:
+                self._carry = line
+                break
+
+            lines.append(line)
+            size += 1 + len(line.content)
+
+        return lines
+
+    async def _post(self, lines: list):
+        first = lines[0]
+        payload = {'content': '\n'.join(line.content for line in lines)}
+
+        if first.username:
+            payload['username'] = first.username
+
+        if first.avatar_url:
+            payload['avatar_url'] = first.avatar_url
+
+        start = time.monotonic()
+
+        while True:
+            wait = self._reset - time.monotonic()
+
+            if self._remaining == 0 and wait > 0:
+                self.stats.delayed += 1
+                await asyncio.sleep(wait)
+
+            async with self._session.post(self.url, json=payload) as response:
+                self._update_limit(response.headers)
+
+                if response.status != 429:
+                    response.raise_for_status()
+                    break
+
+                self.stats.rate_limited += 1
+                data = await response.json(content_type=None)
+
+            await asyncio.sleep(float(data.get('retry_after', 1)))
+
+        now = time.monotonic()
+
+        if METRICS.enabled:
+            WEBHOOK_SECONDS.observe(now - start)
+
+        self.stats.sent += len(lines)
+        self.stats.messages += 1
+        self.stats.max_latency = max(self.stats.max_latency, now - first.queued)
+
+    def _update_limit(self, headers):
+        # https://discord.com/developers/docs/topics/rate-limits#header-format
+        if 'X-RateLimit-Remaining' in headers:
+            self._remaining = int(headers['X-RateLimit-Remaining'])
+
+        if 'X-RateLimit-Reset-After' in headers:
+            self._reset = time.monotonic() + float(headers['X-RateLimit-Reset-After'])
+
+def bridge_event(sink: WebhookSink, event) -> bool:
+    """
+    Send an RCon log event to the chat bridge, if it's one that shows up
+    there.  Returns whether it was queued.
+    """
+    match event:
+        case PlayerConnected(name):
+            return sink.send(content=f'**{clean_nick(name)}** has connected', username='Server')
+
+        case PlayerDisconnected(name):
+            return sink.send(content=f'**{clean_nick(name)}** has disconnected', username='Server')
+
+        case ChatMessage(nick, message) if nick != '<Server>':
+            return sink.send(content=message, username=clean_nick(nick), avatar_url=PLAYER_AVATAR)
+
+    return False
@@ -1,16 +1,39 @@
 import time
+import random
 import socket
 import struct
 import hashlib
 import asyncio
 from enum import IntEnum, IntFlag
 import huffman
-from bytereader import ByteReader
-from dataclasses import dataclass, field
+from bytereader import ByteReader, CheckedByteReader, LONG
+from dataclasses import dataclass, field, replace
+from functools import lru_cache
+from operator import methodcaller
+import collections
+from collections.abc import Sequence
 from typing import Tuple
+from serverstate import ServerSnapshot, diff
+from capture import PacketCapture, CaptureDirection
+from metrics import METRICS, RCON_PACKETS, LAUNCHER_SECONDS, LAUNCHER_ERRORS, huffman_encode, huffman_decode
 
 RCON_PROTOCOL_VERSION = 4
 
+# Seconds to wait for a launcher response, and between the PONGs which
+# keep an RCon session alive.
+LAUNCHER_TIMEOUT = 5
+RCON_KEEPALIVE = 5
+
+# Seconds to wait for logging in to RCon, and of RCon silence after which
+# the server is checked with a launcher query.
+RCON_LOGIN_TIMEOUT = 10
+RCON_LIVENESS = 30
+
+# Range of seconds between attempts to get a lost RCon session back, the
+# delay doubles with every failed attempt.
+RCON_BACKOFF_MIN = 1
+RCON_BACKOFF_MAX = 60
+
 # https://wiki.zandronum.com/Launcher_protocol#Query_flags
 class ServerQueryFlags(IntFlag):
     NAME                = 0x00000001
@@ -52,6 +75,18 @@ class ServerQueryFlags2(IntFlag):
     GAMEMODE_SHORTNAME = 0x00000008
     VOICECHAT          = 0x00000010
 
+# Seconds get_info() keeps sections of a launcher response before asking
+# the server again.  Sections which change during a match expire sooner
+# than the server's setup.
+INFO_TTL = {
+    ServerQueryFlags.MAPNAME:        5,
+    ServerQueryFlags.LIMITS:         5,
+    ServerQueryFlags.NUMPLAYERS:     5,
+    ServerQueryFlags.PLAYERDATA:     5,
+    ServerQueryFlags.TEAMINFO_SCORE: 5,
+}
+DEFAULT_INFO_TTL = 60
+
 # https://wiki.zandronum.com/Launcher_protocol#Challenge_packet
 class ServerLauncherResponse(IntEnum):
     CHALLENGE           = 5660023
@@ -71,11 +106,28 @@ class RConServerHeaders(IntEnum):
     TABCOMPLETE         = 39
     TOOMANYTABCOMPLETES = 40
 
+# Label of every header in the RCon packet metrics
+RCON_HEADER_NAMES = {header.value: header.name.lower() for header in RConServerHeaders}
+
 class RConServerUpdate(IntEnum):
     PLAYERDATA  = 0
     ADMINCOUNT  = 1
     MAP         = 2
 
+class TooManyCompletions(ValueError):
+    """Server has more completions for a prefix than it is willing to send."""
+
+    def __init__(self, prefix: str, count: int):
+        super().__init__(f'Too many completions for "{prefix}": {count}')
+        self.prefix = prefix
+        self.count = count
+
+class RConState(IntEnum):
+    DISCONNECTED = 0
+    CONNECTING   = 1
+    LOGGED_IN    = 2
+    RECONNECTING = 3
+
 class RConClientHeaders(IntEnum):
     BEGINCONNECTION = 52
     PASSWORD        = 53
@@ -84,6 +136,9 @@ class RConClientHeaders(IntEnum):
     DISCONNECT      = 56
     TABCOMPLETE     = 57
 
+# Written to capture files instead of the PASSWORD packet, without the hash
+REDACTED_PASSWORD = bytes([RConClientHeaders.PASSWORD]) + b'\x00'
+
 # https://wiki.zandronum.com/Launcher_protocol#Game_modes 
 class ZandronumGamemode(IntEnum):
     COOPERATIVE     = 0
@@ -103,6 +158,87 @@ class ZandronumGamemode(IntEnum):
     SKULLTAG        = 14
     DOMINATION      = 15
 
+# Game modes where players are on teams, the launcher protocol only sends
+# a player's team in these.
+TEAM_GAMEMODES = frozenset((
+    ZandronumGamemode.TEAMPLAY,
+    ZandronumGamemode.TEAMLMS,
+    ZandronumGamemode.TEAMPOSSESSION,
+    ZandronumGamemode.TEAMGAME,
+    ZandronumGamemode.CTF,
+    ZandronumGamemode.ONEFLAGCTF,
+    ZandronumGamemode.SKULLTAG,
+    ZandronumGamemode.DOMINATION,
+))
+
+LAUNCHER_RESPONSES = frozenset(ServerLauncherResponse)
+LAUNCHER_CHALLENGE = 199
+
+def launcher_query(flags: ServerQueryFlags) -> bytes:
+    """Launcher challenge asking for the sections in flags."""
+    return struct.pack("<lLl", LAUNCHER_CHALLENGE, flags, int(time.time()))
+
+def check_launcher_status(status: int):
+    if status == ServerLauncherResponse.BANNED:
+        LAUNCHER_ERRORS.inc('banned')
+        raise ConnectionRefusedError('Server banned you.')
+
+    if status == ServerLauncherResponse.IGNORING:
+        LAUNCHER_ERRORS.inc('ignoring')
+        raise ConnectionRefusedError('Server ignoring you.')
+
+class SegmentedResponse:
+    """
+    Reassembles a launcher response the server split into several
+    datagrams.  Segments can come in any order, each one is copied once
+    into a buffer of the size the server advertises, and reader() hands
+    the whole response to the parser without copying it again.  The
+    buffer starts with a CHALLENGE status, so it reads just like a
+    response that came in one piece.
+    """
+
+    def __init__(self):
+        self.buffer = None
+        self.segments = 0
+        self.received = set()
+
+    def add(self, res: ByteReader) -> bool:
+        """
+        Add a segment positioned right after its status.  Returns whether
+        the response is complete.
+        """
+        number = res.read_byte()
+        segments = res.read_byte()
+        offset = res.read_ushort()
+        size = res.read_ushort()
+        total = res.read_ushort()
+
+        if self.buffer is None:
+            self.buffer = bytearray(4 + total)
+            self.segments = segments
+            LONG.pack_into(self.buffer, 0, ServerLauncherResponse.CHALLENGE)
+        elif total != len(self.buffer) - 4 or segments != self.segments:
+            raise ValueError(f'Segment {number} belongs to another response')
+
+        if number >= segments or offset + size > total:
+            raise ValueError(f'Segment {number} of {segments} at {offset}+{size} is out of bounds of {total} bytes')
+
+        if size > res.remaining():
+            raise ValueError(f'Segment {number} is truncated')
+
+        # The server may send a segment twice
+        if number not in self.received:
+            self.buffer[4 + offset:4 + offset + size] = res.view[res.pos:res.pos + size]
+            self.received.add(number)
+
+        return len(self.received) == self.segments
+
+    def missing(self) -> list:
+        return [i for i in range(self.segments) if i not in self.received]
+
+    def reader(self) -> CheckedByteReader:
+        return CheckedByteReader(self.buffer)
+
 @dataclass
 class ZandronumTeam:
     name: str
@@ -133,23 +269,301 @@ class ZandronumPlayer:
     team: int = -1
     time: int = 0 # in minutes
 
-class ZandronumServer:
-    def __init__(self, hostname: str, port: int):
-        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self._sock.settimeout(5) # 5 seconds
-        self._hostname = hostname
-        self._port = port
+class ZandronumRecords(Sequence):
+    """
+    Read-only list of records which are decoded from the launcher
+    response only when they are accessed for the first time.
+    """
 
-        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
-        
-        self._handlers = {
-            'message': [],
-            'update': [],
-        }
+    def __init__(self, data, count: int):
+        self._data = data
+        self._items = [None] * count
+
+    def __len__(self):
+        return len(self._items)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self._items)))]
+
+        item = self._items[index]
 
-        self._huffman = huffman.HuffmanObject(huffman.SKULLTAG_FREQS)
+        if item is None:
+            item = self._items[index] = self._decode(index % len(self._items))
 
+        return item
+
+    def __eq__(self, other):
+        if isinstance(other, Sequence):
+            return list(self) == list(other)
+        return NotImplemented
+
+    def __repr__(self):
+        return repr(list(self))
+
+    def _reader(self, pos: int) -> ByteReader:
+        res = ByteReader(self._data)
+        res.seek(pos)
+        return res
+
+    def _decode(self, index: int):
+        raise NotImplementedError
+
+class ZandronumPlayers(ZandronumRecords):
+    # Everything in a player record after the name, with and without team
+    RECORD = struct.Struct('<hhBBB')
+    TEAM_RECORD = struct.Struct('<hhBBBB')
+
+    def __init__(self, data, offsets: list, teams: bool):
+        super().__init__(data, len(offsets))
+        self._offsets = offsets
+        self._teams = teams
+
+    def _decode(self, index: int) -> ZandronumPlayer:
+        pos = self._offsets[index]
+        end = self._data.find(b'\x00', pos)
+        name = self._data[pos:end].decode('utf-8', 'ignore')
+
+        if self._teams:
+            frags, ping, spectating, bot, team, time = self.TEAM_RECORD.unpack_from(self._data, end + 1)
+        else:
+            frags, ping, spectating, bot, time = self.RECORD.unpack_from(self._data, end + 1)
+            team = -1
+
+        return ZandronumPlayer(name, frags, ping, bool(spectating), bool(bot), team, time)
+
+class ZandronumTeams(ZandronumRecords):
+    def __init__(self, data, count: int):
+        super().__init__(data, count)
+        self.name_offsets = None
+        self.color_offset = None
+        self.score_offset = None
+
+    def _decode(self, index: int) -> ZandronumTeam:
+        team = ZandronumTeam(name='')
+
+        if self.name_offsets is not None:
+            team.name = self._reader(self.name_offsets[index]).read_string()
+
+        if self.color_offset is not None:
+            # Sent as 0xAARRGGBB, but the alpha is never set by the server
+            color = self._reader(self.color_offset + index * 4).read_ulong()
+            team.set_color((color >> 16) & 0xff, (color >> 8) & 0xff, color & 0xff)
+
+        if self.score_offset is not None:
+            team.score = self._reader(self.score_offset + index * 2).read_short()
+
+        return team
+
+def _parse_pwads(server, res: ByteReader):
+    server.pwads = [res.read_string() for i in range(res.read_byte())]
+
+def _parse_gametype(server, res: ByteReader):
+    server.gametype = ZandronumGamemode(res.read_byte())
+    server.instagib = bool(res.read_byte())
+    server.buckshot = bool(res.read_byte())
+
+def _parse_limits(server, res: ByteReader):
+    server.fraglimit = res.read_short()
+    server.timelimit = res.read_short()
+
+    if server.timelimit > 0:
+        server.timeleft = res.read_short()
+
+    server.duellimit = res.read_short()
+    server.pointlimit = res.read_short()
+    server.winlimit = res.read_short()
+
+def _parse_teamscores(server, res: ByteReader):
+    res.skip(4)
+
+def _parse_players(server, res: ByteReader):
+    # Only find where every player starts, the records are decoded when
+    # somebody looks at them.
+    teams = server.gametype in TEAM_GAMEMODES
+    size = (ZandronumPlayers.TEAM_RECORD if teams else ZandronumPlayers.RECORD).size
+    offsets = []
+
+    for i in range(server.numplayers):
+        offsets.append(res.tell())
+        res.skip_string()
+        res.skip(size)
+
+    server.players = ZandronumPlayers(res.data, offsets, teams)
+
+def _parse_team_number(server, res: ByteReader):
+    server.numteams = res.read_byte()
+    server.teams = ZandronumTeams(res.data, server.numteams)
+
+def _response_teams(server, res: ByteReader) -> ZandronumTeams:
+    if not isinstance(server.teams, ZandronumTeams) or server.teams._data is not res.data:
+        server.teams = ZandronumTeams(res.data, server.numteams)
+
+    return server.teams
+
+def _parse_team_names(server, res: ByteReader):
+    teams = _response_teams(server, res)
+    teams.name_offsets = []
+
+    for i in range(len(teams)):
+        teams.name_offsets.append(res.tell())
+        res.skip_string()
+
+def _parse_team_colors(server, res: ByteReader):
+    teams = _response_teams(server, res)
+    teams.color_offset = res.tell()
+    res.skip(len(teams) * 4)
+
+def _parse_team_scores(server, res: ByteReader):
+    teams = _response_teams(server, res)
+    teams.score_offset = res.tell()
+    res.skip(len(teams) * 2)
+
+def _parse_testing(server, res: ByteReader):
+    server.testing = bool(res.read_byte())
+    res.skip_string() # Testing binary archive
+
+def _parse_all_dmflags(server, res: ByteReader):
+    n = res.read_byte()
+
+    for i, name in enumerate(('dmflags', 'dmflags2', 'zadmflags', 'compatflags', 'zacompatflags', 'compatflags2')):
+        if i < n:
+            setattr(server, name, res.read_long())
+
+    # Flags this version doesn't know about yet
+    if n > 6:
+        res.skip((n - 6) * 4)
+
+def _parse_optional_wads(server, res: ByteReader):
+    server.optional_wads = [res.read_byte() for i in range(res.read_byte())]
+
+def _parse_deh(server, res: ByteReader):
+    server.deh = [res.read_string() for i in range(res.read_byte())]
+
+_string = methodcaller('read_string')
+_byte = methodcaller('read_byte')
+_long = methodcaller('read_long')
+_float = methodcaller('read_float')
+
+def _bool(res: ByteReader) -> bool:
+    return bool(res.read_byte())
+
+# https://wiki.zandronum.com/Launcher_protocol#Response
+# Sections of a launcher response in the order the server sends them.
+# A section is either a list of (attribute, read) fields, or a function
+# parsing it into the server for anything more involved than that.
+INFO_SECTIONS = (
+    (ServerQueryFlags.NAME,              (('name', _string),)),
+    (ServerQueryFlags.URL,               (('url', _string),)),
+    (ServerQueryFlags.EMAIL,             (('email', _string),)),
+    (ServerQueryFlags.MAPNAME,           (('mapname', _string),)),
+    (ServerQueryFlags.MAXCLIENTS,        (('maxclients', _byte),)),
+    (ServerQueryFlags.MAXPLAYERS,        (('maxplayers', _byte),)),
+    (ServerQueryFlags.PWADS,             _parse_pwads),
+    (ServerQueryFlags.GAMETYPE,          _parse_gametype),
+    (ServerQueryFlags.GAMENAME,          (('gamename', _string),)),
+    (ServerQueryFlags.IWAD,              (('iwad', _string),)),
+    (ServerQueryFlags.FORCEPASSWORD,     (('forcepassword', _bool),)),
+    (ServerQueryFlags.FORCEJOINPASSWORD, (('forcejoinpassword', _bool),)),
+    (ServerQueryFlags.GAMESKILL,         (('skill', _byte),)),
+    (ServerQueryFlags.BOTSKILL,          (('botskill', _byte),)),
+    (ServerQueryFlags.DMFLAGS,           (('dmflags', _long), ('dmflags2', _long), ('compatflags', _long))),
+    (ServerQueryFlags.LIMITS,            _parse_limits),
+    (ServerQueryFlags.TEAMDAMAGE,        (('teamdamage', _float),)),
+    (ServerQueryFlags.TEAMSCORES,        _parse_teamscores),
+    (ServerQueryFlags.NUMPLAYERS,        (('numplayers', _byte),)),
+    (ServerQueryFlags.PLAYERDATA,        _parse_players),
+    (ServerQueryFlags.TEAMINFO_NUMBER,   _parse_team_number),
+    (ServerQueryFlags.TEAMINFO_NAME,     _parse_team_names),
+    (ServerQueryFlags.TEAMINFO_COLOR,    _parse_team_colors),
+    (ServerQueryFlags.TEAMINFO_SCORE,    _parse_team_scores),
+    (ServerQueryFlags.TESTING_SERVER,    _parse_testing),
+    (ServerQueryFlags.DATA_MD5SUM,       (('md5sum', _string),)),
+    (ServerQueryFlags.ALL_DMFLAGS,       _parse_all_dmflags),
+    (ServerQueryFlags.SECURITY_SETTINGS, (('security_settings', _bool),)),
+    (ServerQueryFlags.OPTIONAL_WADS,     _parse_optional_wads),
+    (ServerQueryFlags.DEH,               _parse_deh),
+)
+
+@lru_cache(maxsize=64)
+def _info_sections(flags: int) -> tuple:
+    """Sections present in a response with the given flags."""
+    return tuple(section for flag, section in INFO_SECTIONS if flags & flag)
+
+class ZandronumProtocol(asyncio.DatagramProtocol):
+    """
+    Receives datagrams from the server on the event loop, decodes them
+    and sorts them into launcher responses and RCon packets.  One is
+    created for every connection, so its queues always belong to the
+    loop the connection was opened in.
+    """
+
+    def __init__(self, huffman_object: huffman.HuffmanObject, capture: PacketCapture = None):
+        self._huffman = huffman_object
+        self.capture = capture
+        self.transport = None
+        self.connected = asyncio.get_running_loop().create_future()
+        self.closed = False
+        self.launcher = asyncio.Queue()
+        self.rcon = asyncio.Queue()
+
+        # Launcher queries take turns, a reply is always for the query
+        # waiting for it.
+        self.launcher_lock = asyncio.Lock()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.connected.set_result(None)
+
+    def connection_lost(self, exc):
+        self.closed = True
+
+    def datagram_received(self, data, addr):
+        if self.capture:
+            self.capture.write(CaptureDirection.RECEIVED, data)
+
+        try:
+            data = huffman_decode(self._huffman, data)
+        except (ValueError, IndexError) as e:
+            print(f'Dropped malformed packet from {addr}: {e}')
+            return
+
+        if len(data) >= 4 and LONG.unpack_from(data)[0] in LAUNCHER_RESPONSES:
+            self.launcher.put_nowait(CheckedByteReader(data))
+        else:
+            self.rcon.put_nowait(CheckedByteReader(data))
+
+    def error_received(self, exc):
+        # Wake up whoever is waiting, there is no way to tell which of
+        # them the error belongs to.
+        error = ConnectionError(f'Could not receive data from server. Error: {exc}')
+        self.launcher.put_nowait(error)
+        self.rcon.put_nowait(error)
+
+    def drain_launcher(self):
+        """Drop replies which came in after their query gave up."""
+        while not self.launcher.empty():
+            self.launcher.get_nowait()
+
+    @staticmethod
+    async def get(queue: asyncio.Queue, timeout: float) -> ByteReader:
+        try:
+            res = await asyncio.wait_for(queue.get(), timeout)
+        except TimeoutError:
+            raise TimeoutError('Connection timed out while waiting for response from server.')
+
+        if isinstance(res, Exception):
+            raise res
+
+        return res
+
+class ZandronumInfo:
+    """
+    What a launcher response says about a server.  ZandronumServer keeps
+    it up to date for one server, the fleet poller keeps one per target.
+    """
+
+    def __init__(self):
         # Initialize all attributes
         self.version = ''
         self.name = ''
@@ -186,197 +600,291 @@ class ZandronumServer:
         self.numteams = 0
         self.teams = []
         self.testing = False
+        self.md5sum = ''
+        self.security_settings = False
+        self.optional_wads = []
         self.deh = []
-    
+
+    def parse_info(self, res: ByteReader) -> ServerQueryFlags:
+        """Parse a launcher response positioned right after its status."""
+        send_time = res.read_ulong()
+
+        self.version = res.read_string()
+        res_flags = res.read_ulong()
+
+        for section in _info_sections(res_flags):
+            if callable(section):
+                section(self, res)
+            else:
+                for name, read in section:
+                    setattr(self, name, read(res))
+
+        return ServerQueryFlags(res_flags)
+
+    def get_player(self, username: str):
+        return next((p for p in self.players if p.name == username), None)
+
+class ZandronumServer(ZandronumInfo):
+    def __init__(self, hostname: str, port: int):
+        super().__init__()
+
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._sock.setblocking(False)
+        self._hostname = hostname
+        self._port = port
+
+        # Event loop side of the socket, opened by connect()
+        self._protocol = None
+        self._loop = None
+        self._loop_sock = None
+
+        # Cache of launcher responses for get_info(), when every section
+        # was last received and the query all callers are waiting for
+        self.info_ttl = dict(INFO_TTL)
+        self._info_times = [-float('inf')] * 32
+        self._info_query = None
+        self._info_query_flags = 0
+
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        
+        # What was known about the server the last time it changed, the
+        # 'change' listeners get the events between two snapshots.
+        self.snapshot = None
+
+        # time.monotonic() of the last RCon packet
+        self.rcon_time = -float('inf')
+
+        # RCon session kept up by start_rcon(), 'rcon_state' listeners
+        # hear about every change of rcon_state.
+        self.rcon_state = RConState.DISCONNECTED
+        self.rcon_reconnects = 0
+        self._rcon_task = None
+
+        # Prefixes of tab_complete() calls waiting for their answers, the
+        # server answers them in order.
+        self._tab_completes = collections.deque()
+
+        # Every datagram sent and received, while start_capture() is on
+        self._capture = None
+
+        self._handlers = {
+            'message': [],
+            'update': [],
+            'change': [],
+            'rcon_state': [],
+        }
+
+        self._huffman = huffman.SKULLTAG_HUFFMAN
+
     def __del__(self):
+        self.close()
+        self.stop_capture()
         self._sock.close()
 
+    async def connect(self):
+        """
+        Start receiving datagrams on the running event loop.  Called by
+        everything that waits for the server, so there is usually no need
+        to call it directly.
+        """
+        loop = asyncio.get_running_loop()
+
+        if self._protocol and not self._protocol.closed and self._loop is loop:
+            await self._protocol.connected
+            return
+
+        self.close()
+
+        # The transport gets its own handle to the socket so that closing
+        # it leaves the socket, and its port, to _send() and later loops.
+        # The protocol is stored before waiting for the transport, so
+        # concurrent callers wait for this connection instead of opening
+        # one of their own.
+        self._loop = loop
+        self._loop_sock = self._sock.dup()
+        self._protocol = protocol = ZandronumProtocol(self._huffman, self._capture)
+
+        await loop.create_datagram_endpoint(lambda: protocol, sock=self._loop_sock)
+
+    def close(self):
+        """Stop receiving datagrams on the event loop."""
+        if self._protocol:
+            # A finished asyncio.run() leaves the transport behind with
+            # its loop, it can only be closed while the loop is alive.
+            if self._protocol.transport and not self._loop.is_closed():
+                self._protocol.transport.close()
+            else:
+                self._loop_sock.close()
+
+            self._protocol.closed = True
+            self._protocol = None
+            self._loop = None
+            self._loop_sock = None
+
     def _send(self, data: bytes) -> int:
-        return self._sock.sendto(self._huffman.encode(data), (self._hostname, self._port))
+        encoded = huffman_encode(self._huffman, data)
 
-    def _recv(self, bufsize: int) -> ByteReader:
-        try:
-            data, _ = self._sock.recvfrom(bufsize)
-        except socket.timeout:
-            raise TimeoutError('Connection timed out while waiting for response from server.')
-        except socket.error as e:
-            raise ConnectionError(f'Could not receive data from server. Error: {e}')
+        if self._capture:
+            # The salted password hash stays out of the file
+            if data[0] == RConClientHeaders.PASSWORD:
+                self._capture.write(CaptureDirection.SENT, self._huffman.encode(REDACTED_PASSWORD))
+            else:
+                self._capture.write(CaptureDirection.SENT, encoded)
 
-        return ByteReader(self._huffman.decode(data))
+        return self._sock.sendto(encoded, (self._hostname, self._port))
 
-    def update_info(self, flags: ServerQueryFlags = 0xFFFFFFFF) -> ServerQueryFlags:
-        cur_time = int(time.time())
-        
-        self._send(struct.pack("<lLl", 199, flags, cur_time))
+    def start_capture(self, path: str):
+        """Append every datagram sent and received to the capture file at path."""
+        self.stop_capture()
+        self._capture = PacketCapture(path)
 
-        res = self._recv(1024)
+        if self._protocol:
+            self._protocol.capture = self._capture
 
-        if res.remaining() < 4:
-            raise ValueError("Received empty response")
-    
-        status = res.read_long()
-
-        # UNTESTED CODE
-        if status == ServerLauncherResponse.CHALLENGE_SEGMENTED:
-            segments = {}
-
-            while True:
-                seg_number = res.read_byte()
-                seg_total = res.read_byte()
-                offset = res.read_short()
-                size = res.read_short()
-                total = res.read_short()
-
-                segments[seg_number] = res.read_bytes(size)
-
-                if len(segments) == seg_total:
-                    res = b''.join(segments[i] for i in sorted(segments))
-                    break
-                
-                res, _ = self._sock.recvfrom(1024)
-                res = ByteReader(self._huffman.decode(res))
-                status = res.read_long()
+    def stop_capture(self):
+        if self._capture:
+            self._capture.close()
+            self._capture = None
 
-                if status != ServerLauncherResponse.CHALLENGE_SEGMENTED:
-                    raise ValueError("Unexpected packet")
-        
-        if status == ServerLauncherResponse.BANNED:
-            raise ConnectionRefusedError('Server banned you.')
-    
-        if status == ServerLauncherResponse.IGNORING:
-            raise ConnectionRefusedError('Server ignoring you.')
+        if self._protocol:
+            self._protocol.capture = None
 
-        send_time = res.read_ulong()
+    async def query_info(self, flags: ServerQueryFlags = 0xFFFFFFFF) -> ServerQueryFlags:
+        """Ask the server for the sections in flags and parse its response."""
+        await self.connect()
 
-        self.version = res.read_string()
-        res_flags = res.read_long()
+        protocol = self._protocol
+        loop = asyncio.get_running_loop()
 
-        if res_flags & ServerQueryFlags.NAME:
-            self.name = res.read_string()
-        
-        if res_flags & ServerQueryFlags.URL:
-            self.url = res.read_string()
+        async with protocol.launcher_lock:
+            start = loop.time()
+            deadline = start + LAUNCHER_TIMEOUT
 
-        if res_flags & ServerQueryFlags.EMAIL:
-            self.email = res.read_string()
-        
-        if res_flags & ServerQueryFlags.MAPNAME:
-            self.mapname = res.read_string()
-        
-        if res_flags & ServerQueryFlags.MAXCLIENTS:
-            self.maxclients = res.read_byte()
+            protocol.drain_launcher()
+            self._send(launcher_query(flags))
+
+            try:
+                res = await protocol.get(protocol.launcher, LAUNCHER_TIMEOUT)
+            except TimeoutError:
+                LAUNCHER_ERRORS.inc('timeout')
+                raise
 
-        if res_flags & ServerQueryFlags.MAXPLAYERS:
-            self.maxplayers = res.read_byte()
+            if res.remaining() < 4:
+                raise ValueError("Received empty response")
 
-        if res_flags & ServerQueryFlags.PWADS:
-            n = res.read_byte()
-            self.pwads.clear()
+            status = res.read_long()
 
-            for i in range(n):
-                self.pwads.append(res.read_string())
-        
-        if res_flags & ServerQueryFlags.GAMETYPE:
-            self.gametype = ZandronumGamemode(res.read_byte())
-            self.instagib = res.read_byte()
-            self.buckshot = res.read_byte()
-        
-        if res_flags & ServerQueryFlags.GAMENAME:
-            self.gamename = res.read_string()
+            if status == ServerLauncherResponse.CHALLENGE_SEGMENTED:
+                segments = SegmentedResponse()
 
-        if res_flags & ServerQueryFlags.IWAD:
-            self.iwad = res.read_string()
+                # Every segment has to arrive before the deadline of the query
+                while not segments.add(res):
+                    try:
+                        res = await protocol.get(protocol.launcher, max(deadline - loop.time(), 0))
+                    except TimeoutError:
+                        LAUNCHER_ERRORS.inc('timeout')
+                        raise TimeoutError(f'Connection timed out while waiting for segments {segments.missing()} of response from server.')
 
-        if res_flags & ServerQueryFlags.FORCEPASSWORD:
-            self.forcepassword = res.read_byte()
+                    if res.read_long() != ServerLauncherResponse.CHALLENGE_SEGMENTED:
+                        raise ValueError("Unexpected packet")
 
-        if res_flags & ServerQueryFlags.FORCEJOINPASSWORD:
-            self.forcejoinpassword = res.read_byte()
+                res = segments.reader()
+                status = res.read_long()
 
-        if res_flags & ServerQueryFlags.GAMESKILL:
-            self.skill = res.read_byte()
+        if METRICS.enabled:
+            LAUNCHER_SECONDS.observe(loop.time() - start, 'server')
 
-        if res_flags & ServerQueryFlags.BOTSKILL:
-            self.skill = res.read_byte()
+        check_launcher_status(status)
 
-        if res_flags & ServerQueryFlags.DMFLAGS:
-            self.dmflags = res.read_long()
-            self.dmflags2 = res.read_long()
-            self.compatflags = res.read_long()
-        
-        if res_flags & ServerQueryFlags.LIMITS:
-            self.fraglimit = res.read_short()
-            self.timelimit = res.read_short()
-            
-            if self.timelimit > 0:
-                self.timeleft = res.read_short()
+        res_flags = self.parse_info(res)
+        await self._set_snapshot(self._info_snapshot(res_flags))
 
-            self.duellimit = res.read_short()
-            self.pointlimit = res.read_short()
-            self.winlimit = res.read_short()
+        return res_flags
 
-        if res_flags & ServerQueryFlags.TEAMDAMAGE:
-            self.teamdamage = res.read_float()
+    def _info_snapshot(self, flags: int) -> ServerSnapshot:
+        """
+        Snapshot after parsing a response with the sections in flags.  The
+        players are only in responses with PLAYERDATA, without it the list
+        parsed before is stale, and those of the last snapshot are kept.
+        """
+        if self.snapshot is None or flags & ServerQueryFlags.PLAYERDATA:
+            return ServerSnapshot.from_info(self)
 
-        if res_flags & ServerQueryFlags.TEAMSCORES:
-            res.read_short()
-            res.read_short()
+        return ServerSnapshot.from_info(self, self.snapshot.players)
 
-        if res_flags & ServerQueryFlags.NUMPLAYERS:
-            self.numplayers = res.read_byte()
+    async def _set_snapshot(self, snapshot: ServerSnapshot):
+        old, self.snapshot = self.snapshot, snapshot
 
-        if res_flags & ServerQueryFlags.PLAYERDATA:
-            self.players.clear()
+        for event in diff(old, snapshot):
+            await self._trigger('change', event)
 
-            for i in range(self.numplayers):
-                player = ZandronumPlayer(name=res.read_string())
+    def _stale_info(self, flags: int, max_age: float = None) -> int:
+        """Sections in flags which are older than max_age or their TTL."""
+        now = time.monotonic()
+        stale = 0
 
-                player.frags = res.read_short()
-                player.ping = res.read_short()
-                player.spectating = res.read_byte()
-                player.bot = res.read_byte()
-                player.team = res.read_byte()
-                player.time = res.read_byte()
+        for i in range(32):
+            flag = 1 << i
 
-                self.players.append(player)
-        
-        if res_flags & ServerQueryFlags.TEAMINFO_NUMBER:
-            self.numteams = res.read_byte()
+            if flags & flag:
+                ttl = self.info_ttl.get(flag, DEFAULT_INFO_TTL) if max_age is None else max_age
 
-        if res_flags & ServerQueryFlags.TEAMINFO_NAME:
-            for i in range(self.numteams):
-                self.teams[i].name = res.read_string()
+                if now - self._info_times[i] >= ttl:
+                    stale |= flag
 
-        if res_flags & ServerQueryFlags.TEAMINFO_COLOR:
-            for i in range(self.numteams):
-                self.teams[i].color = struct.unpack("<BBBB", res.read_long())
-        
-        if res_flags & ServerQueryFlags.TEAMINFO_NAME:
-            for i in range(self.numteams):
-                self.teams[i].name = res.read_short()
-
-        if res_flags & ServerQueryFlags.TESTING_SERVER:
-            self.testing = res.read_byte()
-            res.read_string()
-
-        if res_flags & ServerQueryFlags.ALL_DMFLAGS:
-            n = res.read_byte()
-
-            if n > 0:
-                self.dmflags = res.read_long()
-            if n > 1:
-                self.dmflags2 = res.read_long()
-            if n > 3:
-                self.zadmflags = res.read_long()
-            if n > 4:
-                self.compatflags = res.read_long()
-            if n > 5:
-                self.zacompatflags = res.read_long()
-            if n > 6:
-                self.compatflags2 = res.read_long()
+        return stale
+
+    async def _refresh_info(self, flags: int) -> ServerQueryFlags:
+        res_flags = await self.query_info(flags)
+        now = time.monotonic()
+
+        # Sections the server left out count as fresh too, otherwise they
+        # would be asked for again on every call.
+        for i in range(32):
+            if flags & (1 << i):
+                self._info_times[i] = now
 
         return res_flags
-    
+
+    async def get_info(self, flags: ServerQueryFlags = 0xFFFFFFFF, max_age: float = None) -> ServerQueryFlags:
+        """
+        Make sure the sections in flags are fresh, querying the server only
+        for the ones older than their TTL in info_ttl (or max_age, if given).
+        Concurrent callers share a single query, so a burst of commands
+        sends one datagram and doesn't get us ignored by the server.
+        """
+        while True:
+            stale = self._stale_info(flags, max_age)
+
+            if not stale:
+                return ServerQueryFlags(flags)
+
+            query = self._info_query
+
+            if query is None or query.done() or query.get_loop() is not asyncio.get_running_loop():
+                query = self._info_query = asyncio.ensure_future(self._refresh_info(stale))
+                self._info_query_flags = stale
+
+            covered = self._info_query_flags & stale == stale
+
+            # Shielded, so a caller giving up doesn't cancel the query for
+            # everybody else waiting on it.
+            await asyncio.shield(query)
+
+            if covered:
+                return ServerQueryFlags(flags)
+
+    def update_info(self, flags: ServerQueryFlags = 0xFFFFFFFF) -> ServerQueryFlags:
+        """Blocking query_info() for code that isn't running an event loop."""
+        async def query():
+            try:
+                return await self.query_info(flags)
+            finally:
+                self.close()
+
+        return asyncio.run(query())
+
     def message(self, func):
         self.add_listener('message', func)
         return func
@@ -384,6 +892,10 @@ class ZandronumServer:
     def update(self, func):
         self.add_listener('update', func)
         return func
+
+    def change(self, func):
+        self.add_listener('change', func)
+        return func
     
     def add_listener(self, type, func):
         if type not in self._handlers:
@@ -410,86 +922,233 @@ class ZandronumServer:
                 handler(*args, **kwargs)
 
     async def _rcon_runner(self, password: str):
+        """Keep an RCon session up, logging in again whenever it's lost."""
+        await self.connect()
+        connection = self._protocol
+        backoff = RCON_BACKOFF_MIN
+
+        while not connection.closed:
+            try:
+                await self._rcon_session(connection, password)
+            except Exception as e:
+                print(f'RCon session lost: {e}')
+
+            if connection.closed:
+                break
+
+            # Sessions which made it to logging in start over from the
+            # shortest delay.
+            if self.rcon_state == RConState.LOGGED_IN:
+                backoff = RCON_BACKOFF_MIN
+
+            await self._set_rcon_state(RConState.RECONNECTING)
+            self.rcon_reconnects += 1
+
+            delay = backoff * random.uniform(0.5, 1)
+            backoff = min(backoff * 2, RCON_BACKOFF_MAX)
+
+            print(f'Reconnecting to RCon in {delay:.1f} seconds')
+            await asyncio.sleep(delay)
+
+        await self._set_rcon_state(RConState.DISCONNECTED)
+
+    async def _rcon_session(self, connection: ZandronumProtocol, password: str):
+        """Log in and handle RCon packets until the session is lost."""
+        loop = asyncio.get_running_loop()
+
+        # Left over from the last session
+        while not connection.rcon.empty():
+            connection.rcon.get_nowait()
+
+        await self._set_rcon_state(RConState.CONNECTING)
+
         self.disconnect_rcon()
         self._send(struct.pack('<bb', RConClientHeaders.BEGINCONNECTION, RCON_PROTOCOL_VERSION))
         print('Sent begin connection packet')
 
-        while True:
-            try:
-                res = await asyncio.to_thread(self._recv, 4096)
-                status = res.read_byte()
-
-                print(f'Received packet {status}')
-
-                match status:
-                    case RConServerHeaders.BANNED:
-                        raise ConnectionRefusedError('You\'re banned by this server!')
-
-                    case RConServerHeaders.OLDPROTOCOL:
-                        protocol = res.read_byte()
-                        version = res.read_string()
-
-                        raise ConnectionRefusedError(
-                            f'Protocol version ({RCON_PROTOCOL_VERSION}) is too old!',
-                            f'Server protocol: {protocol}. Server version: {version}.'
-                        )
-                    
-                    case RConServerHeaders.SALT:
-                        salt = res.read_bytes(32)
-                        hash = hashlib.md5(salt + password.encode()).hexdigest()
-
-                        self._send(struct.pack('<b', RConClientHeaders.PASSWORD) + hash.encode())
-
-                        print('Sent password to server')
-
-                    case RConServerHeaders.LOGGEDIN:
-                        protocol = res.read_byte()
-                        hostname = res.read_string()
-                        print(f'Logged in {hostname}! Server protocol: {protocol}')
-                    
-                    case RConServerHeaders.INVALIDPASSWORD:
-                        raise ConnectionRefusedError('Invalid RCon password!')
-
-                    case RConServerHeaders.MESSAGE:
-                        msg = res.read_string()
-                        await self._trigger('message', msg)
-                    
-                    case RConServerHeaders.UPDATE:
-                        update = res.read_byte()
-                        value = []
-
-                        match update:
-                            case RConServerUpdate.PLAYERDATA:
-                                self.numplayers = res.read_byte()
-                                
-                                for i in range(self.numplayers):
-                                    value.append(res.read_string())
-
-                            case RConServerUpdate.ADMINCOUNT:
-                                value = res.read_byte()
-                                
-                            case RConServerUpdate.MAP:
-                                self.mapname = value = res.read_string()
-                                
-                        await self._trigger('update', RConServerUpdate(update), value)
-            except socket.timeout:
+        login_deadline = loop.time() + RCON_LOGIN_TIMEOUT
+        next_pong = loop.time() + RCON_KEEPALIVE
+        last_packet = loop.time()
+
+        while not connection.closed:
+            now = loop.time()
+
+            if self.rcon_state == RConState.LOGGED_IN:
+                # The server drops sessions it hears nothing from
+                if now >= next_pong:
                     self._send(struct.pack('<b', RConClientHeaders.PONG))
+                    next_pong = now + RCON_KEEPALIVE
+
+                # It never answers a PONG, so a quiet session is only
+                # known to be alive if the server answers a launcher query.
+                if now - last_packet >= RCON_LIVENESS:
+                    await self.get_info(ServerQueryFlags.NUMPLAYERS, max_age=0)
+                    last_packet = loop.time()
+                    continue
+
+                wait = min(next_pong, last_packet + RCON_LIVENESS) - now
+            elif now >= login_deadline:
+                raise TimeoutError('Connection timed out while logging in to RCon.')
+            else:
+                wait = login_deadline - now
+
+            try:
+                res = await connection.get(connection.rcon, wait)
+            except TimeoutError:
+                continue
+
+            last_packet = loop.time()
+            self.rcon_time = time.monotonic()
+
+            try:
+                await self._handle_rcon(res, password)
+            except ConnectionRefusedError:
+                raise
             except Exception as e:
                 print(f'Error: {e}')
 
+    async def _handle_rcon(self, res: ByteReader, password: str):
+        status = res.read_byte()
+
+        print(f'Received packet {status}')
+
+        if METRICS.enabled:
+            RCON_PACKETS.inc(RCON_HEADER_NAMES.get(status, str(status)))
+
+        match status:
+            case RConServerHeaders.BANNED:
+                raise ConnectionRefusedError('You\'re banned by this server!')
+
+            case RConServerHeaders.OLDPROTOCOL:
+                protocol = res.read_byte()
+                version = res.read_string()
+
+                raise ConnectionRefusedError(
+                    f'Protocol version ({RCON_PROTOCOL_VERSION}) is too old!',
+                    f'Server protocol: {protocol}. Server version: {version}.'
+                )
+            
+            case RConServerHeaders.SALT:
+                salt = res.read_bytes(32)
+                hash = hashlib.md5(salt + password.encode()).hexdigest()
+
+                self._send(struct.pack('<b', RConClientHeaders.PASSWORD) + hash.encode())
+
+                print('Sent password to server')
+
+            case RConServerHeaders.LOGGEDIN:
+                protocol = res.read_byte()
+                hostname = res.read_string()
+                print(f'Logged in {hostname}! Server protocol: {protocol}')
+
+                await self._set_rcon_state(RConState.LOGGED_IN)
+            
+            case RConServerHeaders.INVALIDPASSWORD:
+                raise ConnectionRefusedError('Invalid RCon password!')
+
+            case RConServerHeaders.MESSAGE:
+                msg = res.read_string()
+                await self._trigger('message', msg)
+
+            case RConServerHeaders.TABCOMPLETE:
+                completions = [res.read_string() for i in range(res.read_byte())]
+                self._complete_tab(completions)
+
+            case RConServerHeaders.TOOMANYTABCOMPLETES:
+                count = res.read_short()
+                self._complete_tab(count=count)
+            
+            case RConServerHeaders.UPDATE:
+                update = res.read_byte()
+                value = []
+                snapshot = self.snapshot or ServerSnapshot.from_info(self)
+
+                match update:
+                    case RConServerUpdate.PLAYERDATA:
+                        self.numplayers = res.read_byte()
+                        
+                        for i in range(self.numplayers):
+                            value.append(res.read_string())
+
+                        snapshot = snapshot.with_player_names(value)
+
+                    case RConServerUpdate.ADMINCOUNT:
+                        value = res.read_byte()
+                        
+                    case RConServerUpdate.MAP:
+                        self.mapname = value = res.read_string()
+                        snapshot = replace(snapshot, mapname=value)
+                        
+                await self._trigger('update', RConServerUpdate(update), value)
+                await self._set_snapshot(snapshot)
+
+    async def _set_rcon_state(self, state: RConState):
+        if state != self.rcon_state:
+            self.rcon_state = state
+            await self._trigger('rcon_state', state)
+
     def start_rcon(self, password: str):
-        asyncio.create_task(self._rcon_runner(password))
+        if self._rcon_task is None or self._rcon_task.done():
+            self._rcon_task = asyncio.create_task(self._rcon_runner(password))
 
     def run_rcon(self, password: str):
         asyncio.run(self._rcon_runner(password))
 
+    async def stop_rcon(self):
+        """End the session started by start_rcon()."""
+        if self._rcon_task:
+            self._rcon_task.cancel()
+
+            try:
+                await self._rcon_task
+            except asyncio.CancelledError:
+                pass
+
+            self._rcon_task = None
+            self.disconnect_rcon()
+            await self._set_rcon_state(RConState.DISCONNECTED)
+
     def disconnect_rcon(self):
         self._send(struct.pack('<b', RConClientHeaders.DISCONNECT))
 
+    def _complete_tab(self, completions: list = None, count: int = 0):
+        # Answers come in order, but one for a call which timed out may
+        # still come late, so completions go to the first call they fit.
+        for entry in self._tab_completes:
+            prefix, future = entry
+
+            if completions is None:
+                future.set_exception(TooManyCompletions(prefix, count))
+            elif all(c.lower().startswith(prefix.lower()) for c in completions):
+                future.set_result(completions)
+            else:
+                continue
+
+            self._tab_completes.remove(entry)
+            return
+
+    async def tab_complete(self, prefix: str) -> list:
+        """
+        Console commands and cvars starting with prefix, as the server
+        completes them.  Raises TooManyCompletions if the prefix is too
+        short for the server to answer.
+        """
+        if self.rcon_state != RConState.LOGGED_IN:
+            raise ConnectionError('Not logged in to RCon.')
+
+        entry = (prefix, asyncio.get_running_loop().create_future())
+        self._tab_completes.append(entry)
+
+        try:
+            self._send(struct.pack('<b', RConClientHeaders.TABCOMPLETE) + prefix.encode())
+            return await asyncio.wait_for(entry[1], LAUNCHER_TIMEOUT)
+        except TimeoutError:
+            raise TimeoutError('Connection timed out while waiting for tab completion from server.')
+        finally:
+            if entry in self._tab_completes:
+                self._tab_completes.remove(entry)
+
     def send_command_rcon(self, command: str):
         """Check commands here https://wiki.zandronum.com/Console_commands"""
         packetmsg = struct.pack('<b', RConClientHeaders.COMMAND) + command.encode()
         self._send(packetmsg)
-
-    def get_player(self, username: str):
-        return next((p for p in self.players if p.name == username), None)
\ No newline at end of file